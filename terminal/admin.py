@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from apps.terminal.models import CommandPolicy, CommandPolicyLog
+
+
+@admin.register(CommandPolicy)
+class CommandPolicyAdmin(admin.ModelAdmin):
+    list_display = ('name', 'action', 'priority', 'is_active', 'date_updated')
+    list_filter = ('action', 'is_active')
+    search_fields = ('name', 'rules')
+
+
+@admin.register(CommandPolicyLog)
+class CommandPolicyLogAdmin(admin.ModelAdmin):
+    list_display = ('date_joined', 'policy_name', 'action', 'user_name', 'asset_hostname', 'account_name', 'raw_command')
+    list_filter = ('action',)
+    search_fields = ('policy_name', 'raw_command', 'user_name', 'asset_hostname')
@@ -8,3 +8,22 @@ class TerminalConfig(AppConfig):
 
     def ready(self):
         super().ready()
+        from django.db import transaction
+        from django.db.models.signals import post_save, post_delete
+        from apps.assets.models import BlackCommand
+        from apps.terminal.command_policy import notify_command_policy_change
+        from apps.terminal.models import CommandPolicy
+        from apps.utils.command_matcher import notify_black_command_change
+
+        def on_policy_change(sender, **kwargs):
+            # 事务提交后再通知, 避免其它进程读到旧数据
+            transaction.on_commit(notify_command_policy_change)
+
+        def on_black_command_change(sender, **kwargs):
+            # BLACK_COMMAND_CACHE 随高危命令的增删更新, 同样在提交后通知重新加载
+            transaction.on_commit(notify_black_command_change)
+
+        post_save.connect(on_policy_change, sender=CommandPolicy, weak=False)
+        post_delete.connect(on_policy_change, sender=CommandPolicy, weak=False)
+        post_save.connect(on_black_command_change, sender=BlackCommand, weak=False)
+        post_delete.connect(on_black_command_change, sender=BlackCommand, weak=False)
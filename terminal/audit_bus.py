@@ -0,0 +1,394 @@
+"""
+审计事件总线: 文件操作、高危命令、命令策略命中、命令记录不再每条发一个 celery 任务, 而是追加到一个 redis stream,
+由消费组中的消费者批量读取、按类型分组后 bulk_create 写入, 写入成功后 ack
+
+    生产者  XADD terminal:audit  t=类型 d=按字段顺序的 JSON 数组 ts=时间
+    消费者  XREADGROUP 批量读取 -> 解码 -> 按类型批量写入 -> XACK
+            每 RECLAIM_INTERVAL 秒用 XAUTOCLAIM 接管超过 RECLAIM_IDLE 秒未 ack 的条目(消费者崩溃遗留的)
+            投递超过 MAX_DELIVERIES 次仍写入失败的条目转入死信 stream, 不再阻塞后续条目
+
+批量写入失败时逐条重试, 仍失败的留在待处理列表, 由 reclaim 再次投递
+stream 按 STREAM_MAXLEN 近似截断, 该值需远大于正常的积压量, 否则未消费的条目会被截掉
+需要 redis >= 6.2 (XAUTOCLAIM)
+"""
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import datetime
+
+from apps.assets.models import BlackCommand
+from apps.audits.serializers.command_log import CommandLogSerializer, BlackCommandLogSerializer
+from apps.audits.serializers.file_serializer import FileOperateSerializer
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+AUDIT_STREAM = getattr(settings, 'TERMINAL_AUDIT_STREAM', 'terminal:audit')
+AUDIT_GROUP = getattr(settings, 'TERMINAL_AUDIT_GROUP', 'terminal-audit')
+STREAM_MAXLEN = getattr(settings, 'TERMINAL_AUDIT_STREAM_MAXLEN', 1000000)
+# 每次读取的最大条目数
+CONSUME_BATCH = getattr(settings, 'TERMINAL_AUDIT_CONSUME_BATCH', 500)
+# 没有新条目时阻塞等待的时间(毫秒)
+CONSUME_BLOCK = 1000
+# 条目超过该时间(秒)未 ack 视为消费者已崩溃, 由其它消费者接管
+RECLAIM_IDLE = getattr(settings, 'TERMINAL_AUDIT_RECLAIM_IDLE', 60)
+RECLAIM_INTERVAL = 10
+MAX_DELIVERIES = getattr(settings, 'TERMINAL_AUDIT_MAX_DELIVERIES', 5)
+DEAD_SUFFIX = ':dead'
+
+EVENT_COMMAND = 'c'
+EVENT_BLACK_COMMAND = 'b'
+EVENT_FILE = 'f'
+EVENT_POLICY_COMMAND = 'p'
+# 各类事件按此顺序编码成数组, 不重复存储字段名
+EVENT_FIELDS = {
+    EVENT_COMMAND: ('name', 'command', 'asset_id', 'account_id', 'user_id', 'duration'),
+    EVENT_BLACK_COMMAND: ('commands', 'asset_hostname', 'account_name', 'username', 'command'),
+    EVENT_FILE: (
+        'name', 'origin_path', 'target_path', 'filename', 'operate_type',
+        'operator_id', 'asset_id', 'user_id', 'file_size'
+    ),
+    EVENT_POLICY_COMMAND: (
+        'policy_id', 'policy_name', 'action', 'rules', 'asset_hostname', 'account_name', 'username', 'command'
+    ),
+}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _id_time(entry_id):
+    """
+    stream 条目 id 的毫秒时间戳
+    """
+    return int(_decode(entry_id).split('-')[0]) / 1000.0
+
+
+def encode_event(event_type, values, timestamp=None):
+    return {'t': event_type, 'd': json.dumps(values, ensure_ascii=False), 'ts': timestamp or time.time()}
+
+
+def decode_event(fields):
+    """
+    :return: (类型, 字段 dict)
+    """
+    fields = {_decode(k): _decode(v) for k, v in fields.items()}
+    event_type = fields['t']
+    event = dict(zip(EVENT_FIELDS[event_type], json.loads(fields['d'])))
+    event['ts'] = float(fields['ts'])
+    return event_type, event
+
+
+def persist_commands(events):
+    model = CommandLogSerializer.Meta.model
+    model.objects.bulk_create([model(
+        name=e['name'],
+        command={'command': e['command']},
+        date_joined=datetime.fromtimestamp(e['ts']),
+        executor_id=e['account_id'],
+        asset_id=e['asset_id'],
+        jms_user_id=e['user_id'],
+        duration=e['duration'],
+    ) for e in events], batch_size=CONSUME_BATCH)
+
+
+def persist_black_commands(events):
+    # 一次查询所有命中规则的 id
+    keys = {key for e in events for key in e['commands']}
+    command_ids = dict(BlackCommand.objects.filter(key__in=list(keys)).values_list('key', 'id'))
+    model = BlackCommandLogSerializer.Meta.model
+    model.objects.bulk_create([model(
+        command_id=command_ids[key],
+        raw_command=e['command'],
+        date_joined=datetime.fromtimestamp(e['ts']),
+        account_name=e['account_name'],
+        asset_hostname=e['asset_hostname'],
+        user_name=e['username'],
+    ) for e in events for key in e['commands'] if key in command_ids], batch_size=CONSUME_BATCH)
+
+
+def persist_files(events):
+    model = FileOperateSerializer.Meta.model
+    model.objects.bulk_create([
+        model(**{field: e[field] for field in EVENT_FIELDS[EVENT_FILE]}) for e in events
+    ], batch_size=CONSUME_BATCH)
+
+
+def persist_policy_commands(events):
+    # 避免在 app 加载前导入 model
+    from apps.terminal.models import CommandPolicyLog
+
+    CommandPolicyLog.objects.bulk_create([CommandPolicyLog(
+        policy_id=e['policy_id'],
+        policy_name=e['policy_name'],
+        action=e['action'],
+        rules=e['rules'],
+        raw_command=e['command'],
+        asset_hostname=e['asset_hostname'],
+        account_name=e['account_name'],
+        user_name=e['username'],
+        date_joined=datetime.fromtimestamp(e['ts']),
+    ) for e in events], batch_size=CONSUME_BATCH)
+
+
+PERSISTERS = {
+    EVENT_COMMAND: persist_commands,
+    EVENT_BLACK_COMMAND: persist_black_commands,
+    EVENT_FILE: persist_files,
+    EVENT_POLICY_COMMAND: persist_policy_commands,
+}
+
+
+class AuditBus(object):
+    """
+    生产者接口和积压指标
+    """
+    def __init__(self, redis=None, stream=AUDIT_STREAM, group=AUDIT_GROUP):
+        self.redis = redis or default_redis
+        self.stream = stream
+        self.group = group
+
+    @property
+    def dead_stream(self):
+        return self.stream + DEAD_SUFFIX
+
+    def publish(self, event_type, values, timestamp=None):
+        try:
+            self.redis.xadd(
+                self.stream, encode_event(event_type, values, timestamp), maxlen=STREAM_MAXLEN, approximate=True
+            )
+        except:
+            logger.error(traceback.format_exc())
+
+    def command(self, name, command_str, asset_id, account_id, user_id, duration, timestamp=None):
+        """
+        命令记录
+        :param timestamp: 命令输入的时间, 默认为当前时间
+        """
+        self.publish(EVENT_COMMAND, [name, command_str, asset_id, account_id, user_id, duration], timestamp)
+
+    def black_command(self, commands, asset_hostname, account_name, username, command):
+        """
+        高危命令记录
+        :param commands: 命中的高危命令集合
+        """
+        self.publish(EVENT_BLACK_COMMAND, [sorted(commands), asset_hostname, account_name, username, command])
+
+    def policy_command(self, policy, action, rules, asset_hostname, account_name, username, command):
+        """
+        命令策略命中记录, 命中的是策略规则而不是高危命令, 单独记录
+        :param policy: 命中的策略
+        :param rules: 命中的规则
+        """
+        self.publish(EVENT_POLICY_COMMAND, [
+            policy.id, policy.name, action, sorted(rules), asset_hostname, account_name, username, command
+        ])
+
+    def file_operate(self, name, origin_path, target_path, filename, operate_type,
+                     operator_id, asset_id, user_id, file_size=0):
+        """
+        文件操作记录
+        """
+        self.publish(EVENT_FILE, [
+            name, origin_path, target_path, filename, operate_type, operator_id, asset_id, user_id, file_size
+        ])
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except Exception as e:
+            # 消费组已存在
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def metrics(self):
+        """
+        积压指标
+        :return: {
+            'length': stream 长度,
+            'pending': 已投递未 ack 的条目数,
+            'lag': 还未投递的条目数(redis 7 以上),
+            'behind_seconds': 最新条目与最后投递的条目的时间差,
+            'oldest_pending_seconds': 最早的未 ack 条目已等待的时间,
+            'consumers': 消费者数,
+            'dead': 死信条目数,
+        }
+        """
+        self.ensure_group()
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xlen(self.stream)
+        pipe.xinfo_stream(self.stream)
+        pipe.xinfo_groups(self.stream)
+        pipe.xpending(self.stream, self.group)
+        pipe.xlen(self.dead_stream)
+        length, stream_info, groups, pending, dead = pipe.execute()
+        group = {}
+        for info in groups:
+            info = {_decode(k): v for k, v in info.items()}
+            if _decode(info['name']) == self.group:
+                group = info
+        last_generated = stream_info.get('last-generated-id')
+        last_delivered = group.get('last-delivered-id')
+        behind = 0
+        if last_generated and last_delivered:
+            behind = max(_id_time(last_generated) - _id_time(last_delivered), 0)
+        oldest = pending.get('min') if pending else None
+        return {
+            'length': length,
+            'pending': pending.get('pending', 0) if pending else 0,
+            'lag': group.get('lag'),
+            'behind_seconds': round(behind, 3),
+            'oldest_pending_seconds': round(now - _id_time(oldest), 3) if oldest else 0,
+            'consumers': group.get('consumers', 0),
+            'dead': dead,
+        }
+
+
+class ConsumerStats(object):
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self.acked = 0
+        self.failed = 0
+        self.reclaimed = 0
+        self.dead = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class AuditConsumer(object):
+    """
+    消费组中的一个消费者, 同一消费组可以在多个进程/主机上各运行一个
+    """
+    def __init__(self, bus=None, name=None, persisters=None, batch=CONSUME_BATCH,
+                 reclaim_idle=RECLAIM_IDLE, max_deliveries=MAX_DELIVERIES):
+        self.bus = bus or audit_bus
+        self.redis = self.bus.redis
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.persisters = persisters or PERSISTERS
+        self.batch = batch
+        self.reclaim_idle = reclaim_idle
+        self.max_deliveries = max_deliveries
+        self.stats = ConsumerStats()
+        self.stop = False
+
+    def run(self):
+        self.bus.ensure_group()
+        last_reclaim = 0
+        while not self.stop:
+            try:
+                if time.time() - last_reclaim >= RECLAIM_INTERVAL:
+                    self.reclaim()
+                    last_reclaim = time.time()
+                self.poll(CONSUME_BLOCK)
+            except:
+                logger.error(traceback.format_exc())
+                time.sleep(1)
+
+    def poll(self, block=None):
+        """
+        读取并处理一批新条目
+        :return: 处理的条目数
+        """
+        response = self.redis.xreadgroup(
+            self.bus.group, self.name, {self.bus.stream: '>'}, count=self.batch, block=block
+        )
+        count = 0
+        for _, entries in response or ():
+            self.handle(entries)
+            count += len(entries)
+        return count
+
+    def handle(self, entries):
+        """
+        :param entries: [(id, 字段), ...]
+        """
+        groups = {}
+        broken = []
+        for entry_id, fields in entries:
+            try:
+                event_type, event = decode_event(fields)
+                groups.setdefault(event_type, []).append((entry_id, event))
+            except:
+                logger.error(traceback.format_exc())
+                broken.append((entry_id, fields))
+        if broken:
+            self.bury(broken)
+        for event_type, items in groups.items():
+            persist = self.persisters[event_type]
+            try:
+                persist([event for _, event in items])
+                done = [entry_id for entry_id, _ in items]
+            except:
+                logger.error(traceback.format_exc())
+                # 批量失败时逐条写入, 找出有问题的条目, 其余的照常 ack
+                done = []
+                for entry_id, event in items:
+                    try:
+                        persist([event])
+                        done.append(entry_id)
+                    except:
+                        self.stats.failed += 1
+            if done:
+                self.redis.xack(self.bus.stream, self.bus.group, *done)
+                self.stats.acked += len(done)
+            self.stats.events += len(items)
+        self.stats.batches += 1
+
+    def bury(self, entries):
+        """
+        条目转入死信 stream 并 ack
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id, fields in entries:
+            pipe.xadd(self.bus.dead_stream, dict(fields, id=_decode(entry_id)), maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.xack(self.bus.stream, self.bus.group, *[entry_id for entry_id, _ in entries])
+        pipe.execute()
+        self.stats.dead += len(entries)
+
+    def reclaim(self):
+        """
+        接管长时间未 ack 的条目并处理
+        :return: 接管的条目数
+        """
+        start = '0-0'
+        total = 0
+        while True:
+            response = self.redis.xautoclaim(
+                self.bus.stream, self.bus.group, self.name, int(self.reclaim_idle * 1000), start, count=self.batch
+            )
+            start, entries = response[0], response[1]
+            # 已被截断删除的条目 redis 6.2 返回空字段, 直接 ack
+            deleted = [entry_id for entry_id, fields in entries if not fields]
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+            if deleted:
+                self.redis.xack(self.bus.stream, self.bus.group, *deleted)
+            if entries:
+                total += len(entries)
+                self.stats.reclaimed += len(entries)
+                deliveries = {
+                    _decode(item['message_id']): item['times_delivered']
+                    for item in self.redis.xpending_range(
+                        self.bus.stream, self.bus.group, entries[0][0], entries[-1][0], len(entries), self.name
+                    )
+                }
+                dead = [(i, f) for i, f in entries if deliveries.get(_decode(i), 0) > self.max_deliveries]
+                if dead:
+                    self.bury(dead)
+                    dead_ids = {i for i, _ in dead}
+                    entries = [(i, f) for i, f in entries if i not in dead_ids]
+                if entries:
+                    self.handle(entries)
+            if _decode(start) == '0-0':
+                break
+        return total
+
+
+audit_bus = AuditBus()
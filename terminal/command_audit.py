@@ -0,0 +1,195 @@
+"""
+命令审计: 会话每输入完一条命令放入有界队列, 后台线程攒够 AUDIT_BATCH_SIZE 条或每 AUDIT_FLUSH_INTERVAL 秒
+用一次 bulk_create 批量写入命令记录, 不再每条命令发一个 celery 任务、做一次序列化校验和一次 insert
+每条记录带命令输入的时间(date_joined)和输入时会话已持续的秒数(duration)
+数据库暂时不可用时保留未写入的记录下次重试, 积压超过队列上限后转交审计事件总线
+进程退出时(drain)先停止写线程, 再写入队列中、写线程正在攒的和待重试的全部记录
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from django.db import close_old_connections
+
+from apps.audits.serializers.command_log import CommandLogSerializer
+from apps.terminal.audit_bus import audit_bus
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 每批写入的最大条数
+AUDIT_BATCH_SIZE = getattr(settings, 'TERMINAL_AUDIT_BATCH_SIZE', 500)
+# 最长多久(秒)写入一次
+AUDIT_FLUSH_INTERVAL = getattr(settings, 'TERMINAL_AUDIT_FLUSH_INTERVAL', 1)
+# 待写入(含写入失败待重试)的记录上限
+AUDIT_QUEUE_SIZE = getattr(settings, 'TERMINAL_AUDIT_QUEUE_SIZE', 100000)
+
+
+class AuditStats(object):
+    def __init__(self):
+        self.commands = 0
+        self.flushes = 0
+        self.failures = 0
+        self.fallbacks = 0  # 积压过多转交审计事件总线的记录数
+        self.max_flush_time = 0
+
+    def as_dict(self):
+        return {
+            'commands': self.commands,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'fallbacks': self.fallbacks,
+            'max_flush_time': round(self.max_flush_time, 4),
+        }
+
+
+class CommandAuditSink(object):
+    """
+    命令记录的批量写入线程
+    """
+    def __init__(self, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL,
+                 maxsize=AUDIT_QUEUE_SIZE, model=None):
+        """
+        :param model: 命令记录的模型, 默认为 CommandLogSerializer 的模型
+        """
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.model = model or CommandLogSerializer.Meta.model
+        self.stats = AuditStats()
+        self.stop = True
+        self._pending = []  # 写入失败待重试的记录
+        self._batch = []  # 写线程正在攒的记录, 与 _pending 一样由 _flush_lock 保护, drain 时一并写入
+        self._draining = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def check(self):
+        """
+        检查写线程是否启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        self._thread = threading.Thread(target=self.run, name='terminal-command-audit', daemon=True)
+        self._thread.start()
+
+    def add(self, name, command, asset_id, account_id, user_id, duration, timestamp=None):
+        """
+        :param name: 会话标识
+        :param command: 命令
+        :param duration: 输入命令时会话已持续的秒数
+        :param timestamp: 命令输入的时间, 默认为当前时间
+        """
+        row = {
+            'name': name,
+            'command': {'command': command},
+            'date_joined': timestamp or datetime.now(),
+            'executor_id': account_id,
+            'asset_id': asset_id,
+            'jms_user_id': user_id,
+            'duration': duration,
+        }
+        self.check()
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.fallback([row])
+
+    def fallback(self, rows):
+        """
+        转交审计事件总线, 由总线的消费者写入
+        """
+        for row in rows:
+            try:
+                audit_bus.command(
+                    row['name'], row['command']['command'], row['asset_id'],
+                    row['executor_id'], row['jms_user_id'], row['duration'],
+                    timestamp=row['date_joined'].timestamp()
+                )
+                self.stats.fallbacks += 1
+            except:
+                logger.error(traceback.format_exc())
+
+    def run(self):
+        last_flush = time.time()
+        while not self._draining:
+            timeout = max(self.flush_interval - (time.time() - last_flush), 0.01)
+            rows = []
+            try:
+                rows.append(self.queue.get(timeout=timeout))
+                while len(rows) + len(self._batch) < self.batch_size:
+                    rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            with self._flush_lock:
+                self._batch.extend(row for row in rows if row is not None)
+                if len(self._batch) >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                    batch, self._batch = self._batch, []
+                    self._flush(self._pending + batch)
+                    last_flush = time.time()
+
+    def flush(self, rows=()):
+        """
+        批量写入, 失败的记录保留到下一次
+        """
+        with self._flush_lock:
+            self._flush(self._pending + list(rows))
+
+    def _flush(self, rows):
+        self._pending = []
+        if not rows:
+            return
+        start = time.time()
+        try:
+            # 写线程长期持有数据库连接, 每次写入前清理已失效的连接
+            close_old_connections()
+            self.model.objects.bulk_create([self.model(**row) for row in rows], batch_size=self.batch_size)
+            self.stats.commands += len(rows)
+            self.stats.flushes += 1
+        except:
+            logger.error(traceback.format_exc())
+            self.stats.failures += 1
+            overflow = len(rows) - self.maxsize
+            if overflow > 0:
+                self.fallback(rows[:overflow])
+                rows = rows[overflow:]
+            self._pending = rows
+        self.stats.max_flush_time = max(self.stats.max_flush_time, time.time() - start)
+
+    def drain(self, timeout=10):
+        """
+        进程退出前停止写线程, 写入队列中剩余的、写线程已取出还没写入的和待重试的记录
+        :param timeout: 等待写线程结束的最长时间(秒), 写线程正在写入时 drain 等它写完
+        """
+        self._draining = True
+        try:
+            # 唤醒正在等待队列的写线程
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        rows = []
+        while True:
+            try:
+                row = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                rows.append(row)
+        with self._flush_lock:
+            batch, self._batch = self._batch, []
+            self._flush(self._pending + batch + rows)
+
+
+command_audit = CommandAuditSink()
+atexit.register(command_audit.drain)
@@ -0,0 +1,163 @@
+import logging
+import time
+
+from django.db import close_old_connections
+
+from apps.utils.command_matcher import CommandMatcher, ReloadableRules
+from apps.utils.redis_tool import default_redis
+
+logger = logging.getLogger('service')
+
+# 命令策略变更通知
+COMMAND_POLICY_CHANNEL = 'terminal:command_policy:changed'
+# 按 (用户, 资产, 账号) 缓存的适用策略数量上限
+POLICY_CACHE_SIZE = 10000
+
+
+class Policy(object):
+    __slots__ = ('id', 'name', 'action', 'priority', 'matcher', 'user_ids', 'asset_ids', 'account_ids')
+
+    def __init__(self, id, name, rules, action, priority=50, user_ids=(), asset_ids=(), account_ids=()):
+        self.id = id
+        self.name = name
+        self.action = action
+        self.priority = priority
+        self.matcher = CommandMatcher(rules)
+        self.user_ids = frozenset(user_ids or ())
+        self.asset_ids = frozenset(asset_ids or ())
+        self.account_ids = frozenset(account_ids or ())
+
+    def applies_to(self, user_id, asset_id, account_id):
+        return (
+            (not self.user_ids or user_id in self.user_ids) and
+            (not self.asset_ids or asset_id in self.asset_ids) and
+            (not self.account_ids or account_id in self.account_ids)
+        )
+
+
+class Verdict(object):
+    __slots__ = ('action', 'policy', 'rules')
+
+    def __init__(self, action, policy, rules):
+        self.action = action
+        self.policy = policy
+        self.rules = rules
+
+    @property
+    def blocked(self):
+        return self.action == 'block'
+
+
+class PolicyIndex(object):
+    """
+    命令策略的内存索引
+    按用户、资产、账号分别建倒排表, 某个 (用户, 资产, 账号) 适用的策略按优先级排好后缓存,
+    判定时只需依次匹配这几条策略已编译好的规则, 第一条命中的策略决定结果
+    """
+    def __init__(self, policies=()):
+        self.policies = sorted(policies, key=lambda p: (p.priority, p.id))
+        self._global = []
+        self._by_user = {}
+        self._by_asset = {}
+        self._by_account = {}
+        for policy in self.policies:
+            if not (policy.user_ids or policy.asset_ids or policy.account_ids):
+                self._global.append(policy)
+            for user_id in policy.user_ids:
+                self._by_user.setdefault(user_id, []).append(policy)
+            for asset_id in policy.asset_ids:
+                self._by_asset.setdefault(asset_id, []).append(policy)
+            for account_id in policy.account_ids:
+                self._by_account.setdefault(account_id, []).append(policy)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.policies)
+
+    def resolve(self, user_id, asset_id, account_id):
+        """
+        :return: 适用的策略, 按优先级排序
+        """
+        key = (user_id, asset_id, account_id)
+        policies = self._cache.get(key)
+        if policies is None:
+            candidates = set(self._global)
+            candidates.update(self._by_user.get(user_id, ()))
+            candidates.update(self._by_asset.get(asset_id, ()))
+            candidates.update(self._by_account.get(account_id, ()))
+            policies = sorted(
+                (p for p in candidates if p.applies_to(user_id, asset_id, account_id)),
+                key=lambda p: (p.priority, p.id)
+            )
+            if len(self._cache) >= POLICY_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = policies
+        return policies
+
+    def verdict(self, user_id, asset_id, account_id, command):
+        """
+        :return: Verdict, 没有策略命中时返回 None
+        """
+        for policy in self.resolve(user_id, asset_id, account_id):
+            rules = policy.matcher.match(command)
+            if rules:
+                return Verdict(policy.action, policy, rules)
+        return None
+
+
+class CommandPolicyManager(ReloadableRules):
+    """
+    进程内共享的命令策略索引, 策略保存/删除后通过 COMMAND_POLICY_CHANNEL 通知所有进程重新加载
+    """
+    channel = COMMAND_POLICY_CHANNEL
+
+    def load(self):
+        # 避免在 app 加载前导入 model
+        from apps.terminal.models import CommandPolicy
+
+        policies = []
+        for obj in CommandPolicy.objects.filter(is_active=True):
+            policies.append(Policy(
+                obj.id, obj.name, obj.rules.splitlines(), obj.action, obj.priority,
+                obj.user_ids, obj.asset_ids, obj.account_ids
+            ))
+        index = PolicyIndex(policies)
+        logger.info('command policies loaded: {}'.format(len(index)))
+        return index
+
+    def background_reload(self):
+        # 监听线程长期存活, 与 command_audit 的写线程一样, 查询前后清理已失效或超过 CONN_MAX_AGE 的连接
+        close_old_connections()
+        try:
+            return self.reload()
+        finally:
+            close_old_connections()
+
+    def verdict(self, user_id, asset_id, account_id, command):
+        return self.get().verdict(user_id, asset_id, account_id, command)
+
+
+def notify_command_policy_change(*args, **kwargs):
+    """
+    策略变更后通知所有进程重新加载, 可直接作为 post_save/post_delete 信号处理函数
+    """
+    default_redis.publish(COMMAND_POLICY_CHANNEL, 1)
+
+
+command_policy_manager = CommandPolicyManager()
+
+
+if __name__ == "__main__":
+    # 判定耗时: 1000 条策略, 按用户/资产/账号分散作用范围
+    index = PolicyIndex([
+        Policy(
+            i, 'policy-{}'.format(i), ['rm -rf /', 'shutdown', 'mkfs.ext{}'.format(i), 're:curl .*\\|\\s*sh'],
+            'block', i % 100, user_ids=[i % 50], asset_ids=[i % 200] if i % 3 else []
+        ) for i in range(1000)
+    ])
+    line = 'sudo -u root /bin/ls -la /var/log | grep error && tail -n 100 messages'
+    count = 100000
+    start = time.perf_counter()
+    for n in range(count):
+        index.verdict(n % 50, n % 200, 1, line)
+    print('verdict: {:.1f} us'.format((time.perf_counter() - start) / count * 1e6))
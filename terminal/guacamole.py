@@ -3,11 +3,12 @@ import logging
 import selectors
 import socket
 import threading
+import time
 import traceback
+import uuid
 
 from channels.generic.websocket import WebsocketConsumer
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
 
 from apps.assets.models import Asset
 from apps.common.consts import WsCode
@@ -15,9 +16,17 @@ from apps.utils.guacamole_client.gm_config import (
     GUACD, guacd_hostname, guacd_port, SCREEN_CONFIG
 )
 from apps.utils.guacamole_client.client import GuacamoleClient
+from apps.terminal.guacd_recording import remember_recording
+from apps.terminal.session_registry import session_registry
+from rzx_jms import settings
 
 logger = logging.getLogger('service')
 
+# 窗口大小变化(size 指令)的防抖, 与 ssh 终端使用相同的配置
+RESIZE_DEBOUNCE = getattr(settings, 'TERMINAL_RESIZE_DEBOUNCE', 0.2)
+RESIZE_MAX_DELAY = getattr(settings, 'TERMINAL_RESIZE_MAX_DELAY', 1)
+SIZE_INSTRUCTION = '4.size,'
+
 
 class Conn(object):
     def __init__(self, *args, **kwargs):
@@ -77,6 +86,7 @@ class Conn(object):
         try:
             instruction = ws.gd_client.receive()
             if instruction:
+                ws.bytes_out += len(instruction)
                 ws.send(text_data=instruction)  # 发送信息到WebSock终端显示
                 # error message
                 if instruction.startswith('5.error'):
@@ -104,6 +114,24 @@ class GuacamoleWs(WebsocketConsumer):
         self.account = None
         self.gd_client = None
         self.th = Conn()
+        # 在线会话登记
+        self.token = uuid.uuid4().hex
+        self.start_time = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.registered = False
+        # 等待发送的 size 指令
+        self._pending_size = None
+        self._pending_since = None
+        self._pending_last = None
+        self._resize_timer = None
+        self._resize_lock = threading.Lock()
+        # 会话线程和防抖定时器都会向 guacd 发送, 写入 socket 和流量计数需要串行
+        self._send_lock = threading.Lock()
+
+    @property
+    def protocol(self):
+        return self.asset.protocol
 
     def connect(self):
         self.user = self.scope["user"]
@@ -115,6 +143,11 @@ class GuacamoleWs(WebsocketConsumer):
             try:
                 self.asset = get_object_or_404(Asset, pk=asset_id)
                 self.account = self.asset.accounts.get(pk=account_id)
+                reason = session_registry.admit(self.user.id, self.asset.id)
+                if reason:
+                    self.send(text_data=json.dumps({'code': WsCode.ERROR.value, 'message': reason}))
+                    self.close()
+                    return
             except Asset.DoesNotExist:
                 self.send(
                     text_data=json.dumps({'code': WsCode.ERROR.value, 'message': 'connection fail...'})
@@ -126,7 +159,6 @@ class GuacamoleWs(WebsocketConsumer):
             )
             self.close()
 
-        file_log = '%s.log' % (timezone.now().strftime("%Y.%m.%d.%H.%M.%S"))
         try:
             # 连接本地 guacamole-server
             self.gd_client = GuacamoleClient(guacd_hostname, guacd_port)
@@ -138,10 +170,13 @@ class GuacamoleWs(WebsocketConsumer):
                 password=self.account.password,
                 width=query_params.get('width') or SCREEN_CONFIG['width'],
                 height=query_params.get('height') or SCREEN_CONFIG['height'],
-                # recording_name=file_log,  # 录像文件名
+                recording_name=self.token,  # 录像文件名, 由录像收集器按 token 找到会话信息
                 **GUACD,
             )
             self.th.add_guacamole(self)
+            session_registry.register(self)
+            self.registered = True
+            remember_recording(self)
             # a = threading.Thread(target=self.data_polling, daemon=True)
             # a.start()
 
@@ -152,11 +187,66 @@ class GuacamoleWs(WebsocketConsumer):
             self.close()
 
     def receive(self, text_data=None, bytes_data=None):
+        if text_data and text_data.startswith(SIZE_INSTRUCTION) and text_data.count(';') == 1:
+            # 拖动窗口时浏览器会连续发送 size, 合并后只发送最后一次
+            self.resize(text_data)
+            return
         try:
-            self.gd_client.send(text_data)
+            self.send_to_guacd(text_data)
         except:
             logger.error(traceback.format_exc())
             self.close()
 
+    def send_to_guacd(self, instruction):
+        with self._send_lock:
+            self.bytes_in += len(instruction)
+            self.gd_client.send(instruction)
+
+    def resize(self, instruction):
+        """
+        只记下最后一次的 size, 没有等待中的定时器时才启动一个, 连续拖动时不会每条消息都新建线程
+        """
+        with self._resize_lock:
+            now = time.time()
+            self._pending_size = instruction
+            self._pending_last = now
+            if self._pending_since is None:
+                self._pending_since = now
+            if self._resize_timer is None:
+                self._schedule_resize(RESIZE_DEBOUNCE)
+
+    def _schedule_resize(self, delay):
+        self._resize_timer = threading.Timer(delay, self.apply_resize)
+        self._resize_timer.daemon = True
+        self._resize_timer.start()
+
+    def apply_resize(self):
+        with self._resize_lock:
+            if self._pending_size is None:
+                self._resize_timer = None
+                return
+            now = time.time()
+            due = min(self._pending_last + RESIZE_DEBOUNCE, self._pending_since + RESIZE_MAX_DELAY)
+            if now < due:
+                # 等待期间又收到了 size, 推迟到最后一次之后 RESIZE_DEBOUNCE 秒, 最多推迟到 RESIZE_MAX_DELAY
+                self._schedule_resize(due - now)
+                return
+            instruction, self._pending_size = self._pending_size, None
+            self._pending_since = self._pending_last = None
+            self._resize_timer = None
+        if not self.gd_client:
+            return
+        try:
+            self.send_to_guacd(instruction)
+        except:
+            logger.error(traceback.format_exc())
+
     def disconnect(self, code):
+        with self._resize_lock:
+            self._pending_size = None
+            if self._resize_timer:
+                self._resize_timer.cancel()
+                self._resize_timer = None
+        if self.registered:
+            session_registry.unregister(self)
         self.th.del_guacamole(self)
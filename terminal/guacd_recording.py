@@ -0,0 +1,286 @@
+"""
+RDP/VNC 录像收集: guacd 把录像写到 REPLAY_PATH(文件名为会话 token), 收集器定期扫描该目录,
+会话已结束且文件一段时间没有再写入的录像视为已关闭, 压缩后上传到存储库, 登记回放记录并删除本地文件
+
+    扫描 -> 认领(改名为 .collect, 多个收集器同时运行时不会重复处理) -> 进程池 gzip 压缩 -> 线程池上传 -> 登记 -> 清理
+
+压缩受 cpu 限制, 使用进程池按核数并行(celery prefork 的 worker 是守护进程, 不能再创建子进程,
+此时改用线程池, zlib 压缩时会释放 GIL, 同样可以利用多核); 上传受网络限制, 使用有界线程池
+同时在处理的录像不超过 2 * 压缩进程数, 本地压缩文件的磁盘占用有上限
+上传时设置 Content-Encoding: gzip, 浏览器下载回放时自动解压; 对象名带 .gz 后缀, 回放接口据此区分 guacd 录像和 asciicast 录像
+"""
+import gzip
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from apps.terminal.session_registry import SESSION_KEY
+from apps.utils.guacamole_client.gm_config import REPLAY_PATH
+from apps.utils.minio_tool import minio_manager
+from apps.utils.recording_upload import object_name
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 收集器读取的录像目录, 与 guacd 的 recording-path 为同一目录(guacd 在其它主机时需挂载共享存储)
+RECORD_DIR = getattr(settings, 'TERMINAL_GUACD_RECORD_DIR', REPLAY_PATH)
+# 会话结束后录像超过该时间(秒)没有写入才收集
+SETTLE_SECONDS = getattr(settings, 'TERMINAL_GUACD_RECORD_SETTLE', 30)
+# 会话登记丢失(进程崩溃)时, 录像超过该时间(秒)没有写入也收集
+ORPHAN_SECONDS = getattr(settings, 'TERMINAL_GUACD_RECORD_ORPHAN', 3600)
+# 压缩进程数, 默认为 cpu 核数
+COMPRESS_WORKERS = getattr(settings, 'TERMINAL_GUACD_COMPRESS_WORKERS', None) or os.cpu_count() or 1
+COMPRESS_LEVEL = getattr(settings, 'TERMINAL_GUACD_COMPRESS_LEVEL', 6)
+# 同时上传的录像数
+UPLOAD_WORKERS = getattr(settings, 'TERMINAL_GUACD_UPLOAD_WORKERS', 4)
+# 认领后超过该时间(秒)仍未处理完的录像(收集器崩溃), 放回待收集
+CLAIM_TIMEOUT = 3600
+# 会话信息的保存时间(秒)
+META_TTL = 7 * 24 * 3600
+
+CLAIM_SUFFIX = '.collect'
+GZIP_SUFFIX = '.gz'
+# guacd 录像文件名: 会话 token, 同名文件已存在时 guacd 会追加 .1 .2 ...
+RECORDING_NAME = re.compile(r'^([0-9a-f]{32})(\.\d+)?$')
+META_KEY = 'terminal:guacd:recording:{}'
+CHUNK_SIZE = 1024 * 1024
+
+
+def remember_recording(session):
+    """
+    guacd 会话建立时保存录像对应的会话信息, 收集录像后据此登记回放记录
+    :param session: GuacamoleWs
+    """
+    key = META_KEY.format(session.token)
+    pipe = default_redis.pipeline(transaction=False)
+    pipe.hset(key, mapping={
+        'name': '{}@{}'.format(session.account.username, session.asset.hostname),
+        'account_id': session.account.id,
+        'asset_id': session.asset.id,
+        'user_id': session.user.id,
+        'protocol': session.protocol,
+    })
+    pipe.expire(key, META_TTL)
+    pipe.execute()
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def compress_file(src, dst, level=COMPRESS_LEVEL):
+    """
+    在压缩进程中执行, 流式压缩, 不把整个录像读入内存
+    :return: (原始大小, 压缩后大小)
+    """
+    with open(src, 'rb') as f_in, gzip.open(dst, 'wb', compresslevel=level) as f_out:
+        shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+    return os.path.getsize(src), os.path.getsize(dst)
+
+
+class CollectStats(object):
+    def __init__(self):
+        self.recordings = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def add(self, size_in=0, size_out=0, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+                return
+            self.recordings += 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+
+    def as_dict(self):
+        return {
+            'recordings': self.recordings,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'elapsed': round(self.elapsed, 3),
+            'mb_per_second': round(self.bytes_in / self.elapsed / 1e6, 1) if self.elapsed else 0,
+        }
+
+
+class RecordingCollector(object):
+    """
+    guacd 录像收集器, collect 执行一轮收集, run 持续监视目录
+    """
+    def __init__(self, record_dir=RECORD_DIR, compress_workers=COMPRESS_WORKERS,
+                 upload_workers=UPLOAD_WORKERS, on_uploaded=None):
+        """
+        :param on_uploaded: 上传完成后的回调 on_uploaded(filename, meta), 返回 False 时保留本地文件
+        """
+        self.record_dir = record_dir
+        self.compress_workers = compress_workers
+        self.upload_workers = upload_workers
+        self.on_uploaded = on_uploaded
+
+    @staticmethod
+    def is_active(token):
+        return bool(default_redis.exists(SESSION_KEY.format(token)))
+
+    def pending(self, now=None):
+        """
+        :return: 已关闭的录像 [(路径, token), ...], 按修改时间从早到晚
+        """
+        now = now or time.time()
+        result = []
+        try:
+            entries = list(os.scandir(self.record_dir))
+        except FileNotFoundError:
+            return result
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(CLAIM_SUFFIX):
+                # 收集器崩溃遗留的认领, 放回待收集
+                if now - mtime > CLAIM_TIMEOUT:
+                    self.release(entry.path[:-len(CLAIM_SUFFIX)])
+                continue
+            match = RECORDING_NAME.match(entry.name)
+            if not match:
+                continue
+            idle = now - mtime
+            if idle < SETTLE_SECONDS:
+                continue
+            token = match.group(1)
+            if idle < ORPHAN_SECONDS and self.is_active(token):
+                continue
+            result.append((mtime, entry.path, token))
+        return [(path, token) for _, path, token in sorted(result)]
+
+    @staticmethod
+    def claim(path):
+        """
+        改名认领, 改名是原子操作, 只有一个收集器能成功
+        :return: 认领后的路径, 已被其它收集器认领时返回 None
+        """
+        claimed = path + CLAIM_SUFFIX
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        # 记录认领时间, 用于判断认领是否超时
+        os.utime(claimed)
+        return claimed
+
+    @staticmethod
+    def release(path):
+        """
+        处理失败, 放回待收集, 下一轮重试
+        """
+        if os.path.exists(path + CLAIM_SUFFIX + GZIP_SUFFIX):
+            os.remove(path + CLAIM_SUFFIX + GZIP_SUFFIX)
+        if os.path.exists(path + CLAIM_SUFFIX):
+            os.rename(path + CLAIM_SUFFIX, path)
+
+    def compress_executor(self):
+        # celery prefork 的 worker 是守护进程, 不允许创建子进程
+        if multiprocessing.current_process().daemon:
+            return ThreadPoolExecutor(self.compress_workers, thread_name_prefix='guacd-record-compress')
+        return ProcessPoolExecutor(self.compress_workers)
+
+    def load_meta(self, token):
+        meta = default_redis.hgetall(META_KEY.format(token))
+        return {_decode(k): _decode(v) for k, v in meta.items()}
+
+    def upload(self, path, token, future, stats, window):
+        """
+        在上传线程中执行
+        """
+        claimed = path + CLAIM_SUFFIX
+        compressed = claimed + GZIP_SUFFIX
+        try:
+            size_in, size_out = future.result()
+            filename = object_name(path) + GZIP_SUFFIX
+            minio_manager.file_upload(
+                bucket_name=settings.MINIO_BUCKET_NAME,
+                object_name=filename,
+                file_path=compressed,
+                content_type='application/octet-stream',
+                metadata={'Content-Encoding': 'gzip'},
+            )
+            meta = self.load_meta(token)
+            if self.on_uploaded is not None and self.on_uploaded(filename, meta) is False:
+                # 已上传但登记失败, 保留原始录像, 下一轮重新处理
+                self.release(path)
+                stats.add(failed=True)
+                return
+            os.remove(compressed)
+            os.remove(claimed)
+            default_redis.delete(META_KEY.format(token))
+            stats.add(size_in, size_out)
+        except:
+            logger.error(traceback.format_exc())
+            self.release(path)
+            stats.add(failed=True)
+        finally:
+            window.release()
+
+    def collect(self):
+        """
+        执行一轮收集
+        :return: CollectStats
+        """
+        stats = CollectStats()
+        start = time.perf_counter()
+        recordings = self.pending()
+        if not recordings:
+            return stats
+        # 限制同时在处理的录像数, 压缩后待上传的文件不会无限堆积
+        window = threading.BoundedSemaphore(self.compress_workers * 2)
+        compress_pool = self.compress_executor()
+        upload_pool = ThreadPoolExecutor(self.upload_workers, thread_name_prefix='guacd-record-upload')
+        try:
+            for path, token in recordings:
+                window.acquire()
+                claimed = self.claim(path)
+                if claimed is None:
+                    window.release()
+                    continue
+                try:
+                    future = compress_pool.submit(compress_file, claimed, claimed + GZIP_SUFFIX)
+                except:
+                    logger.error(traceback.format_exc())
+                    self.release(path)
+                    window.release()
+                    continue
+                # 压缩完成后立即交给上传线程, 压缩和上传流水线并行
+                future.add_done_callback(
+                    lambda f, p=path, t=token: upload_pool.submit(self.upload, p, t, f, stats, window)
+                )
+        finally:
+            # 压缩池关闭时所有回调都已执行, 之后再等待上传完成
+            compress_pool.shutdown(wait=True)
+            upload_pool.shutdown(wait=True)
+        stats.elapsed = time.perf_counter() - start
+        logger.info('guacd recordings collected: {}'.format(stats.as_dict()))
+        return stats
+
+    def run(self, interval=10):
+        """
+        持续监视录像目录
+        """
+        while True:
+            try:
+                self.collect()
+            except:
+                logger.error(traceback.format_exc())
+            time.sleep(interval)
@@ -0,0 +1,31 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.terminal.audit_bus import audit_bus, AuditConsumer, CONSUME_BATCH
+
+
+class Command(BaseCommand):
+    help = '消费审计事件总线, 批量写入文件操作、高危命令和命令记录'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', help='消费者名称, 默认为 主机名:进程号')
+        parser.add_argument('--batch', type=int, default=CONSUME_BATCH, help='每次读取的最大条目数')
+        parser.add_argument('--metrics', action='store_true', help='输出积压指标后退出')
+        parser.add_argument('--watch', type=int, default=0, help='与 --metrics 一起使用, 每隔多少秒输出一次')
+
+    def handle(self, *args, **options):
+        if options['metrics']:
+            while True:
+                self.stdout.write(json.dumps(audit_bus.metrics()))
+                if not options['watch']:
+                    return
+                time.sleep(options['watch'])
+        consumer = AuditConsumer(name=options['name'], batch=options['batch'])
+        self.stdout.write('audit consumer {} started'.format(consumer.name))
+        try:
+            consumer.run()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('audit consumer {} stopped: {}'.format(consumer.name, consumer.stats.as_dict()))
@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0002_alter_terminal_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, verbose_name='Name')),
+                ('rules', models.TextField(help_text='One rule per line, prefix "re:" for regex', verbose_name='Rules')),
+                ('action', models.CharField(choices=[('block', 'Block'), ('log', 'Log'), ('allow', 'Allow')], default='block', max_length=16, verbose_name='Action')),
+                ('priority', models.IntegerField(default=50, help_text='Smaller first', verbose_name='Priority')),
+                ('user_ids', models.JSONField(blank=True, default=list, verbose_name='Users')),
+                ('asset_ids', models.JSONField(blank=True, default=list, verbose_name='Assets')),
+                ('account_ids', models.JSONField(blank=True, default=list, verbose_name='Accounts')),
+                ('is_active', models.BooleanField(default=True, verbose_name='Active')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date updated')),
+            ],
+            options={
+                'verbose_name': 'Command Policy',
+                'ordering': ['priority', 'id'],
+            },
+        ),
+    ]
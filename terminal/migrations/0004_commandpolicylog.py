@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-18 14:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0003_commandpolicy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandPolicyLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('policy_name', models.CharField(max_length=128, verbose_name='Policy name')),
+                ('action', models.CharField(choices=[('block', 'Block'), ('log', 'Log'), ('allow', 'Allow')], max_length=16, verbose_name='Action')),
+                ('rules', models.JSONField(default=list, verbose_name='Matched rules')),
+                ('raw_command', models.TextField(verbose_name='Command')),
+                ('asset_hostname', models.CharField(max_length=128, verbose_name='Asset')),
+                ('account_name', models.CharField(max_length=128, verbose_name='Account')),
+                ('user_name', models.CharField(max_length=128, verbose_name='User')),
+                ('date_joined', models.DateTimeField(db_index=True, verbose_name='Date')),
+                ('policy', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='logs', to='terminal.commandpolicy', verbose_name='Policy')),
+            ],
+            options={
+                'verbose_name': 'Command Policy Log',
+                'ordering': ['-date_joined'],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 16:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0004_commandpolicylog'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='terminal',
+            options={'permissions': [('terminal_connect', 'Can Use Web Terminal'), ('terminal_file', 'Can Edit Files'), ('terminal_monitor', 'Can Monitor Web Terminal'), ('terminal_audit', 'Can Audit Web Terminal Sessions')], 'verbose_name': 'Web Terminal'},
+        ),
+    ]
@@ -1 +1,2 @@
 from .terminal import *
+from .command_policy import *
@@ -0,0 +1,60 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class CommandPolicy(models.Model):
+    """
+    命令执行策略: 命中规则的命令按 action 处理, 作用范围为空表示不限
+    """
+    ACTION_BLOCK = 'block'
+    ACTION_LOG = 'log'
+    ACTION_ALLOW = 'allow'
+    ACTION_CHOICES = (
+        (ACTION_BLOCK, _('Block')),
+        (ACTION_LOG, _('Log')),
+        (ACTION_ALLOW, _('Allow')),
+    )
+
+    name = models.CharField(max_length=128, verbose_name=_('Name'))
+    rules = models.TextField(verbose_name=_('Rules'), help_text=_('One rule per line, prefix "re:" for regex'))
+    action = models.CharField(
+        max_length=16, choices=ACTION_CHOICES, default=ACTION_BLOCK, verbose_name=_('Action')
+    )
+    priority = models.IntegerField(default=50, verbose_name=_('Priority'), help_text=_('Smaller first'))
+    user_ids = models.JSONField(default=list, blank=True, verbose_name=_('Users'))
+    asset_ids = models.JSONField(default=list, blank=True, verbose_name=_('Assets'))
+    account_ids = models.JSONField(default=list, blank=True, verbose_name=_('Accounts'))
+    is_active = models.BooleanField(default=True, verbose_name=_('Active'))
+    date_updated = models.DateTimeField(auto_now=True, verbose_name=_('Date updated'))
+
+    class Meta:
+        verbose_name = _('Command Policy')
+        ordering = ['priority', 'id']
+
+    def __str__(self):
+        return self.name
+
+
+class CommandPolicyLog(models.Model):
+    """
+    命令策略命中记录(log 和 block), 策略删除或修改后仍保留命中时的策略名称和规则
+    """
+    policy = models.ForeignKey(
+        CommandPolicy, null=True, blank=True, on_delete=models.SET_NULL, db_constraint=False,
+        related_name='logs', verbose_name=_('Policy')
+    )
+    policy_name = models.CharField(max_length=128, verbose_name=_('Policy name'))
+    action = models.CharField(max_length=16, choices=CommandPolicy.ACTION_CHOICES, verbose_name=_('Action'))
+    rules = models.JSONField(default=list, verbose_name=_('Matched rules'))
+    raw_command = models.TextField(verbose_name=_('Command'))
+    asset_hostname = models.CharField(max_length=128, verbose_name=_('Asset'))
+    account_name = models.CharField(max_length=128, verbose_name=_('Account'))
+    user_name = models.CharField(max_length=128, verbose_name=_('User'))
+    date_joined = models.DateTimeField(db_index=True, verbose_name=_('Date'))
+
+    class Meta:
+        verbose_name = _('Command Policy Log')
+        ordering = ['-date_joined']
+
+    def __str__(self):
+        return '{}: {}'.format(self.policy_name, self.raw_command)
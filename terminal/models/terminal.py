@@ -9,4 +9,6 @@ class Terminal(models.Model):
         permissions = [
             ('terminal_connect', 'Can Use Web Terminal'),
             ('terminal_file', 'Can Edit Files'),
+            ('terminal_monitor', 'Can Monitor Web Terminal'),
+            ('terminal_audit', 'Can Audit Web Terminal Sessions'),
         ]
@@ -0,0 +1,70 @@
+import json
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+
+from apps.common.consts import WsCode
+from apps.terminal.ssh_monitor import MONITOR_HUB_KEY, monitor_group
+from apps.utils.redis_tool import default_redis
+
+logger = logging.getLogger('service')
+
+
+class TerminalMonitorWs(WebsocketConsumer):
+    """
+    只读观察正在进行的 ssh 会话
+    加入会话的 channel layer 组接收输出, 并向会话所在进程请求最近输出的快照
+    """
+    def __init__(self, *args, **kwargs):
+        super(TerminalMonitorWs, self).__init__(*args, **kwargs)
+        self.user = None
+        self.session_token = None
+        self.hub_channel = None
+
+    def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated or not self.user.has_perm('terminal.terminal_monitor'):
+            self.accept()
+            self.send(
+                text_data=json.dumps({"code": WsCode.ERROR.value, 'message': 'connection fail...'})
+            )
+            self.close()
+            return
+        self.accept()
+        query_params = self.scope['query_params']   # type dict
+        self.session_token = query_params.get('session_token')
+        hub_channel = self.session_token and default_redis.get(MONITOR_HUB_KEY.format(self.session_token))
+        if not hub_channel:
+            self.send(
+                text_data=json.dumps({"code": WsCode.ERROR.value, 'message': 'session not found...'})
+            )
+            self.close()
+            return
+        self.hub_channel = hub_channel.decode() if isinstance(hub_channel, bytes) else hub_channel
+        async_to_sync(self.channel_layer.group_add)(monitor_group(self.session_token), self.channel_name)
+        async_to_sync(self.channel_layer.send)(self.hub_channel, {
+            'type': 'monitor.join', 'token': self.session_token, 'reply_channel': self.channel_name
+        })
+
+    def receive(self, text_data=None, bytes_data=None):
+        # 观察者只读, 忽略输入
+        pass
+
+    def terminal_output(self, event):
+        # 帧已由会话编码好, 直接转发
+        self.send(text_data=event['text'])
+
+    def terminal_close(self, event):
+        self.send(
+            text_data=json.dumps({"code": WsCode.ERROR.value, 'message': '会话已结束'}, ensure_ascii=False)
+        )
+        self.close()
+
+    def disconnect(self, code):
+        if not self.hub_channel:
+            return
+        async_to_sync(self.channel_layer.group_discard)(monitor_group(self.session_token), self.channel_name)
+        async_to_sync(self.channel_layer.send)(self.hub_channel, {
+            'type': 'monitor.leave', 'token': self.session_token
+        })
@@ -0,0 +1,284 @@
+import json
+import threading
+from collections import OrderedDict
+
+from apps.utils.cast_format import CastzReader, CASTZ_SUFFIX, index_path
+from apps.utils.cast_keyframe import iter_cast, keyframe_path, load_keyframes, nearest_keyframe
+from apps.utils.minio_tool import minio_manager
+from rzx_jms import settings
+
+# 跳转后默认返回的事件时长(秒), 播放器播完后再请求下一段
+SEEK_DURATION = getattr(settings, 'TERMINAL_PLAYBACK_SEEK_DURATION', 60)
+# 一次跳转或截取最多返回的时长(秒), 请求的时间段更长时截断, 响应在内存中生成, 不能无限大
+MAX_DURATION = getattr(settings, 'TERMINAL_PLAYBACK_MAX_DURATION', 10 * SEEK_DURATION)
+# 录像按 CHUNK_SIZE 对齐分块缓存, 缓存总大小不超过 CACHE_BYTES
+CHUNK_SIZE = getattr(settings, 'TERMINAL_PLAYBACK_CHUNK_SIZE', 1024 * 1024)
+CACHE_BYTES = getattr(settings, 'TERMINAL_PLAYBACK_CACHE_BYTES', 64 * 1024 * 1024)
+# 超过该大小的范围请求直接从存储库转发, 不进入缓存, 避免一次整段下载把热点块全部挤出
+CACHE_RANGE_LIMIT = 8 * CHUNK_SIZE
+# 预签名地址的有效期(秒)
+URL_EXPIRES = getattr(settings, 'TERMINAL_PLAYBACK_URL_EXPIRES', 3600)
+# 缓存解析后的关键帧和索引的录像数
+META_CACHE_SIZE = 64
+# ssh 录像(asciicast)的后缀, 其它录像(guacd 的 RDP/VNC 录像)不能按时间跳转或截取
+CAST_SUFFIXES = ('.cast', CASTZ_SUFFIX)
+
+
+def is_asciicast(object_name):
+    return object_name.endswith(CAST_SUFFIXES)
+
+
+class LRUCache(object):
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self._items and (
+                (self.max_items and len(self._items) > self.max_items) or
+                (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+
+    def lookup(self, key):
+        item = self.get(key)
+        return item[0] if item is not None else None
+
+
+class ChunkCache(object):
+    """
+    录像热点块缓存: 对象按 CHUNK_SIZE 对齐分块, 按块缓存最近读过的数据
+    多人回放同一录像、播放器反复请求相邻范围时不再重复从存储库读取
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, max_bytes=CACHE_BYTES, manager=None):
+        self.chunk_size = chunk_size
+        self.manager = manager or minio_manager
+        self.chunks = LRUCache(max_bytes=max_bytes)
+        self.sizes = LRUCache(max_items=1024)
+
+    def size(self, bucket_name, object_name):
+        key = (bucket_name, object_name)
+        size = self.sizes.lookup(key)
+        if size is None:
+            size = self.manager.get_object(object_name, bucket_name).size
+            self.sizes.put(key, size)
+        return size
+
+    def _fetch(self, bucket_name, object_name, offset, length):
+        response = self.manager.get_object_range(bucket_name, object_name, offset, length)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def chunk(self, bucket_name, object_name, index):
+        key = (bucket_name, object_name, index)
+        data = self.chunks.lookup(key)
+        if data is None:
+            data = self._fetch(bucket_name, object_name, index * self.chunk_size, self.chunk_size)
+            self.chunks.put(key, data, len(data))
+        return data
+
+    def iter_range(self, bucket_name, object_name, start, end):
+        """
+        :param start: 起始位置
+        :param end: 结束位置(不含)
+        :return: 数据块迭代器
+        """
+        if end - start > CACHE_RANGE_LIMIT:
+            yield from self.manager.stream_object(bucket_name, object_name, start, end - start)
+            return
+        position = start
+        while position < end:
+            index, skip = divmod(position, self.chunk_size)
+            data = self.chunk(bucket_name, object_name, index)[skip:skip + end - position]
+            if not data:
+                break
+            position += len(data)
+            yield data
+
+    def read(self, bucket_name, object_name, start, end):
+        return b''.join(self.iter_range(bucket_name, object_name, start, end))
+
+    def stats(self):
+        return {
+            'bytes': self.chunks.bytes,
+            'hits': self.chunks.hits,
+            'misses': self.chunks.misses,
+        }
+
+
+class CachedObjectFile(object):
+    """
+    通过块缓存读取的只读类文件对象, 支持 seek 和按行迭代
+    """
+    def __init__(self, bucket_name, object_name, cache=None):
+        self.bucket_name = bucket_name
+        self.name = object_name
+        self.cache = cache or chunk_cache
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.cache.size(self.bucket_name, self.name) + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        total = self.cache.size(self.bucket_name, self.name)
+        end = total if size is None or size < 0 else min(self.position + size, total)
+        data = self.cache.read(self.bucket_name, self.name, self.position, end)
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        pending = b''
+        total = self.cache.size(self.bucket_name, self.name)
+        while self.position < total:
+            index, skip = divmod(self.position, self.cache.chunk_size)
+            data = self.cache.chunk(self.bucket_name, self.name, index)[skip:]
+            if not data:
+                break
+            self.position += len(data)
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending
+
+    def close(self):
+        pass
+
+
+class RecordPlayback(object):
+    """
+    按时间读取已上传的录像: 最近的关键帧 + 关键帧之后的事件
+    普通 .cast 从关键帧记录的字节偏移开始范围读取, .castz 按索引定位到事件所在的帧
+    所有读取都经过块缓存, 关键帧和索引解析后按录像缓存
+    """
+    def __init__(self, object_name, bucket_name=None, cache=None):
+        self.object_name = object_name
+        self.bucket_name = bucket_name or settings.MINIO_BUCKET_NAME
+        self.compressed = object_name.endswith(CASTZ_SUFFIX)
+        self.cache = cache or chunk_cache
+
+    def _read(self, object_name, offset=0, length=0):
+        end = offset + length if length else self.cache.size(self.bucket_name, object_name)
+        return self.cache.read(self.bucket_name, object_name, offset, end)
+
+    def _meta(self, key, load):
+        key = (self.bucket_name, self.object_name, key)
+        value = playback_meta.lookup(key)
+        if value is None:
+            value = load()
+            playback_meta.put(key, value)
+        return value
+
+    @property
+    def keyframes(self):
+        def load():
+            try:
+                return load_keyframes(self._read(keyframe_path(self.object_name)))
+            except Exception:
+                # 关键帧还没生成(或生成失败)时从头回放, 不缓存, 生成后即可使用
+                return None
+        return self._meta('keyframes', load) or []
+
+    def castz_reader(self):
+        index = self._meta('index', lambda: [
+            json.loads(line) for line in self._read(index_path(self.object_name)).decode().splitlines() if line
+        ])
+        return CastzReader(CachedObjectFile(self.bucket_name, self.object_name, self.cache), index=index)
+
+    def seek(self, timestamp, duration=SEEK_DURATION):
+        """
+        :param timestamp: 跳转到的时间(秒)
+        :param duration: 返回 timestamp 之后多长时间的事件, 不超过 MAX_DURATION
+        :return: {
+            'header': 录像文件头,
+            'keyframe': {'time', 'columns', 'lines', 'screen'} 或 None,
+            'events': 关键帧(没有关键帧时为录像开头)到 timestamp + duration 的事件, 播放器先还原关键帧,
+                      再快速应用 timestamp 之前的事件, 之后正常播放
+        }
+        """
+        keyframe = nearest_keyframe(self.keyframes, timestamp)
+        end = timestamp + min(duration, MAX_DURATION)
+        if self.compressed:
+            reader = self.castz_reader()
+            header = reader.header
+            events = (event for _, event in reader.events_from(keyframe[1] if keyframe else 0))
+        elif keyframe:
+            head = self._read(self.object_name, 0, 64 * 1024)
+            header = json.loads(head.split(b'\n', 1)[0])
+            stream = CachedObjectFile(self.bucket_name, self.object_name, self.cache)
+            stream.seek(keyframe[2])
+            events = (json.loads(line) for line in stream if line.strip())
+        else:
+            header, items = iter_cast(CachedObjectFile(self.bucket_name, self.object_name, self.cache))
+            events = (event for _, event, _ in items)
+        result = []
+        for event in events:
+            if event[0] > end:
+                break
+            result.append(event)
+        return {
+            'header': header,
+            'keyframe': {
+                'time': keyframe[0], 'columns': keyframe[3], 'lines': keyframe[4], 'screen': keyframe[5]
+            } if keyframe else None,
+            'events': result,
+        }
+
+    def clip(self, start, end=None):
+        """
+        截取 [start, end] 时间段为一段独立的 asciicast, 普通播放器打开即可从 start 开始播放:
+        文件头 + 关键帧画面 + 关键帧到 start 之间的事件(时间记为 0, 瞬间重放) + 之后的事件(时间从 0 开始)
+        时间段超过 MAX_DURATION 时截断到 start + MAX_DURATION
+        :return: asciicast 文本
+        """
+        end = min(end if end is not None else start + SEEK_DURATION, start + MAX_DURATION)
+        result = self.seek(start, max(end - start, 0))
+        header = dict(result['header'])
+        keyframe = result['keyframe']
+        lines = []
+        if keyframe:
+            header['width'], header['height'] = keyframe['columns'], keyframe['lines']
+            lines.append([0, 'o', keyframe['screen']])
+        for event in result['events']:
+            lines.append([round(max(event[0] - start, 0), 6)] + list(event[1:]))
+        header['duration'] = round(max(end - start, 0), 6)
+        return ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in [header] + lines)
+
+
+chunk_cache = ChunkCache()
+playback_meta = LRUCache(max_items=META_CACHE_SIZE)
@@ -0,0 +1,220 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+from rzx_jms.base import ONLINE_CONNECTION_COUNT
+
+logger = logging.getLogger('service')
+
+# 心跳间隔(秒)
+HEARTBEAT_INTERVAL = getattr(settings, 'TERMINAL_HEARTBEAT_INTERVAL', 10)
+# 超过该时间(秒)没有心跳的会话视为已失效(所在进程已崩溃)
+SESSION_TTL = getattr(settings, 'TERMINAL_SESSION_TTL', HEARTBEAT_INTERVAL * 3)
+# 每个用户同时在线的会话数上限, 0 表示不限
+MAX_SESSIONS_PER_USER = getattr(settings, 'TERMINAL_MAX_SESSIONS_PER_USER', 0)
+# 每个资产同时在线的会话数上限, 0 表示不限
+MAX_SESSIONS_PER_ASSET = getattr(settings, 'TERMINAL_MAX_SESSIONS_PER_ASSET', 0)
+# 当前进程的节点标识
+NODE_NAME = '{}:{}'.format(getattr(settings, 'TERMINAL_NODE_NAME', socket.gethostname()), os.getpid())
+
+# 会话详情 hash
+SESSION_KEY = 'terminal:session:{}'
+# 在线会话 zset, score 为最近一次心跳时间
+SESSIONS_KEY = 'terminal:sessions'
+USER_SESSIONS_KEY = 'terminal:sessions:user:{}'
+ASSET_SESSIONS_KEY = 'terminal:sessions:asset:{}'
+NODE_SESSIONS_KEY = 'terminal:sessions:node:{}'
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class SessionRegistry(object):
+    """
+    集群范围的在线会话登记表
+    每个会话在 redis 中有一条带过期时间的详情 hash, 并按心跳时间登记到全局、用户、资产、节点四个 zset;
+    每个进程的心跳线程定时用一个 pipeline 刷新本进程所有会话的心跳和流量, 并清理超时的条目,
+    进程崩溃时它的会话最多 SESSION_TTL 秒后自动消失, 不会像计数器一样越积越多
+    ONLINE_CONNECTION_COUNT 仍然保留, 改为由登记表同步, 原有的读取方不受影响
+
+    会话对象需要有 token, user, asset, account, protocol, start_time, bytes_in, bytes_out 属性
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.stop = True
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        检查心跳线程是否启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        t = threading.Thread(target=self.run, name='terminal-session-registry', daemon=True)
+        t.start()
+
+    @staticmethod
+    def _index_keys(user_id, asset_id):
+        return (
+            SESSIONS_KEY,
+            USER_SESSIONS_KEY.format(user_id),
+            ASSET_SESSIONS_KEY.format(asset_id),
+            NODE_SESSIONS_KEY.format(NODE_NAME),
+        )
+
+    def _write(self, pipe, session, now):
+        key = SESSION_KEY.format(session.token)
+        pipe.hset(key, mapping={'bytes_in': session.bytes_in, 'bytes_out': session.bytes_out, 'heartbeat': now})
+        pipe.expire(key, SESSION_TTL)
+        for index_key in self._index_keys(session.user.id, session.asset.id):
+            pipe.zadd(index_key, {session.token: now})
+            pipe.expire(index_key, SESSION_TTL)
+
+    def _sync_count(self, pipe, now):
+        # 清理超时的条目后, 在线数就是 zset 的大小
+        pipe.zremrangebyscore(SESSIONS_KEY, 0, now - SESSION_TTL)
+        pipe.zcard(SESSIONS_KEY)
+
+    def register(self, session):
+        now = time.time()
+        pipe = default_redis.pipeline(transaction=False)
+        pipe.hset(SESSION_KEY.format(session.token), mapping={
+            'token': session.token,
+            'user_id': session.user.id,
+            'username': session.user.username,
+            'asset_id': session.asset.id,
+            'hostname': session.asset.hostname,
+            'ip': session.asset.ip,
+            'account': session.account.username,
+            'protocol': session.protocol,
+            'node': NODE_NAME,
+            'start_time': session.start_time,
+        })
+        self._write(pipe, session, now)
+        self._sync_count(pipe, now)
+        try:
+            count = pipe.execute()[-1]
+            default_redis.set(ONLINE_CONNECTION_COUNT, count)
+        except:
+            logger.error(traceback.format_exc())
+        with self._lock:
+            self.sessions[session.token] = session
+        self.check()
+
+    def unregister(self, session):
+        with self._lock:
+            if self.sessions.pop(session.token, None) is None:
+                return
+        now = time.time()
+        pipe = default_redis.pipeline(transaction=False)
+        pipe.delete(SESSION_KEY.format(session.token))
+        for index_key in self._index_keys(session.user.id, session.asset.id):
+            pipe.zrem(index_key, session.token)
+        self._sync_count(pipe, now)
+        try:
+            count = pipe.execute()[-1]
+            default_redis.set(ONLINE_CONNECTION_COUNT, count)
+        except:
+            logger.error(traceback.format_exc())
+
+    def heartbeat(self):
+        now = time.time()
+        with self._lock:
+            sessions = list(self.sessions.values())
+        pipe = default_redis.pipeline(transaction=False)
+        for session in sessions:
+            self._write(pipe, session, now)
+        self._sync_count(pipe, now)
+        count = pipe.execute()[-1]
+        default_redis.set(ONLINE_CONNECTION_COUNT, count)
+
+    def run(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.heartbeat()
+            except:
+                logger.error(traceback.format_exc())
+
+    def count(self, user_id=None, asset_id=None, node=None):
+        """
+        在线会话数, 不扫描: 先清理超时条目再取 zset 大小
+        """
+        if user_id is not None:
+            key = USER_SESSIONS_KEY.format(user_id)
+        elif asset_id is not None:
+            key = ASSET_SESSIONS_KEY.format(asset_id)
+        elif node is not None:
+            key = NODE_SESSIONS_KEY.format(node)
+        else:
+            key = SESSIONS_KEY
+        pipe = default_redis.pipeline(transaction=False)
+        pipe.zremrangebyscore(key, 0, time.time() - SESSION_TTL)
+        pipe.zcard(key)
+        return pipe.execute()[-1]
+
+    def query(self, user_id=None, asset_id=None, node=None, offset=0, limit=100):
+        """
+        在线会话详情, 按最近心跳时间倒序
+        :return: [{'token': ..., 'user_id': ..., ...}, ...]
+        """
+        if user_id is not None:
+            key = USER_SESSIONS_KEY.format(user_id)
+        elif asset_id is not None:
+            key = ASSET_SESSIONS_KEY.format(asset_id)
+        elif node is not None:
+            key = NODE_SESSIONS_KEY.format(node)
+        else:
+            key = SESSIONS_KEY
+        tokens = default_redis.zrevrangebyscore(
+            key, '+inf', time.time() - SESSION_TTL, start=offset, num=limit
+        )
+        if not tokens:
+            return []
+        pipe = default_redis.pipeline(transaction=False)
+        for token in tokens:
+            pipe.hgetall(SESSION_KEY.format(_decode(token)))
+        result = []
+        for info in pipe.execute():
+            if info:
+                result.append({_decode(k): _decode(v) for k, v in info.items()})
+        return result
+
+    def admit(self, user_id, asset_id, token=None):
+        """
+        准入控制
+        :param token: 断线重连的会话, 已登记时不计入在线会话数
+        :return: 拒绝原因, 允许连接时返回 None
+        """
+        if not (MAX_SESSIONS_PER_USER or MAX_SESSIONS_PER_ASSET):
+            return None
+        now = time.time()
+        user_key, asset_key = USER_SESSIONS_KEY.format(user_id), ASSET_SESSIONS_KEY.format(asset_id)
+        pipe = default_redis.pipeline(transaction=False)
+        pipe.zcount(user_key, now - SESSION_TTL, '+inf')
+        pipe.zcount(asset_key, now - SESSION_TTL, '+inf')
+        if token:
+            pipe.zscore(user_key, token)
+            pipe.zscore(asset_key, token)
+        results = pipe.execute()
+        user_count, asset_count = results[:2]
+        if token:
+            user_count -= int(results[2] is not None and results[2] >= now - SESSION_TTL)
+            asset_count -= int(results[3] is not None and results[3] >= now - SESSION_TTL)
+        if MAX_SESSIONS_PER_USER and user_count >= MAX_SESSIONS_PER_USER:
+            return '当前用户在线会话数已达上限({})'.format(MAX_SESSIONS_PER_USER)
+        if MAX_SESSIONS_PER_ASSET and asset_count >= MAX_SESSIONS_PER_ASSET:
+            return '当前资产在线会话数已达上限({})'.format(MAX_SESSIONS_PER_ASSET)
+        return None
+
+
+session_registry = SessionRegistry()
@@ -1,6 +1,7 @@
 import json
 import os
 import logging
+import traceback
 
 from channels.generic.websocket import WebsocketConsumer
 from django.shortcuts import get_object_or_404
@@ -8,8 +9,10 @@ from django.shortcuts import get_object_or_404
 from apps.assets.models import Asset
 from apps.common.consts import WsCode, FileOperationCode
 from apps.utils.sftp_client import SFTPClient
+from apps.utils.sftp_download import FINISHED
+from apps.utils.sftp_upload import CLIENT_WINDOW
 from apps.utils.ws_data_format import WsDataFormat
-from apps.terminal.tasks import audit_file_record
+from apps.terminal.audit_bus import audit_bus
 from rzx_jms import settings
 
 logger = logging.getLogger('service')
@@ -24,6 +27,7 @@ class FileManageWs(WebsocketConsumer):
         self.paramiko_client = None
         self.remote_server_fd = None
         self.is_download = None
+        self.download = None
 
     def connect(self):
         self.user = self.scope["user"]
@@ -72,9 +76,14 @@ class FileManageWs(WebsocketConsumer):
             if operation_type == FileOperationCode.FINISH.value:
                 if self.remote_server_fd:
                     logger.info('file upload finish!')
-                    self.remote_server_fd.close()
+                    try:
+                        file_size = self.remote_server_fd.finish()
+                    except:
+                        logger.error(traceback.format_exc())
+                        self.upload_failed(notify=self.remote_server_fd.error is None)
+                        return
                     self.remote_server_fd = None
-                    audit_file_record.delay(
+                    audit_bus.file_operate(
                         name=self.paramiko_client.conn_tag,
                         origin_path=self.paramiko_client.current_path,
                         target_path=self.target_path,
@@ -83,7 +92,7 @@ class FileManageWs(WebsocketConsumer):
                         operator_id=self.account.id,
                         asset_id=self.asset.id,
                         user_id=self.user.id,
-                        file_size=0
+                        file_size=file_size
                     )
                     msg = {"code": WsCode.SUCCESS.value, "message": self.paramiko_client.list_dir()}
                     self.send(text_data=json.dumps(msg))
@@ -136,7 +145,7 @@ class FileManageWs(WebsocketConsumer):
                         res = self.paramiko_client.list_dir()
                         msg = {"code": WsCode.SUCCESS.value, "message": json.dumps(res)}
                         self.send(text_data=json.dumps(msg))
-                        audit_file_record.delay(
+                        audit_bus.file_operate(
                             name=self.paramiko_client.conn_tag,
                             origin_path=self.paramiko_client.current_path,
                             target_path="",
@@ -164,7 +173,7 @@ class FileManageWs(WebsocketConsumer):
                     res = self.paramiko_client.list_dir()
                     msg = {"code": WsCode.SUCCESS.value, "message": json.dumps(res)}
                     self.send(text_data=json.dumps(msg))
-                    audit_file_record.delay(
+                    audit_bus.file_operate(
                         name=self.paramiko_client.conn_tag,
                         origin_path=self.paramiko_client.current_path,
                         target_path="",
@@ -213,6 +222,8 @@ class FileManageWs(WebsocketConsumer):
                         "origin_path": "原路径"
                     }
                     文件上传完成之后再让客户端发一个空包，不含data数据
+                    返回的 window 为流控窗口: 已发送未收到 ack 的数据不超过 window 字节,
+                    每写入完成一批数据帧回复 {"message": "ack", "seq": 最后写入的帧序号(从 1 开始), "size": 已写入字节数}
                 """
                 origin_path = text_data['params'].get('origin_path')
                 filename = text_data['params'].get('filename')
@@ -235,11 +246,13 @@ class FileManageWs(WebsocketConsumer):
                     except (IOError, FileNotFoundError):
                         print('success')
                         pass
-                    self.remote_server_fd = self.paramiko_client.sftp.file(file_path, 'ab')
+                    self.remote_server_fd = self.paramiko_client.upload_open(
+                        file_path, on_ack=self.upload_ack, on_error=self.upload_error
+                    )
                 self.is_download = False
                 self.target_path = origin_path
                 self.filename = filename
-                msg = {"code": WsCode.SUCCESS.value, "message": "success"}
+                msg = {"code": WsCode.SUCCESS.value, "message": "success", "window": CLIENT_WINDOW}
                 self.send(
                     text_data=json.dumps(msg)
                 )
@@ -247,28 +260,43 @@ class FileManageWs(WebsocketConsumer):
             elif operation_type == FileOperationCode.DOWNLOAD.value:
                 """
                     params = {
-                        "filename": "文件名"
+                        "filename": "文件名",
+                        "window": 接收窗口(字节, 可选), 不带时使用服务端的默认窗口, 客户端需回复 {"ack": 已接收的字节数},
+                        "ack": 已接收的字节数,
+                        "cancel": 取消下载
                     }
                     文件读取完成之后再给客户端发一个空包，不含data数据、标识文件下载结束
+                    下载在后台进行, 期间可以继续浏览目录; 定时发送进度
+                    {"message": "progress", "status": running|finished|cancelled|failed, "size", "total", "rate", "window"}
+                    开始发送数据前先发送一次进度, 其中的 window 为实际使用的接收窗口
                 """
-                filename = text_data['params'].get('filename')
-                file_size = self.paramiko_client.file_download(filename)
-                if not file_size:
+                params = text_data['params']
+                try:
+                    ack = int(params['ack']) if params.get('ack') is not None else None
+                    window = int(params.get('window') or 0)
+                except (TypeError, ValueError):
+                    msg = {"code": WsCode.ERROR.value, "message": "下载参数不正确"}
+                    self.send(text_data=json.dumps(msg))
+                    return
+                if ack is not None or params.get('cancel'):
+                    if self.download:
+                        if params.get('cancel'):
+                            self.download.cancel()
+                        else:
+                            self.download.ack(ack)
+                    return
+                if self.download and self.download.running:
+                    msg = {"code": WsCode.ERROR.value, "message": '已有文件正在下载'}
+                    self.send(text_data=json.dumps(msg))
+                    return
+                filename = params.get('filename')
+                self.download = self.paramiko_client.file_download(
+                    filename, window=window, on_done=self.download_done
+                )
+                if not self.download:
                     msg = {"code": WsCode.ERROR.value, "message": '下载失败'}
                     self.send(text_data=json.dumps(msg))
                     return
-                else:
-                    audit_file_record.delay(
-                        name=self.paramiko_client.conn_tag,
-                        origin_path=self.paramiko_client.current_path,
-                        target_path="",
-                        filename=filename,
-                        operate_type=FileOperationCode.DOWNLOAD.value,
-                        operator_id=self.account.id,
-                        asset_id=self.asset.id,
-                        user_id=self.user.id,
-                        file_size=file_size
-                    )
             else:
                 msg = {"code": WsCode.ERROR.value, "message": "暂不支持的文件操作！"}
                 self.send(text_data=json.dumps(msg))
@@ -282,7 +310,12 @@ class FileManageWs(WebsocketConsumer):
             if self.is_download is True:
                 pass
             elif self.is_download is False:
-                self.paramiko_client.file_upload(self.remote_server_fd, bytes_data)
+                try:
+                    self.paramiko_client.file_upload(self.remote_server_fd, bytes_data)
+                except:
+                    logger.error(traceback.format_exc())
+                    # 写入线程失败时已经通知过浏览器
+                    self.upload_failed(notify=self.remote_server_fd.error is None)
 
             # try:
             #     code, header, data = WsDataFormat.unpack(bytes_data)
@@ -330,7 +363,7 @@ class FileManageWs(WebsocketConsumer):
             #             self.paramiko_client.rm(False, filename)
             #             return
             #         else:
-            #             audit_file_record.delay(
+            #             audit_bus.file_operate(
             #                 name=self.paramiko_client.conn_tag,
             #                 origin_path=self.paramiko_client.current_path,
             #                 target_path=origin_path,
@@ -364,7 +397,7 @@ class FileManageWs(WebsocketConsumer):
             #         )
             #         return
             #     else:
-            #         audit_file_record.delay(
+            #         audit_bus.file_operate(
             #             name=self.paramiko_client.conn_tag,
             #             origin_path=self.paramiko_client.current_path,
             #             target_path="",
@@ -382,6 +415,47 @@ class FileManageWs(WebsocketConsumer):
             #     )
             #     return
 
+    def upload_ack(self, seq, size):
+        self.send(text_data=json.dumps({"code": WsCode.SUCCESS.value, "message": "ack", "seq": seq, "size": size}))
+
+    def upload_error(self, upload):
+        """
+        写入线程中写入失败, 通知浏览器停止发送, 之后收到的数据帧或结束消息时再放弃本次上传
+        """
+        self.send(text_data=json.dumps({"code": WsCode.ERROR.value, "message": "文件上传失败！"}))
+
+    def upload_failed(self, notify=True):
+        """
+        写入失败(磁盘已满、无权限、连接断开), 放弃本次上传
+        """
+        self.remote_server_fd.close()
+        self.remote_server_fd = None
+        if notify:
+            self.send(text_data=json.dumps({"code": WsCode.ERROR.value, "message": "文件上传失败！"}))
+
+    def download_done(self, download):
+        """
+        下载结束(在下载线程中执行), 取消的下载按已发送的字节数记录
+        """
+        if not download.sent and download.status != FINISHED:
+            return
+        audit_bus.file_operate(
+            name=self.paramiko_client.conn_tag,
+            origin_path=os.path.dirname(download.path),
+            target_path="",
+            filename=os.path.basename(download.path),
+            operate_type=FileOperationCode.DOWNLOAD.value,
+            operator_id=self.account.id,
+            asset_id=self.asset.id,
+            user_id=self.user.id,
+            file_size=download.sent
+        )
+
     def disconnect(self, code):
+        if self.download:
+            self.download.cancel()
         if self.remote_server_fd:
             self.remote_server_fd.close()
+        if self.paramiko_client:
+            # 归还共享的 ssh 连接
+            self.paramiko_client.close()
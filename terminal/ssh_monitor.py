@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import threading
+import traceback
+
+from channels.layers import get_channel_layer
+
+from apps.common.consts import WsCode
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 观察者所在的 channel layer 组
+MONITOR_GROUP = 'terminal-monitor-{}'
+# 会话所在进程的 MonitorHub channel, 观察者通过它请求加入
+MONITOR_HUB_KEY = 'terminal:monitor:hub:{}'
+# 待发布帧的上限, 超过后丢弃, 不阻塞会话输出
+MONITOR_QUEUE_SIZE = getattr(settings, 'TERMINAL_MONITOR_QUEUE_SIZE', 10000)
+
+
+def monitor_group(token):
+    return MONITOR_GROUP.format(token)
+
+
+class MonitorHub(object):
+    """
+    每个进程一个: 在独立线程的事件循环中
+    1. 把会话输出发布到 channel layer 组, 每帧只编码、发送一次, 由 channel layer 分发给所有观察者;
+    2. 接收观察者的加入/离开请求, 给新加入的观察者发送最近输出的快照
+    会话的轮询线程只是把帧放入队列, 观察者数量不影响会话本身的输出延迟
+    """
+    def __init__(self):
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        self.loop = None
+        self.stop = True
+        self.dropped = 0
+        self.pending = 0  # 已入队未发布的帧数, 由会话的轮询线程和事件循环线程共同修改, 用 _pending_lock 保护
+        self._queue = None
+        self._pending_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.channel_layer is not None
+
+    def check(self):
+        """
+        检查事件循环线程是否启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        t = threading.Thread(target=self.run, name='terminal-monitor', daemon=True)
+        t.start()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # 队列创建后再公开 loop, _put 看到 loop 时队列一定已就绪
+        self._queue = asyncio.Queue()
+        self.loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            self.stop = True
+
+    async def _main(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        self._ready.set()
+        await asyncio.gather(self._publish_loop(), self._receive_loop())
+
+    def register(self, session):
+        """
+        会话建立时登记所在进程的 hub channel
+        """
+        if not self.enabled:
+            return
+        self.check()
+        if not self._ready.wait(timeout=5):
+            logger.error('terminal monitor hub is not ready')
+            return
+        default_redis.set(MONITOR_HUB_KEY.format(session.token), self.channel_name)
+
+    def unregister(self, session):
+        if not self.enabled or not self._ready.is_set():
+            return
+        default_redis.delete(MONITOR_HUB_KEY.format(session.token))
+        if session.observing:
+            self._put(monitor_group(session.token), {'type': 'terminal.close'})
+
+    def publish(self, token, text):
+        """
+        在会话的轮询线程中调用, 只入队不等待发送
+        :param token: 会话标识
+        :param text: 已编码好的终端输出帧
+        """
+        self._put(monitor_group(token), {'type': 'terminal.output', 'text': text})
+
+    def _put(self, group, message):
+        loop = self.loop
+        if loop is None:
+            return
+        with self._pending_lock:
+            if self.pending >= MONITOR_QUEUE_SIZE:
+                self.dropped += 1
+                return
+            self.pending += 1
+        loop.call_soon_threadsafe(self._queue.put_nowait, (group, message))
+
+    async def _publish_loop(self):
+        while True:
+            group, message = await self._queue.get()
+            with self._pending_lock:
+                self.pending -= 1
+            try:
+                await self.channel_layer.group_send(group, message)
+            except:
+                logger.error(traceback.format_exc())
+
+    async def _receive_loop(self):
+        while True:
+            try:
+                message = await self.channel_layer.receive(self.channel_name)
+                await self._handle(message)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.error(traceback.format_exc())
+
+    async def _handle(self, message):
+        # 避免循环引用, 使用时再导入
+        from apps.terminal.ssh_session import session_manager
+
+        session = session_manager.get(message.get('token'))
+        reply_channel = message.get('reply_channel')
+        if message['type'] == 'monitor.join':
+            if session is None:
+                await self.channel_layer.send(reply_channel, {'type': 'terminal.close'})
+                return
+            snapshot = session.add_observer().decode('utf-8', 'replace')
+            if snapshot:
+                text = json.dumps({'code': WsCode.TEXT.value, 'message': snapshot}, ensure_ascii=False)
+                await self.channel_layer.send(reply_channel, {'type': 'terminal.output', 'text': text})
+        elif message['type'] == 'monitor.leave':
+            if session is not None:
+                session.remove_observer()
+
+
+monitor_hub = MonitorHub()
@@ -0,0 +1,328 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 轮询线程数(分片), 每个分片一个线程负责多路复用多个 ssh channel
+POLLER_SHARDS = getattr(settings, 'TERMINAL_POLLER_SHARDS', 4)
+# select 最长等待时间(秒)
+SELECT_TIMEOUT = 1
+
+
+class SSHPoller(object):
+    """
+    一个轮询线程: 用 selector 同时监听多个 paramiko channel, 可读时回调 reader.on_read(), 出错时回调 reader.abort()
+    另外提供定时器(call_later), 供输出合并、空闲断开等延时任务使用
+    """
+    def __init__(self, name):
+        self.name = name
+        self.poller = selectors.DefaultSelector()
+        self.readers = set()
+        self.stop = True
+        self._thread = None
+        self._lock = threading.Lock()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        # 其它线程注册 channel 或定时器时唤醒 select
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.poller.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def __len__(self):
+        return len(self.readers)
+
+    def add_reader(self, reader):
+        with self._lock:
+            self.readers.add(reader)
+            self.poller.register(reader.channel, selectors.EVENT_READ, reader)
+        self.check()
+        self.wakeup()
+
+    def del_reader(self, reader):
+        with self._lock:
+            if reader not in self.readers:
+                return
+            self.readers.discard(reader)
+            try:
+                self.poller.unregister(reader.channel)
+            except (KeyError, ValueError, OSError):
+                # channel 已关闭, fileno 已失效
+                pass
+
+    def call_later(self, delay, func, *args):
+        """
+        delay 秒后在轮询线程中执行 func(*args)
+        :return: 定时器句柄, 可用于 cancel_timer
+        """
+        timer = [time.time() + delay, next(self._timer_seq), func, args, False]
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+        self.wakeup()
+        return timer
+
+    @staticmethod
+    def cancel_timer(timer):
+        if timer:
+            timer[4] = True
+
+    def in_thread(self):
+        """
+        :return: 当前是否在本轮询线程中
+        """
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, func, *args):
+        """
+        在轮询线程中尽快执行 func(*args), 不等待; 已在轮询线程中时直接执行
+        """
+        if self.stop or self.in_thread():
+            func(*args)
+        else:
+            self.call_later(0, func, *args)
+
+    def run_sync(self, func, *args, timeout=10):
+        """
+        在轮询线程中执行 func(*args) 并等待执行完成, 其它线程修改只属于轮询线程的状态时使用
+        已在轮询线程中或轮询线程未启动时直接执行
+        :return: func 的返回值, 超时或出错时为 None
+        """
+        if self.stop or self.in_thread():
+            return func(*args)
+        done = threading.Event()
+        result = []
+
+        def call():
+            try:
+                result.append(func(*args))
+            finally:
+                done.set()
+        self.call_later(0, call)
+        if not done.wait(timeout):
+            logger.error('ssh 轮询线程 {} 执行 {} 超时'.format(self.name, func))
+        return result[0] if result else None
+
+    def wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            # 缓冲区已满说明已经有待处理的唤醒
+            pass
+
+    def check(self):
+        """
+        检查轮询线程是否已启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        t = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread = t
+        t.start()
+
+    def _next_timeout(self):
+        with self._lock:
+            while self._timers and self._timers[0][4]:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return SELECT_TIMEOUT
+            return min(max(self._timers[0][0] - time.time(), 0), SELECT_TIMEOUT)
+
+    def _run_timers(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)
+                if not timer[4]:
+                    due.append(timer)
+        for timer in due:
+            try:
+                timer[2](*timer[3])
+            except:
+                logger.error(traceback.format_exc())
+
+    def select(self):
+        events = self.poller.select(timeout=self._next_timeout())
+        for key, event in events:
+            reader = key.data
+            if reader is None:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
+                continue
+            try:
+                reader.on_read()
+            except:
+                logger.error(traceback.format_exc())
+                try:
+                    reader.abort()
+                except:
+                    logger.error(traceback.format_exc())
+        self._run_timers()
+
+    def run(self):
+        logger.info('启动 ssh 轮询线程 {}...'.format(self.name))
+        while True:
+            try:
+                self.select()
+            except:
+                logger.error(traceback.format_exc())
+
+
+class SSHPollerGroup(object):
+    """
+    多个轮询线程分片, 新会话分配给当前连接数最少的分片
+    """
+    def __init__(self, shards=POLLER_SHARDS):
+        self.shards = [SSHPoller('ssh-poller-{}'.format(i)) for i in range(max(int(shards), 1))]
+
+    def register(self, reader):
+        shard = min(self.shards, key=len)
+        reader.poller = shard
+        shard.add_reader(reader)
+        return shard
+
+    def unregister(self, reader):
+        if reader.poller:
+            reader.poller.del_reader(reader)
+
+    def count(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+ssh_pollers = SSHPollerGroup()
+
+
+if __name__ == "__main__":
+    # 5000 个会话(socketpair 代替 ssh channel), 其中 500 个每 50ms 输出一帧:
+    # 分片轮询 vs 每个会话一个读线程, 比较输出延迟和 CPU 占用
+    # 延迟包含发送: 帧编码为 json 后经事件循环发出(与 channels 从其它线程调用 websocket send 相同, 等待事件循环执行完成)
+    import asyncio
+    import json
+    import resource
+    import struct
+
+    SESSIONS = 5000
+    ACTIVE = 500
+    INTERVAL = 0.05
+    DURATION = 5
+    FRAME = 64
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 2 * SESSIONS + 256:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(2 * SESSIONS + 256, hard), hard))
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='websocket-loop', daemon=True).start()
+
+    class BenchReader(object):
+        def __init__(self, channel, latencies):
+            self.channel = channel
+            self.latencies = latencies
+            self.pending = b''
+            self.poller = None
+
+        def on_read(self):
+            data = self.channel.recv(65536)
+            if not data:
+                self.abort()
+                return
+            self.receive(data)
+
+        def receive(self, data):
+            data = self.pending + data
+            end = len(data) - len(data) % FRAME
+            self.pending = data[end:]
+            if end:
+                sent = [struct.unpack_from('d', data, i)[0] for i in range(0, end, FRAME)]
+                text = json.dumps({'code': 2, 'message': data[:end].hex()})
+                asyncio.run_coroutine_threadsafe(self.send(text, sent), loop).result()
+
+        async def send(self, text, sent):
+            now = time.perf_counter()
+            self.latencies.extend(now - t for t in sent)
+
+        def abort(self):
+            if self.poller:
+                self.poller.del_reader(self)
+
+        def read_forever(self):
+            while True:
+                data = self.channel.recv(65536)
+                if not data:
+                    return
+                self.receive(data)
+
+    def feed(writers):
+        padding = b'\0' * (FRAME - 8)
+        deadline = time.perf_counter() + DURATION
+        tick = time.perf_counter()
+        frames = 0
+        while tick < deadline:
+            for w in writers:
+                w.send(struct.pack('d', time.perf_counter()) + padding)
+            frames += len(writers)
+            tick += INTERVAL
+            time.sleep(max(tick - time.perf_counter(), 0))
+        return frames
+
+    def report(name, threads, frames, latencies, cpu):
+        latencies.sort()
+        print('{:<18} threads={:<5} frames={} delivered={} p50={:.2f}ms p99={:.2f}ms cpu={:.0f}%'.format(
+            name, threads, frames, len(latencies),
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+            cpu / DURATION * 100))
+
+    def make_pairs():
+        return [socket.socketpair() for _ in range(SESSIONS)]
+
+    # 分片轮询
+    pairs = make_pairs()
+    latencies = []
+    group = SSHPollerGroup()
+    readers = []
+    for r, w in pairs:
+        r.setblocking(False)
+        reader = BenchReader(r, latencies)
+        group.register(reader)
+        readers.append(reader)
+    time.sleep(0.5)
+    cpu = time.process_time()
+    frames = feed([w for _, w in pairs[:ACTIVE]])
+    time.sleep(0.5)
+    report('poller', len(group.shards), frames, latencies, time.process_time() - cpu)
+    for reader in readers:
+        group.unregister(reader)
+    for r, w in pairs:
+        r.close()
+        w.close()
+
+    # 每个会话一个读线程
+    pairs = make_pairs()
+    latencies = []
+    threading.stack_size(256 * 1024)
+    threads = []
+    for r, w in pairs:
+        t = threading.Thread(target=BenchReader(r, latencies).read_forever, daemon=True)
+        t.start()
+        threads.append(t)
+    time.sleep(0.5)
+    cpu = time.process_time()
+    frames = feed([w for _, w in pairs[:ACTIVE]])
+    time.sleep(0.5)
+    report('thread per session', len(threads), frames, latencies, time.process_time() - cpu)
+    for r, w in pairs:
+        w.close()
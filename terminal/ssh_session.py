@@ -0,0 +1,639 @@
+import codecs
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import traceback
+
+from apps.common.consts import WsCode
+from apps.utils.command_matcher import black_command_matcher
+from apps.utils.flood_control import FloodControl
+from apps.utils.line_editor import LineEditor, CTRL_C
+from apps.utils.output_coalescer import OutputCoalescer
+from apps.utils.recording_writer import recording_writer, RECORD_FORMAT
+from apps.utils.ring_buffer import RingBuffer
+from apps.utils.ssh_client import SSHClient
+from apps.utils.ws_data_format import WsDataFormat
+from apps.terminal.command_policy import command_policy_manager
+from apps.terminal.ssh_monitor import monitor_hub
+from apps.terminal.session_registry import session_registry
+from apps.terminal.ssh_poller import ssh_pollers
+from apps.terminal.command_audit import command_audit
+from apps.terminal.audit_bus import audit_bus
+from apps.terminal.tasks import video_record_upload
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 每次从 channel 读取的最大字节数
+RECV_SIZE = getattr(settings, 'TERMINAL_RECV_SIZE', 32 * 1024)
+# 服务器无输出超过该时间(秒)就断开连接
+IDLE_TIMEOUT = getattr(settings, 'TERMINAL_IDLE_TIMEOUT', 60 * 10)
+# websocket 断开后 ssh 会话保留的时间(秒), 期间可凭 session_token 重新连接, 0 表示不保留
+DETACH_GRACE = getattr(settings, 'TERMINAL_DETACH_GRACE', 60)
+# 每个会话保留的最近输出字节数, 重新连接时回放
+SCROLLBACK_BYTES = getattr(settings, 'TERMINAL_SCROLLBACK_BYTES', 256 * 1024)
+# 高危命令处理方式: log 只记录, block 记录并拦截(不发送回车, 改为 ctrl+c 取消当前行)
+BLACK_COMMAND_MODE = getattr(settings, 'BLACK_COMMAND_MODE', 'log')
+# 每个会话随录像一起提交全文索引的命令条数上限
+INDEX_COMMANDS = getattr(settings, 'TERMINAL_FTS_MAX_COMMANDS', 5000)
+LINE_END = re.compile(r'[\r\n]')
+# 终端大小变化的防抖: 最后一次请求后等待 RESIZE_DEBOUNCE 秒再生效, 持续拖动时最迟 RESIZE_MAX_DELAY 秒生效一次
+RESIZE_DEBOUNCE = getattr(settings, 'TERMINAL_RESIZE_DEBOUNCE', 0.2)
+RESIZE_MAX_DELAY = getattr(settings, 'TERMINAL_RESIZE_MAX_DELAY', 1)
+# 终端大小上限
+MAX_COLS, MAX_ROWS = 1000, 500
+# 会话结束时的阻塞操作(redis、关闭 ssh 连接等)在单独的线程中执行, 不占用轮询线程
+TEARDOWN_WORKERS = getattr(settings, 'TERMINAL_TEARDOWN_WORKERS', 4)
+teardown_executor = ThreadPoolExecutor(TEARDOWN_WORKERS, thread_name_prefix='terminal-teardown')
+
+
+class WsReader(object):
+    """
+    读取ssh服务器返回的数据
+    不再单独开线程阻塞在 recv 上, 而是注册到 ssh_pollers, 由轮询线程在 channel 可读时回调 on_read
+    读取状态(合并缓冲、解码器、命令行、stdout)只在轮询线程中修改, 其它线程通过 run_sync/call_soon 交给轮询线程
+    """
+    def __init__(self, session, *args, **kwargs):
+        self.session = session
+        self.channel = None
+        self.poller = None
+        self.closed = False
+        self.start_time = time.time()
+        self.last_active = self.start_time
+        self.stdout = []
+        self.coalescer = OutputCoalescer()
+        # 增量解码, 多字节字符被切断时保留剩余字节等待下一块数据
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.flood = FloodControl()
+        self._idle_timer = None
+        self._flush_timer = None
+        self._flood_timer = None
+
+    def start(self):
+        self.channel = self.session.ssh.ssh_channel
+        ssh_pollers.register(self)
+        self._idle_timer = self.poller.call_later(IDLE_TIMEOUT, self.check_idle)
+
+    def in_poller(self):
+        return self.poller is not None and self.poller.in_thread()
+
+    def run_sync(self, func, *args):
+        """
+        在轮询线程中执行 func(*args) 并等待完成, 还没有注册到轮询线程时直接执行
+        """
+        if self.poller is None:
+            return func(*args)
+        return self.poller.run_sync(func, *args)
+
+    def call_soon(self, func, *args):
+        if self.poller is None:
+            func(*args)
+        else:
+            self.poller.call_soon(func, *args)
+
+    def stop(self):
+        """
+        停止读取, 在轮询线程中调用
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.poller:
+            self.poller.cancel_timer(self._idle_timer)
+            self.poller.cancel_timer(self._flood_timer)
+            ssh_pollers.unregister(self)
+            # 未发送的数据只写入录像
+            self.flush(send=False)
+            if self.flood.active:
+                self.emit(self.flood.render(), time.time(), send=False)
+            logger.info('ssh output coalesce {}: {}'.format(self.session.conn_tag, self.coalescer.as_dict()))
+
+    def on_read(self):
+        # 服务器返回的数据, channel 里已有的数据一次读完(不超过单帧上限)
+        while True:
+            data = self.channel.recv(RECV_SIZE)
+            if not data:
+                # 服务器关闭了 channel
+                self.flush()
+                self.stop()
+                self.session.close()
+                return
+            self.last_active = time.time()
+            self.session.bytes_out += len(data)
+            self.handle_output(data)
+            if self.coalescer.full or not self.channel.recv_ready():
+                break
+        if self.coalescer.full:
+            self.flush()
+
+    def abort(self):
+        """
+        读取出错: 停止读取并关闭会话
+        """
+        self.stop()
+        self.session.close()
+
+    def is_echo(self, data):
+        # 回显的命令不再发给前端, 只有长度不超过上一次输入的数据才需要解码比较
+        last_input = self.session.last_input
+        if not last_input or len(data) > len(last_input) * 4 + 4:
+            return False
+        return data.strip().decode('utf-8', 'ignore') + '\n' in last_input
+
+    def handle_output(self, data):
+        if self.is_echo(data):
+            return
+        # 合并原始字节到当前帧, 第一块数据到达时开始计时, 超过合并窗口再发给前端
+        if self.coalescer.append(data):
+            self._flush_timer = self.poller.call_later(self.coalescer.latency, self.flush)
+
+    def flush(self, send=True):
+        """
+        发送合并后的一帧, 并记录服务器的输出
+        二进制模式直接发送原始字节, 文本(json)模式和录像使用增量解码后的文本,
+        被切断在两帧之间的多字节字符会留到下一帧一起解码
+        :param send: 连接已断开时只记录不发送
+        """
+        self.poller.cancel_timer(self._flush_timer)
+        self._flush_timer = None
+        frame_time = self.coalescer.first_time
+        data = self.coalescer.pop()
+        if data is None:
+            return
+        str_data = self.decoder.decode(data)
+        # tab 补全、翻历史的回显同步到当前命令行
+        self.session.editor.feed_output(str_data)
+        flood = self.flood
+        if flood.check(len(data)) and not self.closed:
+            # 输出太快, 改为按固定帧率发送屏幕变化
+            flood.start(self.session.scrollback.snapshot())
+            self._flood_timer = self.poller.call_later(flood.interval, self.flood_tick)
+            logger.info('ssh output flood {}: {:.0f} B/s'.format(self.session.conn_tag, flood.meter.rate()))
+        if flood.active:
+            flood.feed(str_data)
+            return
+        self.emit(str_data, frame_time, send, data)
+
+    def emit(self, str_data, frame_time, send=True, data=None):
+        """
+        保存到回放缓冲区, 发给前端, 并记录服务器的输出
+        """
+        if data is None:
+            data = str_data.encode('utf-8')
+        self.session.scrollback.append(data)
+        if send and not self.closed:
+            self.session.send_output(data, str_data)
+        if not str_data:
+            return
+        # 记录服务器的输出
+        self.stdout.append([frame_time - self.start_time, 'o', str_data])
+        # 超过50次，就写文件，防止占内存太大
+        if len(self.stdout) >= 50:
+            self.session.record(self.stdout)
+            self.stdout = []
+
+    def stdout_append(self, event):
+        """
+        录像中追加一个事件, 在轮询线程中调用
+        """
+        self.stdout.append(event)
+
+    def flood_tick(self):
+        """
+        刷屏模式下按固定帧率发送屏幕变化, 速率回落后恢复原样转发
+        """
+        self._flood_timer = None
+        flood = self.flood
+        if self.closed or not flood.active:
+            return
+        exiting = flood.should_exit()
+        text = flood.render()
+        if text:
+            self.emit(text, time.time())
+        if exiting:
+            flood.exit()
+            logger.info('ssh output flood end {}: suppressed {} bytes'.format(self.session.conn_tag, flood.suppressed))
+        else:
+            self._flood_timer = self.poller.call_later(flood.interval, self.flood_tick)
+
+    def check_idle(self):
+        if self.closed:
+            return
+        idle = time.time() - self.last_active
+        if idle < IDLE_TIMEOUT:
+            self._idle_timer = self.poller.call_later(IDLE_TIMEOUT - idle, self.check_idle)
+            return
+        self.flush()
+        self.session.send(
+            text_data=json.dumps({"code": WsCode.ERROR.value, 'message': '由于长时间没有操作，连接已断开!'})
+        )
+        self.stdout.append([time.time() - self.start_time, 'o', '\n由于长时间没有操作，连接已断开!'])
+        self.stop()
+        self.session.close()
+
+
+class TerminalSession(object):
+    """
+    一个 ssh 终端会话, 生命周期独立于 websocket 连接:
+    websocket 断开后会话保留 DETACH_GRACE 秒, 输出继续写入录像和 scrollback,
+    期间客户端带上 session_token 重新连接即可接回会话并回放最近的输出
+    """
+    protocol = 'ssh'
+
+    def __init__(self, user, asset, account, cols=80, rows=24):
+        self.token = uuid.uuid4().hex
+        self.user = user
+        self.asset = asset
+        self.account = account
+        self.cols = cols
+        self.rows = rows
+        self._pending_size = None  # 等待生效的终端大小
+        self._pending_since = None
+        self._resize_timer = None
+        self.ws = None  # 当前连接的 TerminalWebsocket, 断开期间为 None
+        self.reader = WsReader(self)
+        self.reader.flood.resize(cols, rows)
+        self.ssh = None
+        self.editor = LineEditor(on_command=self.on_command)  # 根据输入还原命令
+        self.last_input = ''  # 上一次输入, 用于过滤命令回显
+        self.video_save_path = None
+        self.recording = None  # 录像, 由后台写线程写入
+        self.commands = []  # 本次会话的命令, 录像上传后写入全文索引
+        self.record_meta = {'account_id': account.id, 'asset_id': asset.id, 'user_id': user.id}
+        self.conn_tag = None
+        self.scrollback = RingBuffer(SCROLLBACK_BYTES)
+        self.observers = 0  # 只读观察者数量
+        self.bytes_in = 0   # 用户输入字节数
+        self.bytes_out = 0  # 服务器输出字节数
+        self.opened = False
+        self.closed = False
+        self._grace_timer = None
+        self._lock = threading.Lock()
+
+    def get_video_save_path(self):
+        # 每个系统用户一个目录
+        record_path = os.path.join(settings.jms_video_record, self.user.username)
+        if not os.path.exists(record_path):
+            os.makedirs(record_path, exist_ok=True)
+        # 录像文件名
+        record_file_name = '{}.{}.{}'.format(self.asset.ip, time.strftime('%Y%m%d%H%M%S'), RECORD_FORMAT)
+        record_file_path = os.path.join(record_path, record_file_name)
+        return record_file_path
+
+    @property
+    def start_time(self):
+        return self.reader.start_time
+
+    def open(self):
+        """
+        建立 ssh 连接并开始读取输出
+        :return: 是否连接成功
+        """
+        conn_kwargs = {
+            "hostname": self.asset.hostname, "ip": self.asset.ip, 'port': self.asset.port,
+            "username": self.account.username, "password": self.account.password,
+            'websocket': self, 'os': self.asset.os, 'cols': self.cols, 'rows': self.rows
+        }
+        self.video_save_path = self.get_video_save_path()
+        # 录屏文件头由写线程在打开文件时写入
+        self.recording = recording_writer.open(self.video_save_path, self.record_header(), self.record_meta)
+        self.ssh = SSHClient(**conn_kwargs)
+        self.ssh.ssh_connect()
+        if not self.ssh.ssh_channel:
+            return False
+        # 每个ssh连接的标识
+        self.conn_tag = self.ssh.ssh_channel.get_name()
+        self.record_meta['name'] = self.conn_tag
+        self.reader.start()
+        self.opened = True
+        session_manager.add(self)
+        session_registry.register(self)
+        monitor_hub.register(self)
+        return True
+
+    def send(self, text_data=None, bytes_data=None):
+        ws = self.ws
+        if ws:
+            ws.send(text_data=text_data, bytes_data=bytes_data)
+
+    def send_output(self, data, str_data=None, publish=True):
+        """
+        按当前连接协商的格式发送终端输出, 有观察者时同时发布给观察者
+        文本帧只编码一次, 连接和观察者共用
+        :param data: 原始输出
+        :param str_data: 解码后的文本, 不传时按需解码
+        :param publish: 是否发布给观察者
+        """
+        ws = self.ws
+        binary = ws is not None and ws.binary_output
+        if binary:
+            ws.send(bytes_data=WsDataFormat.pack(WsCode.TEXT.value, data=data))
+        publish = publish and self.observing
+        if (ws is None or binary) and not publish:
+            return
+        if str_data is None:
+            str_data = data.decode('utf-8', 'replace')
+        if not str_data:
+            return
+        text = json.dumps({'code': WsCode.TEXT.value, 'message': str_data}, ensure_ascii=False)
+        if ws is not None and not binary:
+            ws.send(text_data=text)
+        if publish:
+            monitor_hub.publish(self.token, text)
+
+    @property
+    def observing(self):
+        with self._lock:
+            return self.observers > 0
+
+    def add_observer(self):
+        """
+        观察者加入, 在 MonitorHub 的事件循环线程中调用
+        :return: 加入时的回放缓冲区快照
+        """
+        with self._lock:
+            self.observers += 1
+        return self.scrollback.snapshot()
+
+    def remove_observer(self):
+        with self._lock:
+            self.observers = max(self.observers - 1, 0)
+
+    def close(self):
+        """
+        关闭会话: 有连接时先关闭 websocket, 由 disconnect 回调结束会话
+        """
+        ws = self.ws
+        if ws:
+            if self.reader.in_poller():
+                teardown_executor.submit(ws.close)
+            else:
+                ws.close()
+        else:
+            self.terminate()
+
+    def attach(self, ws):
+        """
+        websocket 接入会话, 回放 scrollback
+        :return: 会话已结束时返回 False
+        """
+        with self._lock:
+            if self.closed:
+                return False
+        # 在轮询线程中切换连接并回放, 回放与新的输出不会交错或重复
+        attached = self.reader.run_sync(self._attach, ws)
+        if not attached:
+            return False
+        old_ws = attached[1]
+        if old_ws is not None and old_ws is not ws:
+            # 同一会话只保留最新的连接
+            old_ws.close()
+        return True
+
+    def _attach(self, ws):
+        """
+        :return: (True, 原来的连接), 会话已结束时返回 None
+        """
+        with self._lock:
+            if self.closed:
+                return None
+            if self._grace_timer:
+                self.reader.poller.cancel_timer(self._grace_timer)
+                self._grace_timer = None
+            old_ws, self.ws = self.ws, ws
+        scrollback = self.scrollback.snapshot()
+        if scrollback:
+            self.send_output(scrollback, publish=False)
+        return True, old_ws
+
+    def detach(self, ws):
+        """
+        websocket 断开, ssh 通道仍可用时保留会话等待重新连接
+        """
+        with self._lock:
+            if self.ws is not ws:
+                return
+            self.ws = None
+            keep = self.opened and not self.closed and not self.reader.closed and DETACH_GRACE > 0
+            if keep:
+                self._grace_timer = self.reader.poller.call_later(DETACH_GRACE, self.expire)
+        if not keep:
+            self.terminate()
+
+    def expire(self):
+        with self._lock:
+            if self.closed or self.ws is not None:
+                return
+            self.closed = True
+        logger.info('ssh session {} detach timeout'.format(self.conn_tag))
+        self._teardown()
+
+    def terminate(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._teardown()
+
+    def _teardown(self):
+        try:
+            # 在轮询线程中停止读取并写入剩余输出, 之后轮询线程不再修改 stdout
+            self.reader.run_sync(self._stop_reading)
+        finally:
+            if self.reader.in_poller():
+                # 在轮询线程中结束(空闲超时、服务器断开、重连超时)时, 阻塞操作交给其它线程, 不影响同一分片的其它会话
+                teardown_executor.submit(self._release)
+            else:
+                self._release()
+
+    def _stop_reading(self):
+        self.reader.stop()
+        self.record(self.reader.stdout)
+        self.reader.stdout = []
+
+    def _release(self):
+        try:
+            session_manager.remove(self)
+            monitor_hub.unregister(self)
+            if self.ssh:
+                self.ssh.close()
+            if self.opened:
+                session_registry.unregister(self)
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            if self.recording:
+                # 录屏文件写完后再上传
+                self.recording.close(callback=partial(
+                    video_record_upload.delay,
+                    self.conn_tag,
+                    self.video_save_path,
+                    self.account.id,
+                    self.asset.id,
+                    self.user.id,
+                    commands=self.commands
+                ))
+
+    def input(self, text):
+        """
+        用户输入发给服务器, 并同步到命令行
+        每次回车前检查当前行是否命中高危命令, 拦截模式下不发送回车, 改为发送 ctrl+c 取消当前行
+        """
+        self.last_input = text
+        data = []
+        pos = 0
+        for match in LINE_END.finditer(text):
+            head = text[pos:match.start()]
+            self.editor.feed_input(head)
+            pos = match.end()
+            if self.check_command(self.editor.current.strip()):
+                data.append(head + CTRL_C)
+                self.editor.feed_input(CTRL_C)
+            else:
+                data.append(head + match.group())
+                self.editor.feed_input(match.group())
+        data.append(text[pos:])
+        self.editor.feed_input(text[pos:])
+        data = ''.join(data)
+        self.bytes_in += len(data)
+        self.ssh.ssh_channel.send(data)
+
+    def check_command(self, command):
+        """
+        回车发送前检查命令: 先按 (用户, 资产, 账号) 适用的命令策略判定, 策略没有拦截时再检查高危命令规则
+        allow 策略只覆盖优先级更低的策略, 不跳过全局的高危命令规则, 命中时照常记录, 按 BLACK_COMMAND_MODE 拦截
+        :return: 是否拦截
+        """
+        if not command or self.editor.alt_screen:
+            return False
+        verdict = command_policy_manager.verdict(self.user.id, self.asset.id, self.account.id, command)
+        if verdict is not None and verdict.action != 'allow':
+            audit_bus.policy_command(
+                verdict.policy, verdict.action, verdict.rules,
+                self.asset.hostname, self.account.name, self.user.name, command
+            )
+            if verdict.blocked:
+                self.reject_command('命令 "{}" 命中命令策略 "{}", 已禁止执行'.format(command, verdict.policy.name))
+                return True
+        rules = black_command_matcher.match(command)
+        if not rules:
+            return False
+        audit_bus.black_command(
+            rules, self.asset.hostname, self.account.name, self.user.name, command
+        )
+        if BLACK_COMMAND_MODE != 'block':
+            return False
+        self.reject_command('命令 "{}" 命中高危命令规则, 已禁止执行'.format(command))
+        return True
+
+    def reject_command(self, message):
+        self.send(text_data=json.dumps({'code': WsCode.ERROR.value, 'message': message}, ensure_ascii=False))
+        # stdout 只在轮询线程中修改
+        self.reader.call_soon(
+            self.reader.stdout_append, [time.time() - self.reader.start_time, 'o', '\r\n{}\r\n'.format(message)]
+        )
+
+    def on_command(self, command):
+        """
+        一条命令输入完成
+        """
+        connect_time = int(time.time() - self.reader.start_time)
+        if len(self.commands) < INDEX_COMMANDS:
+            self.commands.append(command)
+        # 批量写入命令记录, 时间取命令输入的时间
+        command_audit.add(
+            self.conn_tag, command,
+            self.asset.id, self.account.id, self.user.id, connect_time
+        )
+
+    def resize(self, cols, rows):
+        """
+        客户端窗口大小变化, 防抖合并后再调整 pty
+        """
+        cols = max(1, min(int(cols), MAX_COLS))
+        rows = max(1, min(int(rows), MAX_ROWS))
+        poller = self.reader.poller
+        with self._lock:
+            self._pending_size = (cols, rows)
+            if poller is None:
+                # 还没有连接, 建立 pty 时直接使用
+                self.cols, self.rows = cols, rows
+                self.reader.flood.resize(cols, rows)
+                self._pending_size = None
+                return
+            now = time.time()
+            if self._pending_since is None:
+                self._pending_since = now
+            poller.cancel_timer(self._resize_timer)
+            delay = min(RESIZE_DEBOUNCE, max(self._pending_since + RESIZE_MAX_DELAY - now, 0))
+            self._resize_timer = poller.call_later(delay, self.apply_resize)
+
+    def apply_resize(self):
+        with self._lock:
+            size, self._pending_size = self._pending_size, None
+            self._pending_since = None
+            self._resize_timer = None
+        if size is None or self.closed or self.reader.closed or size == (self.cols, self.rows):
+            return
+        self.cols, self.rows = size
+        try:
+            self.ssh.resize_pty(*size)
+        except:
+            logger.error(traceback.format_exc())
+            return
+        self.reader.flood.resize(*size)
+        # 录像中记录大小变化, 回放时按新的大小渲染
+        self.reader.stdout.append([time.time() - self.reader.start_time, 'r', '{}x{}'.format(*size)])
+
+    def record_header(self):
+        return {
+            "version": 2,
+            "width": self.cols,
+            "height": self.rows,
+            "timestamp": round(self.reader.start_time),
+            "title": "ssh",
+            "env": {
+                "TERM": os.environ.get('TERM'),
+                "SHELL": os.environ.get('SHELL', '/bin/bash')
+            },
+        }
+
+    def record(self, text):
+        """
+        录像事件放入写线程的队列, 不在当前线程编码和写磁盘
+        :param text: asciicast 事件列表
+        """
+        if self.recording and text:
+            self.recording.write(text)
+
+
+class SessionManager(object):
+    """
+    当前进程中的 ssh 会话, 按 session_token 查找
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add(self, session):
+        with self._lock:
+            self._sessions[session.token] = session
+
+    def remove(self, session):
+        with self._lock:
+            self._sessions.pop(session.token, None)
+
+    def get(self, token):
+        return self._sessions.get(token)
+
+
+session_manager = SessionManager()
@@ -1,3 +1,5 @@
+import io
+import json
 import os
 import traceback
 import logging
@@ -5,58 +7,265 @@ from datetime import datetime
 from urllib.parse import urljoin
 
 from celery import shared_task
+from celery.signals import worker_ready
+from django.contrib.auth import get_user_model
 
-from apps.assets.models import BlackCommand
+from apps.assets.models import Asset, BlackCommand
 from apps.audits.serializers.command_log import CommandLogSerializer, BlackCommandLogSerializer
 from apps.audits.serializers.file_serializer import VideoPlaybackSerializer, FileOperateSerializer
-from apps.utils.minio_tool import minio_manager
+from apps.terminal.guacd_recording import RecordingCollector
+from apps.utils.cast_format import CastzReader, CASTZ_SUFFIX, index_path
+from apps.utils.cast_keyframe import KeyframeBuilder, iter_cast, keyframe_path, pyte
+from apps.utils.minio_tool import minio_manager, MinioObjectFile
+from apps.utils.session_index import SessionIndexer, purge as purge_index
+from apps.utils.recording_spool import recording_spool
+from apps.utils.recording_upload import UploadJournal, object_name
 from rzx_jms import settings
 
 
 logger = logging.getLogger('service')
 
+# 录像上传后是否生成关键帧(需要安装 pyte)
+KEYFRAMES = getattr(settings, 'TERMINAL_KEYFRAMES', True)
+# 录像上传后是否写入全文索引
+FULL_TEXT_INDEX = getattr(settings, 'TERMINAL_FULL_TEXT_INDEX', True)
+
 
 @shared_task
-def video_record_upload(name, path, account_id, asset_id, user_id):
+def video_record_upload(name, path, account_id, asset_id, user_id, commands=None):
     """
     录屏文件保存到存储库 并记录地址
+    先写入上传日志(进入本地上传队列), 失败时由 recover_record_uploads 按退避时间重试
+    边录边传的录像(有 .upload 日志)只需补传剩余部分并合并分片
     :param name:
     :param path:
     :param account_id:
     :param asset_id:
     :param user_id:
+    :param commands: 会话中执行的命令, 写入全文索引
     :return:
     """
     try:
-        if os.path.exists(path):
-            filename = "{}-{}".format('video-playback', path.split("/")[-1])
-            res = minio_manager.file_upload(
+        journal = UploadJournal.load(path)
+        if journal is None:
+            if not os.path.exists(path):
+                return
+            journal = UploadJournal(path)
+        journal.meta.update({
+            'name': name, 'account_id': account_id, 'asset_id': asset_id, 'user_id': user_id,
+            'commands': commands or [],
+        })
+        upload_recording(journal)
+    except:
+        logger.error(traceback.format_exc())
+
+
+def upload_recording(journal):
+    """
+    上传录像并登记回放记录, 成功后删除本地文件和日志, 失败时记录到日志等待重试
+    :return: 是否完成
+    """
+    path = journal.path
+    meta = journal.meta
+    recording_spool.lease(journal)
+    try:
+        journal.upload()
+        filename = object_name(path)
+        # 压缩录像的时间索引, 与录像同名加 .idx
+        if os.path.exists(index_path(path)):
+            minio_manager.file_upload(
                 bucket_name=settings.MINIO_BUCKET_NAME,
-                object_name=filename,
-                file_path=path
+                object_name=index_path(filename),
+                file_path=index_path(path)
             )
-            remote_url = urljoin(
-                settings.MINIO_FILE_URL_PREFIX,
-                "{}/{}".format(settings.MINIO_BUCKET_NAME, res.object_name)
-            )
-            record = {
-                'name': name,
-                'filename': filename,
-                'video_path': remote_url,
-                'date_joined': datetime.now(),
-                'account_id': account_id,
-                'asset_id': asset_id,
-                'user_id': user_id,
-
-            }
-            serializer = VideoPlaybackSerializer(data=record)
-            if serializer.is_valid(raise_exception=False):
-                serializer.save()
-                os.remove(path)
-            else:
-                logger.error(str(serializer.errors))
+        name = meta.get('name') or os.path.basename(path)
+        if not save_video_record(name, filename, meta.get('account_id'), meta.get('asset_id'), meta.get('user_id')):
+            raise ValueError('invalid video playback record')
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        recording_spool.failed(journal, e)
+        return False
+    for local_file in (path, index_path(path)):
+        if os.path.exists(local_file):
+            os.remove(local_file)
+    journal.remove()
+    if KEYFRAMES and pyte is not None:
+        build_record_keyframes.delay(filename)
+    if FULL_TEXT_INDEX:
+        index_record.delay(filename, {
+            'name': name, 'account_id': meta.get('account_id'),
+            'asset_id': meta.get('asset_id'), 'user_id': meta.get('user_id')
+        }, meta.get('commands'))
+    return True
+
+
+def save_video_record(name, filename, account_id, asset_id, user_id):
+    """
+    登记回放记录
+    :param filename: 录像的对象名
+    :return: 是否登记成功
+    """
+    remote_url = urljoin(
+        settings.MINIO_FILE_URL_PREFIX,
+        "{}/{}".format(settings.MINIO_BUCKET_NAME, filename)
+    )
+    record = {
+        'name': name,
+        'filename': filename,
+        'video_path': remote_url,
+        'date_joined': datetime.now(),
+        'account_id': account_id,
+        'asset_id': asset_id,
+        'user_id': user_id,
+
+    }
+    serializer = VideoPlaybackSerializer(data=record)
+    if serializer.is_valid(raise_exception=False):
+        serializer.save()
+        return True
+    logger.error(str(serializer.errors))
+    return False
+
+
+@shared_task
+def collect_guacd_recordings():
+    """
+    收集 guacd 已关闭的 RDP/VNC 录像: 压缩上传后登记回放记录, 删除本地文件, 由 celery beat 定时执行
+    """
+    def on_uploaded(filename, meta):
+        return save_video_record(
+            meta.get('name') or filename, filename,
+            meta.get('account_id'), meta.get('asset_id'), meta.get('user_id')
+        )
+
+    try:
+        RecordingCollector(on_uploaded=on_uploaded).collect()
+    except:
+        logger.error(traceback.format_exc())
+
+
+def open_record_events(object_name):
+    """
+    从存储库顺序读取录像
+    :return: (文件头, (序号, 事件, 下一个事件的字节偏移) 迭代器, 需要关闭的响应)
+    """
+    bucket_name = settings.MINIO_BUCKET_NAME
+    if object_name.endswith(CASTZ_SUFFIX):
+        index_response = minio_manager.get_object_range(bucket_name, index_path(object_name))
+        try:
+            index = [json.loads(line) for line in index_response.read().decode().splitlines() if line]
+        finally:
+            index_response.close()
+            index_response.release_conn()
+        reader = CastzReader(MinioObjectFile(bucket_name, object_name), index=index)
+        return reader.header, ((seq, event, None) for seq, event in reader.events_from(0)), None
+    response = minio_manager.get_object_range(bucket_name, object_name)
+    header, events = iter_cast(response)
+    return header, events, response
+
+
+@shared_task
+def build_record_keyframes(object_name):
+    """
+    回放已上传的录像, 生成关键帧文件(录像同名加 .kf)上传到存储库
+    :param object_name: 录像的对象名
+    """
+    bucket_name = settings.MINIO_BUCKET_NAME
+    response = None
+    try:
+        header, events, response = open_record_events(object_name)
+        builder = KeyframeBuilder(header.get('width', 80), header.get('height', 24))
+        for seq, event, next_offset in events:
+            builder.feed(seq, event, next_offset)
+        data = builder.dumps()
+        minio_manager.object_upload(bucket_name, keyframe_path(object_name), io.BytesIO(data), len(data))
+        logger.info('record keyframes {}: {}'.format(object_name, len(builder.keyframes)))
     except:
         logger.error(traceback.format_exc())
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+
+
+@shared_task
+def index_record(object_name, meta, commands=None):
+    """
+    录像的输出和命令写入全文索引
+    :param object_name: 录像的对象名
+    :param meta: 会话信息 name, account_id, asset_id, user_id
+    :param commands: 会话中执行的命令
+    """
+    response = None
+    try:
+        header, events, response = open_record_events(object_name)
+        indexer = SessionIndexer(object_name, header.get('timestamp') or 0, meta)
+        for _, event, _ in events:
+            if event[1] == 'o':
+                indexer.feed_output(event[2])
+        for command in commands or ():
+            indexer.feed_command(command)
+        doc_id = indexer.commit()
+        logger.info('record indexed {}: {}'.format(object_name, doc_id))
+    except:
+        logger.error(traceback.format_exc())
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+
+
+@shared_task
+def purge_session_index():
+    """
+    删除全文索引中超过保留时间的会话, 由 celery beat 定时执行(每天一次即可)
+    """
+    try:
+        logger.info('session index purged: {}'.format(purge_index()))
+    except:
+        logger.error(traceback.format_exc())
+
+
+def orphan_record_meta(path):
+    """
+    没有上传日志的录像, 按路径 {用户名}/{资产ip}.{时间}.{格式} 推断会话信息
+    """
+    username = os.path.basename(os.path.dirname(path))
+    ip = os.path.basename(path).rsplit('.', 2)[0]
+    user = get_user_model().objects.filter(username=username).first()
+    asset = Asset.objects.filter(ip=ip).first()
+    return {
+        'name': os.path.basename(path),
+        'account_id': None,
+        'asset_id': asset and asset.id,
+        'user_id': user and user.id,
+    }
+
+
+@shared_task
+def recover_record_uploads(max_age=3600):
+    """
+    处理本地上传队列: 收编孤儿录像, 重试到期的失败上传, 续传进程崩溃遗留的边录边传录像
+    worker 启动时执行一次, 之后由 celery beat 定时执行
+    :param max_age: 会话仍在进行时日志会随分片上传更新, 超过该时间视为会话已中断
+    """
+    with recording_spool.lock() as locked:
+        if not locked:
+            return
+        for path in recording_spool.orphans():
+            try:
+                recording_spool.adopt(path, orphan_record_meta(path))
+            except:
+                logger.error(traceback.format_exc())
+        for journal in recording_spool.due(max_age):
+            logger.info('retry recording upload: {} (attempt {})'.format(journal.path, journal.attempts + 1))
+            upload_recording(journal)
+        logger.info('recording spool: {}'.format(recording_spool.metrics()))
+
+
+@worker_ready.connect
+def on_worker_ready(**kwargs):
+    recover_record_uploads.delay()
 
 
 @shared_task
@@ -83,7 +292,7 @@ def audit_file_record(
 
 
 @shared_task
-def command_log(name, command_str, asset_id, account_id, user_id, duration):
+def command_log(name, command_str, asset_id, account_id, user_id, duration, date_joined=None):
     """
     终端命令记录
     :param name:
@@ -92,12 +301,13 @@ def command_log(name, command_str, asset_id, account_id, user_id, duration):
     :param account_id:
     :param user_id:
     :param duration:
+    :param date_joined: 命令输入的时间(ISO 格式), 默认为当前时间
     :return:
     """
     record_data = {
         "name": name,
         "command": {'command': command_str},
-        "date_joined": datetime.now(),
+        "date_joined": date_joined or datetime.now(),
         "executor_id": account_id,
         "asset_id": asset_id,
         "jms_user_id": user_id,
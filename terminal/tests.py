@@ -1,3 +1,1603 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from apps.terminal.audit_bus import (
+    AuditBus, AuditConsumer, EVENT_BLACK_COMMAND, EVENT_COMMAND, EVENT_FILE, EVENT_POLICY_COMMAND, PERSISTERS, decode_event
+)
+
+try:
+    import redis
+    # 需要本地 redis (>= 6.2), 不可用时跳过
+    local_redis = redis.Redis.from_url(os.environ.get('TERMINAL_TEST_REDIS_URL', 'redis://127.0.0.1:6379/15'))
+    local_redis.ping()
+except Exception:
+    local_redis = None
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+from apps.utils.cast_keyframe import pyte
+
+
+@unittest.skipIf(local_redis is None, 'local redis is not available')
+class AuditBusTest(SimpleTestCase):
+    def setUp(self):
+        self.bus = AuditBus(redis=local_redis, stream='test:audit:{}'.format(uuid.uuid4().hex), group='test')
+        self.bus.ensure_group()
+        self.saved = {EVENT_COMMAND: [], EVENT_FILE: []}
+
+    def tearDown(self):
+        local_redis.delete(self.bus.stream, self.bus.dead_stream)
+
+    def consumer(self, name, fail=False, **kwargs):
+        def persist(event_type):
+            def inner(events):
+                if fail:
+                    raise RuntimeError('database is down')
+                self.saved[event_type].extend(events)
+            return inner
+        persisters = {event_type: persist(event_type) for event_type in self.saved}
+        return AuditConsumer(self.bus, name, persisters=persisters, **kwargs)
+
+    def test_consume_in_batches(self):
+        for i in range(25):
+            self.bus.command('ssh-1', 'ls {}'.format(i), 1, 2, 3, i)
+        self.bus.file_operate('sftp-1', '/root', '', 'a.txt', 1, 2, 1, 3, file_size=10)
+        consumer = self.consumer('c1', batch=10)
+        while consumer.poll(block=100):
+            pass
+        self.assertEqual([e['command'] for e in self.saved[EVENT_COMMAND]], ['ls {}'.format(i) for i in range(25)])
+        self.assertEqual(self.saved[EVENT_FILE][0]['filename'], 'a.txt')
+        metrics = self.bus.metrics()
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['behind_seconds'], 0)
+        self.assertEqual(consumer.stats.acked, 26)
+
+    def test_reclaim_after_crash(self):
+        for i in range(5):
+            self.bus.command('ssh-1', 'ls {}'.format(i), 1, 2, 3, i)
+        # 第一个消费者读取后写入失败(相当于崩溃), 条目留在待处理列表
+        self.consumer('c1', fail=True).poll(block=100)
+        self.assertEqual(self.bus.metrics()['pending'], 5)
+        time.sleep(0.05)
+        consumer = self.consumer('c2', reclaim_idle=0.01)
+        self.assertEqual(consumer.reclaim(), 5)
+        self.assertEqual(len(self.saved[EVENT_COMMAND]), 5)
+        self.assertEqual(self.bus.metrics()['pending'], 0)
+
+    def test_dead_letter(self):
+        self.bus.command('ssh-1', 'ls', 1, 2, 3, 0)
+        local_redis.xadd(self.bus.stream, {'t': 'x', 'd': 'not json', 'ts': 0})
+        consumer = self.consumer('c1', fail=True, reclaim_idle=0, max_deliveries=2)
+        consumer.poll(block=100)
+        for _ in range(3):
+            consumer.reclaim()
+        metrics = self.bus.metrics()
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['dead'], 2)
+
+
+class LocalSFTPServer(object):
+    """
+    本地 paramiko SFTP 服务端, 接受任意账号密码, 读写本机文件
+    """
+    def __init__(self):
+        class Server(paramiko.ServerInterface):
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def get_allowed_auths(self, username):
+                return 'password'
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+        class Handle(paramiko.SFTPHandle):
+            def stat(self):
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        class SFTP(paramiko.SFTPServerInterface):
+            def open(self, path, flags, attr):
+                handle = Handle(flags)
+                handle.readfile = handle.writefile = os.fdopen(os.open(path, flags, 0o644), 'ab+')
+                return handle
+
+            def stat(self, path):
+                return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+            lstat = stat
+
+            def list_folder(self, path):
+                return [
+                    paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)
+                ]
+
+            def canonicalize(self, path):
+                return os.path.abspath(path)
+
+        self.server_class, self.sftp_class = Server, SFTP
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, self.sftp_class)
+            transport.start_server(server=self.server_class())
+
+    def close(self):
+        self.listener.close()
+
+
+class FakeWs(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, text_data=None, bytes_data=None):
+        self.messages.append(json.loads(text_data) if text_data else bytes_data)
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class SFTPUploadTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils.sftp_client import SFTPClient
+        self.server = LocalSFTPServer()
+        self.home = tempfile.mkdtemp()
+        self.ws = FakeWs()
+        self.client = SFTPClient(
+            'local', self.server.port, 'u', 'p', ip='127.0.0.1', websocket=self.ws, home_path=self.home
+        )
+        self.client.sftp_connect()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.home)
+
+    def test_browse_during_upload(self):
+        # 流水线写入的响应未读取时浏览目录, 上传不能因响应被丢弃而卡住
+        data = os.urandom(4 * 1024 * 1024)
+        acks = []
+        upload = self.client.upload_open(os.path.join(self.home, 'a.bin'), on_ack=lambda seq, size: acks.append(size))
+        for i in range(0, len(data), 64 * 1024):
+            self.client.file_upload(upload, data[i:i + 64 * 1024])
+        self.assertIn('a.bin', [f['name'] for f in self.client.list_dir()])
+        self.client.sftp.stat(os.path.join(self.home, 'a.bin'))
+
+        result = []
+        finisher = threading.Thread(target=lambda: result.append(upload.finish()), daemon=True)
+        finisher.start()
+        finisher.join(10)
+        self.assertEqual(result, [len(data)])
+        self.assertEqual(acks[-1], len(data))
+        with open(os.path.join(self.home, 'a.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class StalledSFTP(object):
+    """
+    不回复响应的 SFTP 服务端, release 后按请求顺序回复
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.error = None
+        self.requests = 0
+        self.sock = mock.Mock(**{'recv_ready.return_value': False})
+        self.fd = mock.Mock(handle=b'h', **{'stat.return_value': SimpleNamespace(st_size=0)})
+
+    def open(self, path, mode):
+        return self.fd
+
+    def _async_request(self, *args):
+        self.requests += 1
+        return self.requests
+
+    def _read_response(self, num):
+        from paramiko.sftp import CMD_STATUS
+        self.release.wait(10)
+        if self.error:
+            raise self.error
+        return CMD_STATUS, None
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class SFTPUploadFeedTest(SimpleTestCase):
+    def make_upload(self):
+        from apps.utils.sftp_upload import SFTPUpload
+
+        self.sftp = StalledSFTP()
+        self.addCleanup(self.sftp.release.set)
+        self.acks = []
+        self.errors = []
+        return SFTPUpload(
+            self.sftp, '/tmp/a.bin', window=2, request_size=16 * 1024, client_window=64 * 1024,
+            on_ack=lambda seq, size: self.acks.append((seq, size)), on_error=self.errors.append
+        )
+
+    def test_feed_does_not_wait_for_server(self):
+        upload = self.make_upload()
+        start = time.time()
+        for i in range(8):
+            self.assertEqual(upload.feed(b'x' * 16 * 1024), i + 1)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.acks, [])
+        # 浏览器没有遵守窗口
+        with self.assertRaises(IOError):
+            upload.feed(b'x' * (2 * 64 * 1024 + 1))
+        self.sftp.release.set()
+        self.assertEqual(upload.finish(timeout=5), 8 * 16 * 1024)
+        self.assertEqual(self.acks[-1], (8, 8 * 16 * 1024))
+
+    def test_write_error(self):
+        upload = self.make_upload()
+        self.sftp.error = IOError('disk full')
+        upload.feed(b'x' * 16 * 1024)
+        self.sftp.release.set()
+        upload._thread.join(5)
+        self.assertEqual(self.errors, [upload])
+        with self.assertRaises(IOError):
+            upload.feed(b'x')
+        with self.assertRaises(IOError):
+            upload.finish(timeout=5)
+
+
+class SFTPDownloadTest(SimpleTestCase):
+    def make_download(self, window=0):
+        from apps.utils.sftp_download import SFTPDownload
+        client = SimpleNamespace(ws=FakeWs(), ip='127.0.0.1', port=22, username='u', password='p')
+        return SFTPDownload(client, '/tmp/a.bin', 10 * 1024 * 1024, window=window)
+
+    def test_default_window(self):
+        # 浏览器没有指定窗口时也按默认窗口流控, 不回复 ack 时不会无限发送
+        from apps.utils import sftp_download
+        download = self.make_download()
+        self.assertEqual(download.window, sftp_download.DOWNLOAD_WINDOW)
+        download.started = time.time()
+        download.progress()
+        self.assertEqual(download.ws.messages[-1]['window'], sftp_download.DOWNLOAD_WINDOW)
+        frame = b'x' * (download.window // 2)
+        self.assertTrue(download.send_frame(frame))
+        self.assertTrue(download.send_frame(frame))
+        with mock.patch.object(sftp_download, 'ACK_TIMEOUT', 0):
+            with self.assertRaises(IOError):
+                download.send_frame(frame)
+        download.ack(len(frame))
+        self.assertTrue(download.send_frame(frame))
+
+    def test_malformed_ack(self):
+        from apps.common.consts import FileOperationCode
+        from apps.terminal.sftp_websocket import FileManageWs
+        ws = FileManageWs()
+        ws.send = FakeWs().send
+        ws.download = self.make_download(window=1024)
+        params = {'code': FileOperationCode.DOWNLOAD.value, 'params': {'ack': 'abc'}}
+        ws.receive(text_data=json.dumps(params))
+        self.assertEqual(ws.download.acked, 0)
+        self.assertEqual(ws.send.__self__.messages[-1]['message'], '下载参数不正确')
+        params['params']['ack'] = '512'
+        ws.receive(text_data=json.dumps(params))
+        self.assertEqual(ws.download.acked, 512)
+
+
+class RecordingRedis(object):
+    """
+    只记录 xadd 的条目, 代替审计事件总线的 redis
+    """
+    def __init__(self):
+        self.entries = []
+
+    def xadd(self, stream, fields, **kwargs):
+        self.entries.append(fields)
+
+
+class CommandPolicyAuditTest(TestCase):
+    def check(self, action, command, black_rules=()):
+        from apps.terminal import ssh_session
+        from apps.terminal.command_policy import Policy, PolicyIndex
+        from apps.terminal.models import CommandPolicy
+        from apps.utils.command_matcher import CommandMatcher
+
+        obj = CommandPolicy.objects.create(name='no-rm', rules='rm -rf /\nre:^shutdown', action=action)
+        index = PolicyIndex([Policy(obj.id, obj.name, obj.rules.splitlines(), obj.action)])
+        bus = AuditBus(redis=RecordingRedis())
+        session = SimpleNamespace(
+            editor=SimpleNamespace(alt_screen=False),
+            user=SimpleNamespace(id=1, name='alice'),
+            asset=SimpleNamespace(id=2, hostname='web-1'),
+            account=SimpleNamespace(id=3, name='root'),
+            rejected=[],
+        )
+        session.reject_command = session.rejected.append
+        with mock.patch.object(ssh_session, 'command_policy_manager', index), \
+                mock.patch.object(ssh_session, 'audit_bus', bus), \
+                mock.patch.object(ssh_session, 'black_command_matcher', CommandMatcher(black_rules)), \
+                mock.patch.object(ssh_session, 'BLACK_COMMAND_MODE', 'block'):
+            blocked = ssh_session.TerminalSession.check_command(session, command)
+        self.events = [decode_event(fields) for fields in bus.redis.entries]
+        # 按消费者的方式解码并写入
+        for event_type, event in self.events:
+            if event_type == EVENT_POLICY_COMMAND:
+                PERSISTERS[event_type]([event])
+        return obj, blocked, session.rejected
+
+    def test_blocked_command_is_audited(self):
+        from apps.terminal.models import CommandPolicyLog
+
+        policy, blocked, rejected = self.check('block', 'rm -rf /')
+        self.assertTrue(blocked)
+        self.assertEqual(len(rejected), 1)
+        log = CommandPolicyLog.objects.get()
+        self.assertEqual(log.policy_id, policy.id)
+        self.assertEqual(log.policy_name, 'no-rm')
+        self.assertEqual(log.action, 'block')
+        self.assertEqual(log.rules, ['rm -rf /'])
+        self.assertEqual(log.raw_command, 'rm -rf /')
+        self.assertEqual((log.user_name, log.asset_hostname, log.account_name), ('alice', 'web-1', 'root'))
+
+    def test_logged_command_is_audited(self):
+        from apps.terminal.models import CommandPolicyLog
+
+        _, blocked, rejected = self.check('log', 'shutdown -h now')
+        self.assertFalse(blocked)
+        self.assertEqual(rejected, [])
+        self.assertEqual(CommandPolicyLog.objects.get().action, 'log')
+
+    def test_allow_keeps_black_command_rules(self):
+        # allow 策略不跳过全局高危命令规则
+        _, blocked, rejected = self.check('allow', 'shutdown -h now', black_rules=['shutdown'])
+        self.assertTrue(blocked)
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual([event_type for event_type, _ in self.events], [EVENT_BLACK_COMMAND])
+
+        _, blocked, _ = self.check('allow', 'shutdown -h now')
+        self.assertFalse(blocked)
+
+
+@unittest.skipIf(local_redis is None, 'local redis is not available')
+class SessionSearchViewTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Permission
+        from apps.utils import session_index
+
+        patcher = mock.patch.object(session_index, 'default_redis', local_redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.clear)
+        self.clear()
+        user_model = get_user_model()
+        self.alice = user_model.objects.create_user(username='alice', password='x')
+        self.bob = user_model.objects.create_user(username='bob', password='x')
+        self.auditor = user_model.objects.create_user(username='auditor', password='x')
+        self.auditor.user_permissions.add(Permission.objects.get(codename='terminal_audit'))
+        now = time.time()
+        for user, start_time in ((self.alice, now - 60), (self.bob, now - 30)):
+            indexer = session_index.SessionIndexer('{}.cast'.format(user.username), start_time, {'user_id': user.id})
+            indexer.feed_command('cat /etc/shadow')
+            indexer.commit()
+
+    def clear(self):
+        keys = list(local_redis.scan_iter(match='terminal:fts:*'))
+        if keys:
+            local_redis.delete(*keys)
+
+    def search(self, user, **params):
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from apps.terminal.views import SessionSearchView
+
+        request = APIRequestFactory().get('/sessions/search/', dict(params, q='shadow'))
+        force_authenticate(request, user=user)
+        response = SessionSearchView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return sorted(doc['object_name'] for doc in response.data['results'])
+
+    def test_user_sees_only_own_sessions(self):
+        self.assertEqual(self.search(self.alice), ['alice.cast'])
+        self.assertEqual(self.search(self.alice, user_id=self.bob.id), ['alice.cast'])
+
+    def test_auditor_sees_all_sessions(self):
+        self.assertEqual(self.search(self.auditor), ['alice.cast', 'bob.cast'])
+        self.assertEqual(self.search(self.auditor, user_id=self.bob.id), ['bob.cast'])
+
+    def test_purge_expired_sessions(self):
+        from apps.utils import session_index
+
+        session_index.purge(before=time.time() - 45)
+        self.assertEqual(self.search(self.auditor), ['bob.cast'])
+        self.assertEqual(local_redis.zcard(session_index.USER_KEY.format(self.alice.id)), 0)
+
+
+class PlaybackAccessTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Permission
+        from apps.audits.serializers.file_serializer import VideoPlaybackSerializer
+
+        user_model = get_user_model()
+        self.alice = user_model.objects.create_user(username='alice', password='x')
+        self.bob = user_model.objects.create_user(username='bob', password='x')
+        self.auditor = user_model.objects.create_user(username='auditor', password='x')
+        self.auditor.user_permissions.add(Permission.objects.get(codename='terminal_audit'))
+        self.video = VideoPlaybackSerializer.Meta.model.objects.create(
+            name='alice', filename='alice/10.0.0.1.cast', user_id=self.alice.id
+        )
+
+    def get(self, view, user, headers=None, **params):
+        from rest_framework.test import APIRequestFactory, force_authenticate
+
+        request = APIRequestFactory().get('/playback/', params, **(headers or {}))
+        force_authenticate(request, user=user)
+        return view.as_view()(request, pk=self.video.pk)
+
+    def test_seek(self):
+        from apps.terminal import views
+
+        with mock.patch.object(views.RecordPlayback, 'seek', return_value={'events': []}):
+            self.assertEqual(self.get(views.RecordPlaybackSeekView, self.alice, time=10).status_code, 200)
+            self.assertEqual(self.get(views.RecordPlaybackSeekView, self.auditor, time=10).status_code, 200)
+            self.assertEqual(self.get(views.RecordPlaybackSeekView, self.bob, time=10).status_code, 404)
+
+    def test_stream(self):
+        from apps.terminal import views
+
+        with mock.patch.object(views.chunk_cache, 'size', return_value=3), \
+                mock.patch.object(views.chunk_cache, 'iter_range', return_value=iter([b'abc'])):
+            self.assertEqual(self.get(views.RecordPlaybackStreamView, self.alice).status_code, 200)
+            self.assertEqual(self.get(views.RecordPlaybackStreamView, self.bob).status_code, 404)
+
+    def test_presigned_url_requires_audit(self):
+        from apps.terminal import views
+
+        with mock.patch.object(views.minio_manager, 'presigned_url', return_value='http://minio/x'):
+            self.assertEqual(self.get(views.RecordPlaybackStreamView, self.alice, url=1).status_code, 403)
+            response = self.get(views.RecordPlaybackStreamView, self.auditor, url=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['url'], 'http://minio/x')
+
+    def test_clip_duration_is_capped(self):
+        from apps.terminal import views
+        from apps.terminal.playback import MAX_DURATION
+
+        result = {'header': {'version': 2}, 'keyframe': None, 'events': []}
+        with mock.patch.object(views.RecordPlayback, 'seek', return_value=result) as seek:
+            response = self.get(views.RecordPlaybackStreamView, self.alice, start=0, end=10 ** 9)
+        self.assertEqual(response.status_code, 200)
+        seek.assert_called_once_with(0, MAX_DURATION)
+        self.assertEqual(json.loads(response.content.splitlines()[0])['duration'], MAX_DURATION)
+
+    def test_guacd_recording(self):
+        # guacd 录像整体返回压缩数据, 不能按时间跳转或截取
+        from apps.terminal import views
+
+        self.video.filename = 'video-playback-{}.gz'.format(uuid.uuid4().hex)
+        self.video.save()
+        self.assertEqual(self.get(views.RecordPlaybackSeekView, self.alice, time=10).status_code, 400)
+        self.assertEqual(self.get(views.RecordPlaybackStreamView, self.alice, start=0).status_code, 400)
+        with mock.patch.object(views.chunk_cache, 'size', return_value=3), \
+                mock.patch.object(views.chunk_cache, 'iter_range', return_value=iter([b'abc'])) as iter_range:
+            # 压缩数据忽略 Range
+            response = self.get(views.RecordPlaybackStreamView, self.alice, headers={'HTTP_RANGE': 'bytes=1-'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Accept-Ranges'], 'none')
+        iter_range.assert_called_once_with(mock.ANY, self.video.filename, 0, 3)
+
+
+class StreamingUploadTest(SimpleTestCase):
+    """
+    写线程调用 check 时不等待开始分片上传和上一个分片的上传
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'a.cast')
+        self.release = threading.Event()
+        self.manager = mock.Mock()
+        self.manager.upload_part.side_effect = lambda *args: self.release.wait(10) and 'etag'
+        patcher = mock.patch('apps.utils.recording_upload.minio_manager', self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+
+    def sink(self):
+        from apps.utils.recording_upload import PART_SIZE
+
+        sink = SimpleNamespace(local_size=PART_SIZE, rotated=[])
+
+        def rotate(path):
+            with open(path, 'wb') as f:
+                f.write(b'x')
+            sink.rotated.append(path)
+        sink.rotate = rotate
+        return sink
+
+    def test_check_does_not_wait_for_upload(self):
+        from apps.utils.recording_upload import StreamingUpload, UploadJournal
+
+        self.manager.create_multipart_upload.return_value = 'upload-1'
+        upload = StreamingUpload(UploadJournal(self.path))
+        sink = self.sink()
+        start = time.time()
+        upload.check(sink)
+        # 上一个分片还在上传, 跳过切分而不是等待
+        upload.check(sink)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(sink.rotated), 1)
+        done = threading.Event()
+        upload.then(done.set)
+        self.assertFalse(done.is_set())
+        self.release.set()
+        self.assertTrue(done.wait(10))
+        journal = UploadJournal.load(self.path)
+        self.assertEqual((journal.upload_id, journal.parts, journal.next_part), ('upload-1', [(1, 'etag')], 2))
+
+    def test_start_failure_is_not_retried(self):
+        from apps.utils.recording_upload import StreamingUpload, UploadJournal
+
+        self.manager.create_multipart_upload.side_effect = IOError('minio is down')
+        upload = StreamingUpload(UploadJournal(self.path))
+        sink = self.sink()
+        upload.check(sink)
+        upload.future.result(10)
+        upload.check(sink)
+        self.assertEqual(self.manager.create_multipart_upload.call_count, 1)
+        self.assertEqual(len(sink.rotated), 1)
+        # 会话结束后的上传任务开始分片上传并补传切出的分片
+        journal = UploadJournal.load(self.path)
+        self.assertEqual((journal.upload_id, journal.next_part), (None, 2))
+        self.assertTrue(os.path.exists(sink.rotated[0]))
+
+
+class RecordingSpoolTest(SimpleTestCase):
+    """
+    进行中的录像长时间没有输出也不会被收编或重试
+    """
+    def setUp(self):
+        from apps.utils.recording_spool import RecordingSpool
+        from apps.utils.recording_writer import Recording
+
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.spool = RecordingSpool(self.tmp)
+        self.path = os.path.join(self.tmp, 'alice', '10.0.0.1.1700000000.cast')
+        os.makedirs(os.path.dirname(self.path))
+        with mock.patch('apps.utils.recording_writer.RECORD_STREAM', False):
+            self.recording = Recording(None, self.path, {'version': 2, 'width': 80, 'height': 24}, {'user_id': 1})
+            self.recording.open()
+        self.recording.sink.flush(False)
+
+    def age(self, seconds):
+        from apps.utils.recording_upload import journal_path
+
+        past = time.time() - seconds
+        for path in (self.path, journal_path(self.path)):
+            os.utime(path, (past, past))
+
+    def test_quiet_recording_is_not_adopted(self):
+        self.age(7200)
+        self.assertEqual(self.spool.orphans(), [])
+        self.assertEqual(self.spool.due(), [])
+
+    def test_recording_of_crashed_process_is_retried(self):
+        import subprocess
+        import sys
+
+        from apps.utils.recording_upload import UploadJournal
+
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        journal = UploadJournal.load(self.path)
+        journal.owner = '{}:{}'.format(socket.gethostname(), process.pid)
+        journal.save()
+        self.assertEqual([j.path for j in self.spool.due()], [self.path])
+
+    def test_closed_recording_is_retried_by_age(self):
+        self.recording.finish()
+        self.recording.after_upload()
+        self.assertEqual(self.spool.due(), [])
+        self.age(7200)
+        self.assertEqual([j.path for j in self.spool.due()], [self.path])
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+class TransportPoolTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils.ssh_transport_pool import TransportPool
+
+        self.pool = TransportPool()
+        self.pool.stop = False  # 不启动清理线程
+        patcher = mock.patch.object(TransportPool, '_connect', side_effect=lambda *args: FakeTransport())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refs(self, transport):
+        return self.pool._owners[transport].refs
+
+    def test_release_after_reconnect(self):
+        t1 = self.pool.acquire('10.0.0.1', 22, 'root', 'pw')
+        self.assertIs(self.pool.acquire('10.0.0.1', 22, 'root', 'pw'), t1)
+        t1.active = False
+        t2 = self.pool.acquire('10.0.0.1', 22, 'root', 'pw')
+        self.assertIsNot(t2, t1)
+        # 断开前的使用者归还旧连接, 不影响新连接的引用数
+        self.pool.release(t1)
+        self.pool.release(t1)
+        self.assertEqual((self.refs(t1), self.refs(t2)), (0, 1))
+        self.assertEqual(self.pool.evict_idle(), 1)
+        self.pool.release(t2)
+        self.assertEqual(self.refs(t2), 0)
+
+    def test_password_is_part_of_key(self):
+        t1 = self.pool.acquire('10.0.0.1', 22, 'root', 'pw')
+        t2 = self.pool.acquire('10.0.0.1', 22, 'root', 'other')
+        self.assertIsNot(t1, t2)
+        self.assertNotIn('pw', repr(list(self.pool._entries)))
+
+
+class CommandMatcherTest(SimpleTestCase):
+    def test_split_words(self):
+        from apps.utils.command_matcher import split_words
+
+        self.assertEqual(split_words('ls -l  /tmp'), ['ls', '-l', '/tmp'])
+        self.assertEqual(split_words('\\rm -rf /'), ['rm', '-rf', '/'])
+        self.assertEqual(split_words('r\\m "-r"f \'/\''), ['rm', '-rf', '/'])
+        self.assertEqual(split_words('"r""m" \'\' a\\ b'), ['rm', '', 'a b'])
+        self.assertEqual(split_words('echo "a \\"b\\" \\n"'), ['echo', 'a "b" \\n'])
+        self.assertEqual(split_words('echo "unclosed quote'), ['echo', 'unclosed quote'])
+
+    def test_parse_command(self):
+        from apps.utils.command_matcher import parse_command
+
+        self.assertEqual(
+            parse_command('sudo -u root /bin/rm -fr --verbose /tmp'), ('rm', {'-f', '-r', '--verbose'}, ['/tmp'])
+        )
+        self.assertEqual(parse_command('LANG=C nohup r\\m --recursive --force /'), ('rm', {'-r', '-f'}, ['/']))
+        self.assertIsNone(parse_command('  '))
+        self.assertIsNone(parse_command('A=1 sudo'))
+
+    def test_match(self):
+        from apps.utils.command_matcher import CommandMatcher
+
+        matcher = CommandMatcher(['rm -rf /', ':(){ :|:& };:', 're:^curl .*\\|\\s*sh'])
+        for command in ('rm -rf /', '/bin/rm -fr /', 'cd / && sudo rm -r -f /', '\\rm -rf /', 'r\\m -rf /',
+                        '"rm" -rf "/"', "r''m -r'f' /", 'echo $(rm --recursive --force /)'):
+            self.assertEqual(matcher.match(command), ['rm -rf /'], command)
+        for command in ('rm -rf /tmp/a', 'rm -f /', 'echo rm -rf /', 'ls'):
+            self.assertEqual(matcher.match(command), [], command)
+        self.assertEqual(matcher.match(':(){ :|:& };:'), [':(){ :|:& };:'])
+        self.assertEqual(matcher.match('curl http://x/a.sh | sh'), ['re:^curl .*\\|\\s*sh'])
+
+
+class BlackCommandNotifyTest(TestCase):
+    def test_change_notifies_reload(self):
+        from apps.assets.models import BlackCommand
+        from apps.utils import command_matcher
+
+        with mock.patch.object(command_matcher.default_redis, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                BlackCommand.objects.create(key='rm -rf /')
+        publish.assert_called_once_with(command_matcher.BLACK_COMMAND_CHANNEL, 1)
+
+
+class GuacamoleResizeTest(SimpleTestCase):
+    def test_burst_sends_last_size_once(self):
+        from apps.terminal import guacamole
+
+        sent = []
+        ws = guacamole.GuacamoleWs()
+        ws.gd_client = SimpleNamespace(send=sent.append)
+        with mock.patch.object(guacamole, 'RESIZE_DEBOUNCE', 0.05), \
+                mock.patch.object(guacamole, 'RESIZE_MAX_DELAY', 10), \
+                mock.patch.object(guacamole.threading, 'Timer', wraps=threading.Timer) as timer:
+            for i in range(50):
+                ws.receive(text_data='4.size,1.0,3.{},3.600;'.format(100 + i))
+            ws.receive(text_data='4.sync,1.0;')
+            deadline = time.time() + 5
+            while len(sent) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(sent, ['4.sync,1.0;', '4.size,1.0,3.149,3.600;'])
+        self.assertLess(timer.call_count, 5)
+        self.assertEqual(ws.bytes_in, sum(len(item) for item in sent))
+
+
+@mock.patch('apps.utils.recording_writer.RECORD_STREAM', False)
+class RecordingWriterTest(SimpleTestCase):
+    """
+    队列已满时 write/close 都不阻塞调用方
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def writer(self, overflow):
+        from apps.utils.recording_writer import RecordingWriter
+
+        writer = RecordingWriter(maxsize=1, flush_interval=0.05, overflow=overflow)
+        writer.stop = False  # 由测试驱动写线程的处理
+        return writer
+
+    def drain(self, writer):
+        items = []
+        while not writer.queue.empty():
+            items.append(writer.queue.get_nowait())
+        writer.handle(items)
+        writer.handle_requests()
+
+    def read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f][1:]
+
+    def test_close_does_not_block_when_queue_is_full(self):
+        writer = self.writer('drop')
+        path = os.path.join(self.tmp, 'a.cast')
+        recording = writer.open(path, {'version': 2})
+        self.drain(writer)
+        self.assertTrue(recording.write([[0.1, 'o', 'a']]))
+        self.assertFalse(recording.write([[0.2, 'o', 'b']]))
+        closed = threading.Event()
+        start = time.time()
+        recording.close(callback=closed.set)
+        self.assertLess(time.time() - start, 0.05)
+        self.drain(writer)
+        self.assertTrue(closed.is_set())
+        self.assertEqual([event[1:] for event in self.read(path)], [['o', 'a'], ['m', 'recording dropped 1 events']])
+
+    def test_close_waits_for_queued_events(self):
+        writer = self.writer('drop')
+        path = os.path.join(self.tmp, 'b.cast')
+        recording = writer.open(path, {'version': 2})
+        self.drain(writer)
+        recording.write([[0.1, 'o', 'a']])
+        recording.close()
+        writer.handle_requests()
+        self.assertFalse(recording.finished)
+        self.drain(writer)
+        self.assertTrue(recording.finished)
+        self.assertEqual(self.read(path), [[0.1, 'o', 'a']])
+
+    def test_block_keeps_backlog(self):
+        writer = self.writer('block')
+        path = os.path.join(self.tmp, 'c.cast')
+        recording = writer.open(path, {'version': 2})
+        for i in range(5):
+            start = time.time()
+            self.assertTrue(recording.write([[i, 'o', str(i)]]))
+            self.assertLess(time.time() - start, 0.05)
+        recording.close()
+        self.drain(writer)
+        self.drain(writer)
+        self.assertEqual([event[2] for event in self.read(path)], ['0', '1', '2', '3', '4'])
+        self.assertEqual(writer.stats.dropped, 0)
+
+
+class ReattachTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        from apps.assets.models import Asset
+
+        self.user = get_user_model().objects.create_user(username='alice', password='x')
+        self.asset = Asset.objects.create(hostname='web-1')
+        self.account = self.asset.accounts.create(username='root')
+        self.session = SimpleNamespace(
+            token='t1', user=self.user, asset=self.asset, account=self.account,
+            attach=mock.Mock(return_value=True), terminate=mock.Mock(),
+        )
+
+    def reattach(self):
+        from apps.terminal import ssh_websocket
+
+        ws = ssh_websocket.TerminalWebsocket()
+        ws.user = self.user
+        ws.send = mock.Mock()
+        ws.close = mock.Mock()
+        with mock.patch.object(ssh_websocket.session_manager, 'get', return_value=self.session):
+            self.assertTrue(ws.reattach(self.session.token))
+        return ws
+
+    def test_reattach(self):
+        ws = self.reattach()
+        self.assertIs(ws.session, self.session)
+        self.session.attach.assert_called_once_with(ws)
+
+    def test_disabled_account_terminates_session(self):
+        self.account.is_active = False
+        self.account.save()
+        ws = self.reattach()
+        self.assertIsNone(ws.session)
+        self.session.attach.assert_not_called()
+        self.session.terminate.assert_called_once_with()
+        ws.close.assert_called_once_with()
+
+    def test_disabled_user_terminates_session(self):
+        self.user.is_active = False
+        self.user.save()
+        ws = self.reattach()
+        self.assertIsNone(ws.session)
+        self.session.terminate.assert_called_once_with()
+
+    @unittest.skipIf(local_redis is None, 'local redis is not available')
+    def test_admit_limit(self):
+        from apps.terminal import session_registry as registry
+
+        user_key = registry.USER_SESSIONS_KEY.format(self.user.id)
+        self.addCleanup(local_redis.delete, user_key, registry.ASSET_SESSIONS_KEY.format(self.asset.id))
+        local_redis.zadd(user_key, {'t1': time.time()})
+        with mock.patch.object(registry, 'default_redis', local_redis), \
+                mock.patch.object(registry, 'MAX_SESSIONS_PER_USER', 1):
+            # 会话自己不计入
+            self.assertIs(self.reattach().session, self.session)
+            local_redis.zadd(user_key, {'t2': time.time()})
+            ws = self.reattach()
+        self.assertIsNone(ws.session)
+        self.assertEqual(self.session.attach.call_count, 1)
+        self.session.terminate.assert_not_called()
+
+
+class CommandAuditDrainTest(SimpleTestCase):
+    def test_drain_writes_batch_in_progress(self):
+        from apps.terminal.command_audit import CommandAuditSink
+
+        saved = []
+        model = mock.Mock(side_effect=lambda **row: row)
+        model.objects.bulk_create.side_effect = lambda objs, batch_size=None: saved.extend(objs)
+        sink = CommandAuditSink(batch_size=100, flush_interval=60, model=model)
+        for i in range(10):
+            sink.add('ssh-1', 'ls {}'.format(i), 1, 2, 3, i)
+        # 等写线程把记录从队列取到它正在攒的批次中
+        deadline = time.time() + 5
+        while not sink.queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        with mock.patch('apps.terminal.command_audit.close_old_connections'):
+            sink.drain()
+        self.assertEqual([row['command']['command'] for row in saved], ['ls {}'.format(i) for i in range(10)])
+        self.assertFalse(sink._thread.is_alive())
+
+
+class MonitorObserverTest(SimpleTestCase):
+    def setUp(self):
+        from apps.terminal.ssh_monitor import MonitorHub
+        from apps.terminal.ssh_session import TerminalSession
+
+        self.session = TerminalSession(
+            SimpleNamespace(id=1, username='alice'), SimpleNamespace(id=2, ip='127.0.0.1'), SimpleNamespace(id=3)
+        )
+        self.session.scrollback.append(b'$ ls\r\n')
+        self.hub = MonitorHub()
+        self.hub.channel_layer = mock.Mock(send=mock.AsyncMock())
+
+    def handle(self, kind):
+        import asyncio
+        from apps.terminal import ssh_session
+
+        with mock.patch.object(ssh_session.session_manager, 'get', return_value=self.session):
+            asyncio.run(self.hub._handle({'type': kind, 'token': self.session.token, 'reply_channel': 'r'}))
+
+    def test_join_and_leave(self):
+        self.handle('monitor.join')
+        self.assertTrue(self.session.observing)
+        message = self.hub.channel_layer.send.call_args[0][1]
+        self.assertEqual(json.loads(message['text'])['message'], '$ ls\r\n')
+        self.handle('monitor.leave')
+        self.handle('monitor.leave')
+        self.assertEqual(self.session.observers, 0)
+        self.assertFalse(self.session.observing)
+
+    def test_put_before_loop_and_queue_limit(self):
+        from apps.terminal import ssh_monitor
+
+        self.hub.publish('t1', 'a')
+        self.assertEqual(self.hub.pending, 0)
+        self.hub.loop = mock.Mock()
+        self.hub._queue = mock.Mock()
+        with mock.patch.object(ssh_monitor, 'MONITOR_QUEUE_SIZE', 2):
+            for text in 'abc':
+                self.hub.publish('t1', text)
+        self.assertEqual((self.hub.pending, self.hub.dropped), (2, 1))
+        self.assertEqual(self.hub.loop.call_soon_threadsafe.call_count, 2)
+
+    def test_publish_through_loop(self):
+        import asyncio
+
+        async def receive(channel):
+            await asyncio.Event().wait()
+        sent = threading.Event()
+        self.hub.channel_layer = mock.Mock(
+            new_channel=mock.AsyncMock(return_value='hub'), receive=receive,
+            group_send=mock.AsyncMock(side_effect=lambda group, message: sent.set()),
+        )
+        self.hub.check()
+        self.assertTrue(self.hub._ready.wait(5))
+        self.hub.publish('t1', 'frame')
+        self.assertTrue(sent.wait(5))
+        self.hub.channel_layer.group_send.assert_called_once_with(
+            'terminal-monitor-t1', {'type': 'terminal.output', 'text': 'frame'}
+        )
+        self.assertEqual(self.hub.pending, 0)
+
+
+class PollerReader(object):
+    def __init__(self, channel):
+        self.channel = channel
+        self.poller = None
+        self.received = []
+        self.event = threading.Event()
+
+    def on_read(self):
+        self.received.append(self.channel.recv(4096))
+        self.event.set()
+
+    def abort(self):
+        pass
+
+
+class SSHPollerTest(SimpleTestCase):
+    def setUp(self):
+        from apps.terminal.ssh_poller import SSHPoller
+        self.poller = SSHPoller('test-poller')
+
+    def pair(self):
+        r, w = socket.socketpair()
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        r.setblocking(False)
+        return PollerReader(r), w
+
+    def test_read_and_unregister(self):
+        reader, w = self.pair()
+        self.poller.add_reader(reader)
+        self.assertEqual(len(self.poller), 1)
+        w.send(b'hello')
+        self.assertTrue(reader.event.wait(5))
+        self.assertEqual(reader.received, [b'hello'])
+
+        self.poller.del_reader(reader)
+        self.poller.del_reader(reader)
+        self.assertEqual(len(self.poller), 0)
+        reader.event.clear()
+        w.send(b'again')
+        self.assertFalse(reader.event.wait(0.3))
+
+    def test_timers(self):
+        calls = []
+        self.poller.call_later(0.02, calls.append, 'b')
+        self.poller.call_later(0, calls.append, 'a')
+        cancelled = self.poller.call_later(0, calls.append, 'cancelled')
+        self.poller.call_later(0, lambda: 1 / 0)
+        later = self.poller.call_later(60, calls.append, 'later')
+        self.poller.cancel_timer(cancelled)
+        self.poller.cancel_timer(None)
+
+        self.poller._run_timers()
+        self.assertEqual(calls, ['a'])
+        time.sleep(0.03)
+        self.poller._run_timers()
+        self.assertEqual(calls, ['a', 'b'])
+        # 已取消的定时器不影响下一次 select 的等待时间
+        self.assertGreater(self.poller._next_timeout(), 0.5)
+        self.poller.cancel_timer(later)
+        self.poller._next_timeout()
+        self.assertEqual(self.poller._timers, [])
+
+    def test_timer_runs_in_poller_thread(self):
+        reader, w = self.pair()
+        self.poller.add_reader(reader)
+        done = threading.Event()
+        threads = []
+        self.poller.call_later(0.01, lambda: (threads.append(threading.current_thread().name), done.set()))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(threads, ['test-poller'])
+        self.poller.del_reader(reader)
+
+
+class SSHPollerGroupTest(SimpleTestCase):
+    def test_register_balances_shards(self):
+        from apps.terminal.ssh_poller import SSHPoller, SSHPollerGroup
+
+        group = SSHPollerGroup(shards=3)
+        readers = []
+        with mock.patch.object(SSHPoller, 'check'):
+            for _ in range(7):
+                r, w = socket.socketpair()
+                self.addCleanup(r.close)
+                self.addCleanup(w.close)
+                reader = PollerReader(r)
+                group.register(reader)
+                readers.append(reader)
+        self.assertEqual(group.count(), 7)
+        self.assertEqual(sorted(len(shard) for shard in group.shards), [2, 2, 3])
+        self.assertTrue(all(reader.poller in group.shards for reader in readers))
+
+        for reader in readers[:4]:
+            group.unregister(reader)
+        group.unregister(PollerReader(None))
+        self.assertEqual(group.count(), 3)
+        self.assertEqual(len(SSHPollerGroup(shards=0).shards), 1)
+
+
+class SocketChannel(object):
+    """
+    用 socketpair 的一端代替 paramiko channel
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        try:
+            return self.sock.recv(size)
+        except BlockingIOError:
+            return b''
+
+    def recv_ready(self):
+        import select
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+
+class SessionThreadTest(SimpleTestCase):
+    """
+    读取状态只在轮询线程中修改
+    """
+    def setUp(self):
+        from apps.terminal import ssh_session
+        from apps.terminal.ssh_poller import SSHPollerGroup
+
+        group = SSHPollerGroup(shards=1)
+        self.poller = group.shards[0]
+        patcher = mock.patch.object(ssh_session, 'ssh_pollers', group)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ssh_session.monitor_hub, 'unregister')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        sock, self.server = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(self.server.close)
+        self.channel = SocketChannel(sock)
+        self.session = ssh_session.TerminalSession(
+            SimpleNamespace(id=1, username='alice'), SimpleNamespace(id=2, ip='127.0.0.1'), SimpleNamespace(id=3)
+        )
+        self.session.ssh = mock.Mock(ssh_channel=self.channel)
+        self.session.reader.start()
+
+    def output(self, data):
+        self.server.send(data)
+        deadline = time.time() + 5
+        while data not in self.session.scrollback.snapshot() and time.time() < deadline:
+            time.sleep(0.01)
+        self.session.reader.run_sync(self.session.reader.flush)
+
+    def test_teardown_stops_reader_in_poller_thread(self):
+        threads = []
+        self.session.record = lambda events: threads.append(threading.current_thread().name)
+        self.output(b'$ ls\r\n')
+        self.session.terminate()
+        self.assertTrue(self.session.reader.closed)
+        self.assertEqual(threads, [self.poller.name])
+        self.assertEqual(len(self.poller), 0)
+
+    def test_attach_replays_in_poller_thread(self):
+        self.output(b'$ ls\r\n')
+        ws = mock.Mock(binary_output=False)
+        threads = []
+        ws.send.side_effect = lambda **kwargs: threads.append(threading.current_thread().name)
+        self.assertTrue(self.session.attach(ws))
+        self.assertIs(self.session.ws, ws)
+        self.assertEqual(threads, [self.poller.name])
+        self.assertEqual(json.loads(ws.send.call_args[1]['text_data'])['message'], '$ ls\r\n')
+
+        self.session.terminate()
+        self.assertFalse(self.session.attach(mock.Mock()))
+
+    def test_read_error_closes_session_off_poller(self):
+        threads = []
+        done = threading.Event()
+        self.session.ssh.close.side_effect = lambda: (threads.append(threading.current_thread().name), done.set())
+        with mock.patch.object(self.session.reader, 'handle_output', side_effect=ValueError('bad output')):
+            self.server.send(b'x')
+            self.assertTrue(done.wait(5))
+        self.assertTrue(self.session.closed)
+        self.assertTrue(self.session.reader.closed)
+        self.assertTrue(threads[0].startswith('terminal-teardown'))
+        self.assertEqual(len(self.poller), 0)
+
+    def test_reject_command_records_in_poller_thread(self):
+        threads = []
+        append = self.session.reader.stdout_append
+        self.session.reader.stdout_append = lambda event: (threads.append(threading.current_thread().name), append(event))
+        self.session.reject_command('blocked')
+        self.session.reader.run_sync(lambda: None)
+        self.assertEqual(threads, [self.poller.name])
+        self.assertEqual(self.session.reader.stdout[-1][2], '\r\nblocked\r\n')
+
+
+class CastzTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.src = os.path.join(self.tmp, 'a.cast')
+        with open(self.src, 'w') as f:
+            f.write(json.dumps({'version': 2, 'width': 80, 'height': 24}) + '\n')
+            for i in range(2000):
+                f.write(json.dumps([i * 0.1, 'o', 'line {}\r\n'.format(i)]) + '\n')
+
+    def test_convert_twice_overwrites(self):
+        from apps.utils.cast_format import CastzReader, cast_to_castz
+
+        dst = os.path.join(self.tmp, 'a.castz')
+        cast_to_castz(self.src, dst)
+        size = os.path.getsize(dst)
+        cast_to_castz(self.src, dst)
+        self.assertEqual(os.path.getsize(dst), size)
+        reader = CastzReader.open(dst)
+        try:
+            events = list(reader.events())
+        finally:
+            reader.close()
+        self.assertEqual(len(events), 2000)
+        self.assertEqual(events[-1][2], 'line 1999\r\n')
+
+
+class SSHBannerTest(SimpleTestCase):
+    def test_banner_goes_through_session_output(self):
+        from apps.common.consts import WsCode
+        from apps.terminal.ssh_session import TerminalSession
+        from apps.utils import ssh_client
+        from apps.utils.ws_data_format import WsDataFormat
+
+        session = TerminalSession(
+            SimpleNamespace(id=1, username='alice'), SimpleNamespace(id=2, ip='127.0.0.1'), SimpleNamespace(id=3)
+        )
+        session.ws = mock.Mock(binary_output=True)
+        channel = mock.Mock()
+        # 多字节字符被切断在两次读取之间
+        channel.recv.side_effect = [b'Welcome \xe4\xbd', b'\xa0\xe5\xa5\xbd\r\n$ ']
+        pool = mock.Mock()
+        pool.acquire.return_value.open_session.return_value = channel
+        client = ssh_client.SSHClient('web-1', 22, 'root', 'x', ip='127.0.0.1', websocket=session)
+        with mock.patch.object(ssh_client, 'transport_pool', pool):
+            client.ssh_connect()
+
+        sent = [c[1]['bytes_data'] for c in session.ws.send.call_args_list]
+        self.assertEqual(sent, [
+            WsDataFormat.pack(WsCode.TEXT.value, data=b'Welcome \xe4\xbd'),
+            WsDataFormat.pack(WsCode.TEXT.value, data=b'\xa0\xe5\xa5\xbd\r\n$ '),
+        ])
+        self.assertEqual(session.scrollback.snapshot(), 'Welcome 你好\r\n$ '.encode())
+        self.assertEqual(''.join(event[2] for event in session.reader.stdout), 'Welcome 你好\r\n$ ')
+
+
+class LineEditorTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils.line_editor import LineEditor
+
+        self.commands = []
+        self.editor = LineEditor(on_command=self.commands.append)
+
+    def test_enter_completes_command(self):
+        self.editor.feed_input('ls -la')
+        self.assertEqual(self.editor.current, 'ls -la')
+        self.editor.feed_input('\r')
+        self.editor.feed_input('  \r')
+        self.assertEqual(self.commands, ['ls -la'])
+        self.assertEqual(self.editor.current, '')
+
+    def test_cursor_movement(self):
+        editor = self.editor
+        editor.feed_input('ls')
+        editor.feed_input('\x1b[D')
+        editor.feed_input('x')
+        self.assertEqual(editor.current, 'lxs')
+        # ctrl+a / ctrl+e
+        editor.feed_input('\x01sudo \x05 /tmp')
+        self.assertEqual(editor.current, 'sudo lxs /tmp')
+        # home / end / ctrl+b / ctrl+f / →
+        editor.feed_input('\x1b[H\x06\x06\x06\x06\x06\x06\x1b[C\x7f')
+        self.assertEqual(editor.current, 'sudo ls /tmp')
+        editor.feed_input('\x1b[F\x02\x02\x02\x02\x1b[3~\x04')
+        self.assertEqual(editor.current, 'sudo ls mp')
+        editor.feed_input('\x1bOF/')
+        self.assertEqual(editor.current, 'sudo ls mp/')
+
+    def test_kill_keys(self):
+        editor = self.editor
+        editor.feed_input('git commit -m  ')
+        editor.feed_input('\x17')
+        self.assertEqual(editor.current, 'git commit ')
+        editor.feed_input('\x01\x06\x06\x06\x0b')
+        self.assertEqual(editor.current, 'git')
+        editor.feed_input('status\x02\x02\x15')
+        self.assertEqual(editor.current, 'us')
+        editor.feed_input('\x03')
+        self.assertEqual(editor.current, '')
+
+    def test_history_recall(self):
+        editor = self.editor
+        editor.feed_input('cat')
+        editor.feed_input('\x1b[A')
+        # 上一条命令覆盖当前行
+        editor.feed_output('\x08\x08\x08ls -la')
+        self.assertEqual(editor.current, 'ls -la')
+        editor.feed_input('\x1b[A')
+        editor.feed_output('\x08\x08\x08\x08\x08\x08pwd\x1b[K')
+        editor.feed_input('\r')
+        self.assertEqual(self.commands, ['pwd'])
+        # 没有按键时的输出不改变命令行
+        editor.feed_input('ls')
+        editor.feed_output('xx')
+        self.assertEqual(editor.current, 'ls')
+
+    def test_tab_completion(self):
+        editor = self.editor
+        editor.feed_input('cd /e\t')
+        editor.feed_output('tc/')
+        self.assertEqual(editor.current, 'cd /etc/')
+        # 多个候选时输出候选列表, 不改变当前行
+        editor.feed_input('sys\t')
+        editor.feed_output('\r\nsysconfig/  sysctl.conf\r\n$ cd /etc/sys')
+        self.assertEqual(editor.current, 'cd /etc/sys')
+        # 补全在行中间插入
+        editor.feed_input('\x01\x06\x06\x06\t')
+        editor.feed_output('\x1b[4@tmp/')
+        self.assertEqual(editor.current, 'cd tmp//etc/sys')
+
+    def test_multibyte(self):
+        editor = self.editor
+        editor.feed_input('echo 你好')
+        editor.feed_input('\x1b[D们')
+        self.assertEqual(editor.current, 'echo 你们好')
+        editor.feed_input('\x7f\x7f')
+        self.assertEqual(editor.current, 'echo 好')
+        editor.feed_input('\r')
+        self.assertEqual(self.commands, ['echo 好'])
+
+    def test_alt_screen(self):
+        editor = self.editor
+        editor.feed_input('vi a.txt\r')
+        editor.feed_output('\x1b[?1049h\x1b[1;1H')
+        self.assertTrue(editor.alt_screen)
+        editor.feed_input('dd\r:wq')
+        self.assertEqual(self.commands, ['vi a.txt'])
+        editor.feed_output('\x1b[?1049l')
+        self.assertFalse(editor.alt_screen)
+        self.assertEqual(editor.current, '')
+        editor.feed_input('ls\r')
+        self.assertEqual(self.commands, ['vi a.txt', 'ls'])
+
+    def test_gap_buffer_grows(self):
+        from apps.utils.line_editor import GapBuffer
+
+        line = GapBuffer(capacity=4)
+        line.insert('a' * 100)
+        line.move_to(50)
+        line.insert('b' * 100)
+        self.assertEqual(str(line), 'a' * 50 + 'b' * 100 + 'a' * 50)
+        self.assertEqual((len(line), line.cursor), (200, 150))
+        line.move_to(1000)
+        self.assertEqual(line.delete_before(3), 3)
+        self.assertEqual(line.delete_after(3), 0)
+        self.assertEqual(len(line), 197)
+
+
+@unittest.skipIf(local_redis is None, 'local redis is not available')
+class SessionRegistryTest(SimpleTestCase):
+    def setUp(self):
+        from apps.terminal import session_registry as registry
+
+        self.registry_module = registry
+        for patcher in (
+            mock.patch.object(registry, 'default_redis', local_redis),
+            mock.patch.object(registry.SessionRegistry, 'check'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.clear)
+        self.clear()
+        self.registry = registry.SessionRegistry()
+
+    def clear(self):
+        keys = list(local_redis.scan_iter(match='terminal:session*'))
+        if keys:
+            local_redis.delete(*keys)
+
+    def make_session(self, token, user_id=1, asset_id=1):
+        return SimpleNamespace(
+            token=token, protocol='ssh', start_time=time.time(), bytes_in=0, bytes_out=0,
+            user=SimpleNamespace(id=user_id, username='u{}'.format(user_id)),
+            asset=SimpleNamespace(id=asset_id, hostname='h{}'.format(asset_id), ip='10.0.0.{}'.format(asset_id)),
+            account=SimpleNamespace(username='root'),
+        )
+
+    def test_register_and_unregister(self):
+        s1, s2 = self.make_session('t1'), self.make_session('t2', user_id=2)
+        self.registry.register(s1)
+        self.registry.register(s2)
+        self.assertEqual(self.registry.count(), 2)
+        self.assertEqual(self.registry.count(user_id=2), 1)
+        self.assertEqual(self.registry.count(asset_id=1), 2)
+        self.assertEqual(self.registry.count(node=self.registry_module.NODE_NAME), 2)
+        self.assertEqual([row['token'] for row in self.registry.query(user_id=2)], ['t2'])
+        self.registry.unregister(s1)
+        # 重复注销不影响计数
+        self.registry.unregister(s1)
+        self.assertEqual(self.registry.count(), 1)
+        self.assertEqual(self.registry.count(user_id=1), 0)
+        self.assertEqual(int(local_redis.get(self.registry_module.ONLINE_CONNECTION_COUNT)), 1)
+
+    def test_crashed_process_sessions_expire(self):
+        registry = self.registry_module
+        self.registry.register(self.make_session('alive'))
+        # 已崩溃进程登记的会话, 最后一次心跳早于 SESSION_TTL
+        stale = time.time() - registry.SESSION_TTL - 1
+        for key in (registry.SESSIONS_KEY, registry.USER_SESSIONS_KEY.format(1), registry.ASSET_SESSIONS_KEY.format(1)):
+            local_redis.zadd(key, {'crashed': stale})
+        self.assertEqual(self.registry.count(user_id=1), 1)
+        self.assertEqual([row['token'] for row in self.registry.query(asset_id=1)], ['alive'])
+        self.registry.heartbeat()
+        self.assertEqual(self.registry.count(), 1)
+        self.assertIsNone(local_redis.zscore(registry.SESSIONS_KEY, 'crashed'))
+
+    def test_admit(self):
+        registry = self.registry_module
+        self.registry.register(self.make_session('t1'))
+        self.assertIsNone(self.registry.admit(1, 1))
+        with mock.patch.object(registry, 'MAX_SESSIONS_PER_USER', 1):
+            self.assertIsNotNone(self.registry.admit(1, 2))
+            self.assertIsNone(self.registry.admit(2, 1))
+            # 断线重连的会话自己不计入
+            self.assertIsNone(self.registry.admit(1, 1, token='t1'))
+        with mock.patch.object(registry, 'MAX_SESSIONS_PER_ASSET', 1):
+            self.assertIsNotNone(self.registry.admit(2, 1))
+            local_redis.zadd(registry.ASSET_SESSIONS_KEY.format(1), {'t1': time.time() - registry.SESSION_TTL - 1})
+            # 超时的条目不计入
+            self.assertIsNone(self.registry.admit(2, 1))
+
+
+class FloodControlTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils import flood_control
+
+        self.now = 1000.0
+        patcher = mock.patch.object(flood_control, 'time', SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.flood = flood_control.FloodControl(cols=40, rows=5, threshold=1000)
+
+    def test_enter_threshold(self):
+        self.assertFalse(self.flood.check(100))
+        self.assertTrue(self.flood.check(600))
+        self.flood.start()
+        # 已经在刷屏模式中不再重复进入
+        self.assertFalse(self.flood.check(600))
+        self.assertEqual(self.flood.floods, 1)
+
+    def test_exit_hysteresis(self):
+        from apps.utils import flood_control
+
+        self.flood.check(700)
+        self.flood.start()
+        # 速率低于进入阈值, 但没有低于退出阈值
+        self.now += 0.5
+        self.assertLess(self.flood.meter.rate(), self.flood.threshold)
+        self.assertFalse(self.flood.should_exit())
+        self.now += 1
+        self.assertFalse(self.flood.should_exit())
+        # 保持期间又有输出, 重新计时
+        self.now += flood_control.FLOOD_EXIT_HOLD - 0.5
+        self.flood.check(200)
+        self.assertFalse(self.flood.should_exit())
+        self.now += 2
+        self.assertFalse(self.flood.should_exit())
+        self.now += flood_control.FLOOD_EXIT_HOLD - 0.2
+        self.assertFalse(self.flood.should_exit())
+        self.now += 0.4
+        self.assertTrue(self.flood.should_exit())
+        self.flood.exit()
+        self.assertFalse(self.flood.active)
+        self.assertIsNone(self.flood.stream)
+
+    @unittest.skipIf(pyte is None, 'pyte is not installed')
+    def test_output_bounded_by_screen(self):
+        flood = self.flood
+        flood.start(b'$ yes\r\n')
+        text = ''.join('line {}\r\n'.format(i) for i in range(100000))
+        flood.feed(text)
+        self.assertEqual(flood.suppressed, len(text))
+        frame = flood.render()
+        # 第一帧为整屏
+        self.assertIn('\x1b[2J', frame)
+        self.assertIn('line 99999', frame)
+        self.assertNotIn('line 99000', frame)
+        self.assertLess(len(frame), flood.cols * flood.rows * 2)
+        # 之后只发送变化的行
+        flood.feed('abc')
+        frame = flood.render()
+        self.assertNotIn('\x1b[2J', frame)
+        self.assertIn('abc', frame)
+        self.assertEqual(flood.render(), '')
+
+    def test_output_bounded_without_pyte(self):
+        from apps.utils import flood_control
+
+        with mock.patch.object(flood_control, 'pyte', None):
+            self.flood.start()
+        text = ''.join('line {}\r\n'.format(i) for i in range(100000))
+        self.flood.feed(text)
+        frame = self.flood.render()
+        self.assertLessEqual(len(frame), flood_control.FLOOD_TAIL_BYTES)
+        # 从一行的开头开始
+        self.assertTrue(frame.startswith('line '))
+        self.assertTrue(frame.endswith('line 99999\r\n'))
+        self.assertEqual(self.flood.render(), '')
+
+
+class MinioManagerCacheTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils import minio_tool
+
+        self.minio_tool = minio_tool
+        self.now = 1000.0
+        patcher = mock.patch.object(minio_tool, 'time', SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = minio_tool.MinioManager(
+            endpoint='127.0.0.1:9000', access_key='key', secret_key='secret', bucket_cache_ttl=60
+        )
+        self.manager.client = mock.Mock()
+
+    def test_bucket_cache(self):
+        client = self.manager.client
+        client.bucket_exists.return_value = True
+        self.assertTrue(self.manager.check_exists('record'))
+        self.now += 59
+        self.assertTrue(self.manager.check_exists('record'))
+        self.assertEqual(client.bucket_exists.call_count, 1)
+        self.now += 2
+        self.assertTrue(self.manager.check_exists('record'))
+        self.assertEqual(client.bucket_exists.call_count, 2)
+
+    def test_missing_bucket_not_cached(self):
+        client = self.manager.client
+        client.bucket_exists.return_value = False
+        self.assertFalse(self.manager.check_exists('new'))
+        client.bucket_exists.return_value = True
+        self.assertTrue(self.manager.check_exists('new'))
+        self.assertEqual(client.bucket_exists.call_count, 2)
+
+    def test_presign_cache(self):
+        client = self.manager.client
+        client.presigned_get_object.side_effect = lambda bucket, name, expires: '{}/{}?t={}'.format(
+            bucket, name, self.now
+        )
+        url = self.manager.presigned_url('record', 'a.cast', expires=100)
+        self.now += 79
+        self.assertEqual(self.manager.presigned_url('record', 'a.cast', expires=100), url)
+        self.assertEqual(client.presigned_get_object.call_count, 1)
+        # 剩余有效期不足 PRESIGN_MARGIN 时重新生成
+        self.now += 2
+        self.assertNotEqual(self.manager.presigned_url('record', 'a.cast', expires=100), url)
+        # 有效期不同的地址分别缓存
+        self.manager.presigned_url('record', 'a.cast', expires=3600)
+        self.assertEqual(client.presigned_get_object.call_count, 3)
+
+    def test_presign_cache_evicts_oldest(self):
+        client = self.manager.client
+        client.presigned_get_object.side_effect = lambda bucket, name, expires: name
+        with mock.patch.object(self.minio_tool, 'PRESIGN_CACHE_SIZE', 2):
+            for name in ('a', 'b', 'a', 'c', 'a', 'b'):
+                self.manager.presigned_url('record', name)
+        # b 在 c 加入时被淘汰, a 一直是最近使用的
+        self.assertEqual([c[0][1] for c in client.presigned_get_object.call_args_list], ['a', 'b', 'c', 'b'])
+        self.assertEqual(len(self.manager._presigned), 2)
+
+    def test_stream_object(self):
+        response = mock.Mock()
+        response.stream.return_value = iter([b'ab', b'cd', b'ef'])
+        self.manager.client.get_object.return_value = response
+        chunks = self.manager.stream_object('record', 'a.cast', offset=10, length=6, chunk_size=2)
+        self.assertEqual(next(chunks), b'ab')
+        self.manager.client.get_object.assert_called_once_with('record', 'a.cast', offset=10, length=6)
+        response.stream.assert_called_once_with(2)
+        response.release_conn.assert_not_called()
+        # 调用方中途停止时归还连接
+        chunks.close()
+        response.close.assert_called_once_with()
+        response.release_conn.assert_called_once_with()
+
+    def test_stream_object_to_end(self):
+        response = mock.Mock()
+        response.stream.return_value = iter([b'ab', b'cd'])
+        self.manager.client.get_object.return_value = response
+        self.assertEqual(b''.join(self.manager.stream_object('record', 'a.cast')), b'abcd')
+        self.manager.client.get_object.assert_called_once_with('record', 'a.cast', offset=0, length=0)
+        response.release_conn.assert_called_once_with()
+
+
+class OutputCoalescerTest(SimpleTestCase):
+    def setUp(self):
+        from apps.utils import output_coalescer
+
+        patcher = mock.patch.object(output_coalescer, 'coalesce_stats', output_coalescer.CoalesceStats())
+        self.stats = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.coalescer = output_coalescer.OutputCoalescer(latency=0.005, max_bytes=8)
+
+    def test_merge_chunks(self):
+        coalescer = self.coalescer
+        self.assertIsNone(coalescer.pop())
+        self.assertTrue(coalescer.append(b'ab'))
+        first_time = coalescer.first_time
+        # 只有每帧的第一块数据需要启动定时器
+        self.assertFalse(coalescer.append(b'cd'))
+        self.assertFalse(coalescer.append(b'e'))
+        self.assertEqual(coalescer.first_time, first_time)
+        self.assertEqual(len(coalescer), 5)
+        self.assertEqual(coalescer.pop(), b'abcde')
+        self.assertEqual(len(coalescer), 0)
+        self.assertIsNone(coalescer.pop())
+        self.assertTrue(coalescer.append('中文'))
+        self.assertEqual(coalescer.pop(), '中文')
+
+    def test_full(self):
+        coalescer = self.coalescer
+        coalescer.append(b'1234567')
+        self.assertFalse(coalescer.full)
+        coalescer.append(b'8')
+        self.assertTrue(coalescer.full)
+        coalescer.pop()
+        self.assertFalse(coalescer.full)
+
+    def test_stats(self):
+        coalescer = self.coalescer
+        self.assertEqual(coalescer.merge_ratio, 0)
+        for chunk in (b'a', b'b', b'c'):
+            coalescer.append(chunk)
+        coalescer.pop()
+        coalescer.append(b'd')
+        coalescer.pop()
+        self.assertEqual(coalescer.as_dict(), {'chunks': 4, 'frames': 2, 'bytes': 4, 'merge_ratio': 2.0})
+        # 进程内的合并计数
+        self.assertEqual(self.stats.as_dict(), coalescer.as_dict())
@@ -0,0 +1,10 @@
+from django.urls import path
+
+from apps.terminal.views import RecordPlaybackSeekView, RecordPlaybackStreamView, RecordingSpoolView, SessionSearchView
+
+urlpatterns = [
+    path('playback/<int:pk>/seek/', RecordPlaybackSeekView.as_view(), name='playback-seek'),
+    path('playback/<int:pk>/stream/', RecordPlaybackStreamView.as_view(), name='playback-stream'),
+    path('sessions/search/', SessionSearchView.as_view(), name='session-search'),
+    path('recordings/spool/', RecordingSpoolView.as_view(), name='recording-spool'),
+]
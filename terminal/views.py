@@ -0,0 +1,168 @@
+import re
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from apps.audits.serializers.file_serializer import VideoPlaybackSerializer
+from apps.terminal.guacd_recording import GZIP_SUFFIX
+from apps.terminal.playback import RecordPlayback, SEEK_DURATION, URL_EXPIRES, chunk_cache, is_asciicast
+from apps.utils.minio_tool import minio_manager
+from apps.utils.recording_spool import recording_spool
+from apps.utils.session_index import session_search
+from rzx_jms import settings
+
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def is_auditor(user):
+    """
+    是否可以查看所有人的会话录像和检索结果
+    """
+    return user.is_superuser or user.has_perm('terminal.terminal_audit')
+
+
+def get_playback(request, pk):
+    """
+    取得回放记录, 没有审计权限的用户只能打开自己会话的录像, 其它录像返回 404
+    """
+    queryset = VideoPlaybackSerializer.Meta.model.objects.all()
+    if not is_auditor(request.user):
+        queryset = queryset.filter(user_id=request.user.id)
+    return get_object_or_404(queryset, pk=pk)
+
+
+def parse_range(header, size):
+    """
+    解析单个 Range: bytes=a-b / bytes=a- / bytes=-n
+    :return: (start, end) end 不含; 没有 Range 时返回 None; 范围无效时返回 ()
+    """
+    if not header:
+        return None
+    match = RANGE_HEADER.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return ()
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        return ()
+    return start, end
+
+
+class RecordPlaybackSeekView(APIView):
+    """
+    录像跳转: GET ?time=秒&duration=秒
+    返回最近的关键帧和之后的事件, 跳转耗时与录像长度无关
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, pk):
+        video = get_playback(request, pk)
+        if not is_asciicast(video.filename):
+            return Response({'detail': 'recording does not support seeking'}, status=400)
+        try:
+            timestamp = float(request.query_params.get('time', 0))
+            duration = float(request.query_params.get('duration', SEEK_DURATION))
+        except ValueError:
+            return Response({'detail': 'invalid time'}, status=400)
+        return Response(RecordPlayback(video.filename).seek(timestamp, duration))
+
+
+class RecordPlaybackStreamView(APIView):
+    """
+    录像流式回放:
+        GET ?start=秒&end=秒  截取时间段为独立的 asciicast, 从最近的关键帧开始, 打开大录像不用下载整个文件
+        GET ?url=1           返回存储库的预签名地址, 浏览器直接从存储库按范围读取, 只对审计用户开放:
+                             地址在有效期内不经过鉴权即可访问, 不能交给普通用户
+        GET Range: bytes=a-b  按字节范围读取录像, 返回 206, 读取经过热点块缓存
+    guacd 的 RDP/VNC 录像(.gz)只能整个读取: 以 Content-Encoding: gzip 返回压缩后的数据, 不支持按时间截取和按范围读取
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, pk):
+        video = get_playback(request, pk)
+        params = request.query_params
+        bucket_name = settings.MINIO_BUCKET_NAME
+        if params.get('url'):
+            if not is_auditor(request.user):
+                return Response({'detail': 'permission denied'}, status=403)
+            return Response({
+                'url': minio_manager.presigned_url(bucket_name, video.filename, URL_EXPIRES),
+                'expires': URL_EXPIRES,
+            })
+        compressed = video.filename.endswith(GZIP_SUFFIX)
+        if 'start' in params:
+            if not is_asciicast(video.filename):
+                return Response({'detail': 'recording does not support clipping'}, status=400)
+            try:
+                start = float(params['start'])
+                end = float(params['end']) if params.get('end') else None
+            except ValueError:
+                return Response({'detail': 'invalid time'}, status=400)
+            return HttpResponse(
+                RecordPlayback(video.filename).clip(start, end), content_type='application/x-asciicast'
+            )
+        size = chunk_cache.size(bucket_name, video.filename)
+        # 压缩数据的部分范围无法单独解压, 忽略 Range 返回整个录像
+        byte_range = None if compressed else parse_range(request.META.get('HTTP_RANGE'), size)
+        if byte_range == ():
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        start, end = byte_range or (0, size)
+        response = StreamingHttpResponse(
+            chunk_cache.iter_range(bucket_name, video.filename, start, end),
+            status=206 if byte_range else 200, content_type='application/octet-stream'
+        )
+        if byte_range:
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+        response['Content-Length'] = end - start
+        if compressed:
+            response['Content-Encoding'] = 'gzip'
+            response['Accept-Ranges'] = 'none'
+        else:
+            response['Accept-Ranges'] = 'bytes'
+        return response
+
+
+class SessionSearchView(APIView):
+    """
+    会话全文检索: GET ?q=查询语句&field=o|c&user_id=&asset_id=&start=&end=&offset=&limit=
+    q 中空格分隔的词之间为 AND, 双引号括起来的是短语; field 为 o 只查输出, c 只查命令
+    没有审计权限的用户只能检索自己的会话, user_id 参数被忽略
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        params = request.query_params
+        user_id = (params.get('user_id') or None) if is_auditor(request.user) else request.user.id
+        try:
+            total, docs = session_search.search(
+                params.get('q', ''),
+                field=params.get('field') or None,
+                user_id=user_id,
+                asset_id=params.get('asset_id') or None,
+                start=float(params['start']) if params.get('start') else None,
+                end=float(params['end']) if params.get('end') else None,
+                offset=int(params.get('offset', 0)),
+                limit=min(int(params.get('limit', 50)), 500),
+            )
+        except ValueError:
+            return Response({'detail': 'invalid params'}, status=400)
+        return Response({'count': total, 'results': docs})
+
+
+class RecordingSpoolView(APIView):
+    """
+    本节点录像上传队列的积压情况: 待上传数、失败次数、上传延迟、占用的磁盘空间
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(recording_spool.metrics())
@@ -0,0 +1,341 @@
+"""
+可跳转的压缩录像格式(.castz)
+
+录像文件由若干个独立压缩的帧首尾相连组成, 每帧是一段连续的 asciicast v2 事件(JSON 行):
+    第 0 帧只有文件头, 之后每帧最多 FRAME_SECONDS 秒或 FRAME_BYTES 字节的事件
+gzip 帧就是一个完整的 gzip member, 整个文件可以直接 zcat 成普通 .cast; 安装了 zstandard 时可选 zstd 帧
+同名的 .idx 文件是时间索引, 每帧一行 [起始时间, 文件偏移, 压缩后长度, 事件数],
+播放器按时间找到对应的帧, 只解压这一帧及之后的数据, 不需要从头解压
+索引丢失(如进程崩溃)时可以顺序扫描帧重建
+"""
+import bisect
+import json
+import os
+import sys
+import time
+import zlib
+
+from rzx_jms import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 每帧最长时间跨度(秒)和最大原始字节数, 超过后结束当前帧
+FRAME_SECONDS = getattr(settings, 'TERMINAL_RECORD_FRAME_SECONDS', 10)
+FRAME_BYTES = getattr(settings, 'TERMINAL_RECORD_FRAME_BYTES', 1024 * 1024)
+# 压缩算法: gzip 或 zstd(需要安装 zstandard, 未安装时使用 gzip)
+FRAME_CODEC = getattr(settings, 'TERMINAL_RECORD_CODEC', 'gzip')
+COMPRESS_LEVEL = getattr(settings, 'TERMINAL_RECORD_COMPRESS_LEVEL', 6)
+
+CASTZ_SUFFIX = '.castz'
+INDEX_SUFFIX = '.idx'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def compress_frame(data, codec=FRAME_CODEC, level=COMPRESS_LEVEL):
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # wbits=31: 带 gzip 头和尾, 每帧是一个独立的 gzip member
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_frame(data):
+    """
+    :return: (解压后的数据, 帧之后剩余的字节)
+    """
+    if data[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError('zstd frame found but zstandard is not installed')
+        obj = zstandard.ZstdDecompressor().decompressobj()
+        return obj.decompress(data), obj.unused_data
+    obj = zlib.decompressobj(31)
+    return obj.decompress(data), obj.unused_data
+
+
+class PlainCastSink(object):
+    """
+    普通 .cast 文件(JSON 行)
+    local_size 为本地文件当前的字节数, rotate 把已写入的内容移到另一个文件(用于分片上传), 之后从空文件继续写
+    """
+    mode = 'a'
+
+    def __init__(self, path, header):
+        self.path = path
+        self.fd = open(path, self.mode)
+        self.local_size = 0
+        self._write(json.dumps(header) + '\n')
+
+    def _write(self, data):
+        self.fd.write(data)
+        self.local_size += len(data)
+
+    def write(self, events):
+        self._write(''.join(json.dumps(event) + '\n' for event in events))
+
+    def rotate(self, new_path):
+        self.fd.flush()
+        self.fd.close()
+        os.rename(self.path, new_path)
+        self.fd = open(self.path, self.mode)
+        self.local_size = 0
+
+    def flush(self, fsync=False):
+        self.fd.flush()
+        if fsync:
+            os.fsync(self.fd.fileno())
+
+    def close(self, fsync=False):
+        self.flush(fsync)
+        self.fd.close()
+
+
+class CastzWriter(PlainCastSink):
+    """
+    写 .castz 文件, 接口与 PlainCastSink 相同
+    当前帧在内存中累积, 满 FRAME_SECONDS 秒或 FRAME_BYTES 字节后压缩写入, flush 只落盘已经完成的帧
+    索引从文件开头描述每一帧, 打开时清空已有的文件, 不能追加到旧内容之后
+    """
+    mode = 'wb'
+
+    def __init__(self, path, header, codec=FRAME_CODEC, frame_seconds=FRAME_SECONDS, frame_bytes=FRAME_BYTES):
+        self.path = path
+        self.codec = codec
+        self.frame_seconds = frame_seconds
+        self.frame_bytes = frame_bytes
+        self.fd = open(path, self.mode)
+        self.index_fd = open(index_path(path), 'w')
+        self.local_size = 0
+        self.offset = 0
+        self.raw_bytes = 0
+        self._lines = []
+        self._size = 0
+        self._count = 0
+        self._start = None
+        self._write_frame([json.dumps(header) + '\n'], 0, 0)
+
+    def _write_frame(self, lines, start, count):
+        data = ''.join(lines).encode('utf-8')
+        frame = compress_frame(data, self.codec)
+        self._write(frame)
+        self.index_fd.write(json.dumps([start, self.offset, len(frame), count]) + '\n')
+        self.offset += len(frame)
+        self.raw_bytes += len(data)
+
+    def _end_frame(self):
+        if not self._lines:
+            return
+        self._write_frame(self._lines, self._start, self._count)
+        self._lines = []
+        self._size = 0
+        self._count = 0
+        self._start = None
+
+    def write(self, events):
+        for event in events:
+            if self._start is not None and event[0] - self._start >= self.frame_seconds:
+                self._end_frame()
+            if self._start is None:
+                self._start = event[0]
+            line = json.dumps(event) + '\n'
+            self._lines.append(line)
+            self._size += len(line)
+            self._count += 1
+            if self._size >= self.frame_bytes:
+                self._end_frame()
+
+    def flush(self, fsync=False):
+        self.fd.flush()
+        self.index_fd.flush()
+        if fsync:
+            os.fsync(self.fd.fileno())
+            os.fsync(self.index_fd.fileno())
+
+    def close(self, fsync=False):
+        self._end_frame()
+        self.flush(fsync)
+        self.fd.close()
+        self.index_fd.close()
+
+
+def open_sink(path, header, fmt):
+    """
+    :param fmt: cast 或 castz
+    """
+    if fmt == 'castz':
+        return CastzWriter(path, header)
+    return PlainCastSink(path, header)
+
+
+def build_index(fd):
+    """
+    顺序扫描各帧重建索引
+    :param fd: 以二进制方式打开的 .castz 文件
+    :return: [[起始时间, 偏移, 长度, 事件数], ...]
+    """
+    fd.seek(0)
+    data = fd.read()
+    index = []
+    offset = 0
+    while offset < len(data):
+        raw, rest = decompress_frame(data[offset:])
+        length = len(data) - offset - len(rest)
+        lines = raw.decode('utf-8').splitlines()
+        start = 0 if not index else json.loads(lines[0])[0]
+        index.append([start, offset, length, 0 if not index else len(lines)])
+        offset += length
+    return index
+
+
+class CastzReader(object):
+    """
+    读 .castz 文件, 按时间跳转
+    :param fd: 以二进制方式打开的文件(本地文件或支持 seek/read 的对象)
+    :param index: 索引, 不传时从 .idx 文件读取, 都没有时扫描重建
+    """
+    def __init__(self, fd, index=None):
+        self.fd = fd
+        if index is None:
+            index = self.load_index(getattr(fd, 'name', None))
+        if index is None:
+            index = build_index(fd)
+        self.index = index
+        self._times = [item[0] for item in index[1:]]
+        self.header = json.loads(self.read_frame(0)[0])
+
+    @staticmethod
+    def load_index(path):
+        if not path or not os.path.exists(index_path(path)):
+            return None
+        with open(index_path(path)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    @classmethod
+    def open(cls, path):
+        return cls(open(path, 'rb'))
+
+    def close(self):
+        self.fd.close()
+
+    @property
+    def duration(self):
+        return self._times[-1] if self._times else 0
+
+    def read_frame(self, i):
+        _, offset, length, _ = self.index[i]
+        self.fd.seek(offset)
+        raw, _ = decompress_frame(self.fd.read(length))
+        return raw.decode('utf-8').splitlines()
+
+    def events(self, start=0, end=None):
+        """
+        :param start: 起始时间(秒), 从包含该时间的帧开始解压
+        :param end: 结束时间(秒)
+        :return: 事件迭代器
+        """
+        i = max(bisect.bisect_right(self._times, start), 1)
+        for n in range(i, len(self.index)):
+            if end is not None and self.index[n][0] > end:
+                return
+            for line in self.read_frame(n):
+                event = json.loads(line)
+                if event[0] < start:
+                    continue
+                if end is not None and event[0] > end:
+                    return
+                yield event
+
+
+    def events_from(self, seq):
+        """
+        :param seq: 事件序号(不含文件头), 按索引中每帧的事件数直接定位到所在的帧
+        :return: (序号, 事件) 迭代器
+        """
+        first = 0
+        for n in range(1, len(self.index)):
+            count = self.index[n][3]
+            if first + count <= seq:
+                first += count
+                continue
+            for i, line in enumerate(self.read_frame(n)):
+                if first + i >= seq:
+                    yield first + i, json.loads(line)
+            first += count
+
+
+def cast_to_castz(src, dst, codec=FRAME_CODEC):
+    """
+    普通 .cast 转为 .castz
+    """
+    with open(src) as f:
+        header = json.loads(f.readline())
+        writer = CastzWriter(dst, header, codec=codec)
+        batch = []
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= 1000:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+        writer.close()
+
+
+def castz_to_cast(src, dst):
+    """
+    .castz 转为普通 .cast
+    """
+    reader = CastzReader.open(src)
+    try:
+        with open(dst, 'w') as f:
+            f.write(json.dumps(reader.header) + '\n')
+            for event in reader.events():
+                f.write(json.dumps(event) + '\n')
+    finally:
+        reader.close()
+
+
+def ratio_report(paths):
+    """
+    各压缩算法的压缩率和跳转耗时
+    """
+    tmp = '/tmp/cast_format_ratio{}'.format(os.getpid())
+    for path in paths:
+        size = os.path.getsize(path)
+        codecs = ['gzip'] + (['zstd'] if zstandard is not None else [])
+        for codec in codecs:
+            start = time.perf_counter()
+            cast_to_castz(path, tmp, codec=codec)
+            encode_time = time.perf_counter() - start
+            compressed = os.path.getsize(tmp) + os.path.getsize(index_path(tmp))
+            reader = CastzReader.open(tmp)
+            start = time.perf_counter()
+            next(reader.events(reader.duration * 0.9), None)
+            seek_time = time.perf_counter() - start
+            print('{} {}: {} -> {} bytes, ratio {:.1f}x, encode {:.2f}s, seek to 90% {:.1f}ms, frames {}'.format(
+                path, codec, size, compressed, size / compressed, encode_time, seek_time * 1000, len(reader.index)
+            ))
+            reader.close()
+            for name in (tmp, index_path(tmp)):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+if __name__ == "__main__":
+    # python cast_format.py ratio a.cast b.cast
+    # python cast_format.py encode a.cast a.castz
+    # python cast_format.py decode a.castz a.cast
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == 'ratio':
+        ratio_report(args)
+    elif command == 'encode':
+        cast_to_castz(args[0], args[1])
+    elif command == 'decode':
+        castz_to_cast(args[0], args[1])
@@ -0,0 +1,204 @@
+"""
+录像关键帧: 用无界面的终端模拟器(pyte)回放录像, 每隔 KEYFRAME_SECONDS 秒或 KEYFRAME_BYTES 字节输出保存一次屏幕状态
+跳转到任意时间只需要 "最近的关键帧 + 之后的少量事件", 耗时与录像长度无关
+
+关键帧文件(录像同名加 .kf, gzip 压缩的 JSON 行), 每行一个关键帧:
+    [时间, 下一个事件的序号, 下一个事件在 .cast 中的字节偏移(.castz 为 null), 列数, 行数, 屏幕内容]
+屏幕内容是一段终端控制序列, 写入空白终端即可还原当时的画面(字符、颜色、光标位置)
+"""
+import bisect
+import gzip
+import json
+
+from rzx_jms import settings
+
+try:
+    import pyte
+    from pyte.graphics import FG_ANSI, BG_ANSI, FG_AIXTERM, BG_AIXTERM
+except ImportError:
+    pyte = None
+
+KEYFRAME_SECONDS = getattr(settings, 'TERMINAL_KEYFRAME_SECONDS', 30)
+KEYFRAME_BYTES = getattr(settings, 'TERMINAL_KEYFRAME_BYTES', 256 * 1024)
+KEYFRAME_SUFFIX = '.kf'
+
+
+def keyframe_path(path):
+    return path + KEYFRAME_SUFFIX
+
+
+def _color_sgr(color, ansi, aixterm, base):
+    """
+    :param base: 38 前景色, 48 背景色
+    """
+    if color == 'default':
+        return None
+    for table in (ansi, aixterm):
+        for code, name in table.items():
+            if name == color:
+                return str(code)
+    if len(color) == 6:
+        try:
+            return '{};2;{};{};{}'.format(base, int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16))
+        except ValueError:
+            return None
+    return None
+
+
+def _sgr(char):
+    codes = ['0']
+    if char.bold:
+        codes.append('1')
+    if char.italics:
+        codes.append('3')
+    if char.underscore:
+        codes.append('4')
+    if char.reverse:
+        codes.append('7')
+    if char.strikethrough:
+        codes.append('9')
+    fg = _color_sgr(char.fg, FG_ANSI, FG_AIXTERM, 38)
+    bg = _color_sgr(char.bg, BG_ANSI, BG_AIXTERM, 48)
+    if fg:
+        codes.append(fg)
+    if bg:
+        codes.append(bg)
+    return '\x1b[{}m'.format(';'.join(codes))
+
+
+def render_line(screen, y):
+    """
+    一行的内容, 行尾的默认空白不输出
+    """
+    row = screen.buffer[y]
+    default = _sgr(screen.default_char)
+    end = screen.columns
+    while end > 0 and row[end - 1].data == ' ' and _sgr(row[end - 1]) == default:
+        end -= 1
+    out = []
+    last = None
+    for x in range(end):
+        char = row[x]
+        sgr = _sgr(char)
+        if sgr != last:
+            out.append(sgr)
+            last = sgr
+        out.append(char.data)
+    return ''.join(out)
+
+
+def render_cursor(screen):
+    out = '\x1b[0m\x1b[{};{}H'.format(screen.cursor.y + 1, screen.cursor.x + 1)
+    return out + ('\x1b[?25l' if screen.cursor.hidden else '\x1b[?25h')
+
+
+def render_screen(screen):
+    """
+    把屏幕状态编码成控制序列
+    """
+    out = ['\x1b[0m\x1b[2J']
+    for y in range(screen.lines):
+        line = render_line(screen, y)
+        if line:
+            out.append('\x1b[{};1H'.format(y + 1))
+            out.append(line)
+    out.append(render_cursor(screen))
+    return ''.join(out)
+
+
+def render_dirty(screen):
+    """
+    只输出上次调用之后变化的行
+    """
+    out = []
+    for y in sorted(screen.dirty):
+        if y < screen.lines:
+            out.append('\x1b[{};1H\x1b[0m\x1b[2K'.format(y + 1))
+            out.append(render_line(screen, y))
+    screen.dirty.clear()
+    if not out:
+        return ''
+    out.append(render_cursor(screen))
+    return ''.join(out)
+
+
+class KeyframeBuilder(object):
+    """
+    按顺序喂入录像事件, 到达时间或字节间隔时生成关键帧
+    """
+    def __init__(self, width, height, interval=KEYFRAME_SECONDS, interval_bytes=KEYFRAME_BYTES):
+        if pyte is None:
+            raise RuntimeError('pyte is required to build keyframes')
+        self.screen = pyte.Screen(width, height)
+        self.stream = pyte.Stream(self.screen)
+        self.interval = interval
+        self.interval_bytes = interval_bytes
+        self.keyframes = []
+        self._last_time = 0
+        self._bytes = 0
+
+    def feed(self, seq, event, next_offset=None):
+        """
+        :param seq: 事件序号
+        :param event: [时间, 类型, 数据]
+        :param next_offset: 下一个事件在 .cast 中的字节偏移
+        """
+        timestamp, event_type, data = event[0], event[1], event[2]
+        if event_type == 'o':
+            self.stream.feed(data)
+            self._bytes += len(data)
+        elif event_type == 'r':
+            # 终端大小变化 "列x行"
+            try:
+                columns, lines = (int(n) for n in data.split('x'))
+                self.screen.resize(lines=lines, columns=columns)
+            except ValueError:
+                pass
+        else:
+            return
+        if timestamp - self._last_time >= self.interval or self._bytes >= self.interval_bytes:
+            self.keyframes.append([
+                timestamp, seq + 1, next_offset,
+                self.screen.columns, self.screen.lines, render_screen(self.screen)
+            ])
+            self._last_time = timestamp
+            self._bytes = 0
+
+    def dumps(self):
+        return gzip.compress(''.join(json.dumps(kf) + '\n' for kf in self.keyframes).encode('utf-8'))
+
+
+def load_keyframes(data):
+    """
+    :param data: .kf 文件内容
+    """
+    return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines() if line]
+
+
+def iter_cast(stream):
+    """
+    逐行读取普通 .cast
+    :param stream: 二进制流, 支持 iter 按行读取
+    :return: 文件头和 (序号, 事件, 下一行的字节偏移) 迭代器
+    """
+    lines = iter(stream)
+    first = next(lines)
+    header = json.loads(first)
+
+    def events():
+        offset = len(first)
+        seq = 0
+        for line in lines:
+            offset += len(line)
+            if line.strip():
+                yield seq, json.loads(line), offset
+                seq += 1
+    return header, events()
+
+
+def nearest_keyframe(keyframes, timestamp):
+    """
+    :return: 时间不晚于 timestamp 的最后一个关键帧, 没有时返回 None
+    """
+    i = bisect.bisect_right([kf[0] for kf in keyframes], timestamp)
+    return keyframes[i - 1] if i else None
@@ -0,0 +1,326 @@
+import collections
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+from rzx_jms.base import BLACK_COMMAND_CACHE
+
+logger = logging.getLogger('service')
+
+# 高危命令规则变更通知
+BLACK_COMMAND_CHANNEL = '{}:changed'.format(BLACK_COMMAND_CACHE)
+# 兜底: 定时重新加载规则(秒)
+BLACK_COMMAND_REFRESH = getattr(settings, 'BLACK_COMMAND_REFRESH', 60)
+# 正则规则前缀, 如 're:^curl .*\|\s*sh'
+REGEX_PREFIX = 're:'
+
+# 管道、命令分隔符和命令替换都会开始一条新命令
+SEGMENT_SPLIT = re.compile(r'\|\||&&|\$\(|[|;&\n`()]')
+ENV_ASSIGN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+COMMAND_RULE = re.compile(r'^[\w.\-/]+(\s+[^|;&`$()<>]+)*$')
+# 命令前缀, 及其需要跳过参数值的选项
+COMMAND_PREFIX = {
+    'sudo': {'-u', '-g', '-C', '-D', '-h', '-p', '-r', '-t', '-U'},
+    'nice': {'-n'},
+    'nohup': set(), 'env': set(), 'command': set(), 'exec': set(),
+    'time': set(), 'builtin': set(), 'xargs': set(), 'busybox': set(),
+}
+# 长选项与短选项等价
+LONG_FLAG_ALIAS = {
+    'rm': {'--recursive': '-r', '--force': '-f'},
+    'chmod': {'--recursive': '-R'},
+    'chown': {'--recursive': '-R'},
+}
+
+
+def split_words(segment):
+    """
+    按 shell 的规则拆分单词: 去掉引号, 处理反斜杠转义, \\rm、r\\m、'r'm、"r""m" 都还原为 rm
+    引号没有闭合时剩余部分算作最后一个单词
+    """
+    if '\\' not in segment and '\'' not in segment and '"' not in segment:
+        return segment.split()
+    words, word = [], []
+    in_word = False
+    quote = None
+    i, size = 0, len(segment)
+    while i < size:
+        c = segment[i]
+        if quote == "'":
+            if c == quote:
+                quote = None
+            else:
+                word.append(c)
+        elif quote == '"':
+            if c == quote:
+                quote = None
+            elif c == '\\' and i + 1 < size and segment[i + 1] in '"\\$`':
+                i += 1
+                word.append(segment[i])
+            else:
+                word.append(c)
+        elif c == '\\':
+            if i + 1 < size:
+                i += 1
+                word.append(segment[i])
+            in_word = True
+        elif c in '\'"':
+            quote = c
+            in_word = True
+        elif c.isspace():
+            if in_word:
+                words.append(''.join(word))
+                word = []
+                in_word = False
+        else:
+            word.append(c)
+            in_word = True
+        i += 1
+    if in_word:
+        words.append(''.join(word))
+    return words
+
+
+def parse_command(segment):
+    """
+    解析一条简单命令
+    'sudo -u root /bin/rm -fr --verbose /tmp' -> ('rm', {'-f', '-r', '--verbose'}, ['/tmp'])
+    :return: (命令名, 选项集合, 参数列表), 空命令返回 None
+    """
+    tokens = split_words(segment)
+    i, size = 0, len(tokens)
+    while i < size:
+        token = tokens[i]
+        if ENV_ASSIGN.match(token):
+            i += 1
+        elif token in COMMAND_PREFIX:
+            options = COMMAND_PREFIX[token]
+            i += 1
+            while i < size and tokens[i].startswith('-'):
+                i += 2 if tokens[i] in options else 1
+        else:
+            break
+    if i >= size:
+        return None
+    exe = os.path.basename(tokens[i]) or tokens[i]
+    alias = LONG_FLAG_ALIAS.get(exe, {})
+    flags, args = set(), []
+    for token in tokens[i + 1:]:
+        if token.startswith('--'):
+            flags.add(alias.get(token, token))
+        elif token.startswith('-') and len(token) > 1:
+            flags.update('-' + c for c in token[1:])
+        else:
+            args.append(token)
+    return exe, flags, args
+
+
+class AhoCorasick(object):
+    """
+    多模式子串匹配, 一次扫描找出文本中出现的所有关键字
+    """
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword):
+        state = 0
+        for ch in keyword:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = nxt
+        self.output[state].append(keyword)
+
+    def _build(self):
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def search(self, text):
+        found = set()
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class CommandMatcher(object):
+    """
+    高危命令匹配, 规则编译一次后可被所有会话共用
+    规则有三种:
+    1. 命令规则 'rm -rf /': 按命令名建索引, 命令名相同且包含规则中的全部选项和参数即命中,
+       选项顺序、合并写法(-rf/-fr/-r -f)、命令路径(/bin/rm)、sudo 等前缀、管道和 ; && 分隔的每条命令都能识别;
+    2. 其它字面量规则(含特殊字符, 如 ':(){ :|:& };:'): Aho-Corasick 子串匹配;
+    3. 're:' 开头的正则规则
+    """
+    def __init__(self, rules=()):
+        self.rules = set()
+        self.command_rules = {}  # 命令名: [(规则, 选项集合, 参数集合), ...]
+        literals = []
+        regex_rules = []
+        for rule in rules:
+            rule = rule.decode() if isinstance(rule, bytes) else rule
+            rule = rule.strip()
+            if not rule:
+                continue
+            self.rules.add(rule)
+            if rule.startswith(REGEX_PREFIX):
+                try:
+                    regex_rules.append((rule, re.compile(rule[len(REGEX_PREFIX):])))
+                except re.error:
+                    logger.error('invalid black command regex: {}'.format(rule))
+            elif COMMAND_RULE.match(rule):
+                exe, flags, args = parse_command(rule)
+                self.command_rules.setdefault(exe, []).append((rule, frozenset(flags), frozenset(args)))
+            else:
+                literals.append(rule)
+        self.literal_matcher = AhoCorasick(literals) if literals else None
+        self.regex_rules = regex_rules
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, command_line):
+        """
+        :param command_line: 完整的一行命令
+        :return: 命中的规则列表
+        """
+        found = set()
+        if self.command_rules:
+            for segment in SEGMENT_SPLIT.split(command_line):
+                parsed = parse_command(segment)
+                if parsed is None:
+                    continue
+                exe, flags, args = parsed
+                candidates = self.command_rules.get(exe)
+                if not candidates:
+                    continue
+                for rule, rule_flags, rule_args in candidates:
+                    if rule_flags <= flags and rule_args.issubset(args):
+                        found.add(rule)
+        if self.literal_matcher:
+            found.update(self.literal_matcher.search(command_line))
+        for rule, pattern in self.regex_rules:
+            if pattern.search(command_line):
+                found.add(rule)
+        return list(found)
+
+
+class ReloadableRules(object):
+    """
+    进程内共享的规则, 第一次使用时加载, 之后由后台线程监听 redis 频道 channel,
+    收到通知(或每隔 refresh 秒)时重新编译并整体替换, 正在进行的会话立即生效
+    子类实现 load() 返回编译好的规则对象
+    """
+    channel = None
+    refresh = BLACK_COMMAND_REFRESH
+
+    def __init__(self):
+        self.compiled = None
+        self.stop = True
+        self._lock = threading.Lock()
+
+    def load(self):
+        raise NotImplementedError
+
+    def reload(self):
+        self.compiled = self.load()
+        return self.compiled
+
+    def background_reload(self):
+        """
+        监听线程中的重新加载, 子类需要在后台线程中做额外清理(如数据库连接)时覆盖
+        """
+        return self.reload()
+
+    def get(self):
+        compiled = self.compiled
+        if compiled is None:
+            with self._lock:
+                if self.compiled is None:
+                    self.reload()
+                    self.check()
+            compiled = self.compiled
+        return compiled
+
+    def check(self):
+        """
+        检查规则变更监听线程是否启动
+        :return:
+        """
+        if not self.stop:
+            return
+        self.stop = False
+        t = threading.Thread(target=self.run, name='{}-listener'.format(self.channel), daemon=True)
+        t.start()
+
+    def run(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = default_redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                last_load = time.time()
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    if message or time.time() - last_load >= self.refresh:
+                        self.background_reload()
+                        last_load = time.time()
+            except:
+                logger.error(traceback.format_exc())
+                time.sleep(5)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+
+class BlackCommandMatcher(ReloadableRules):
+    """
+    进程内共享的高危命令匹配器, 规则来自 redis 的 BLACK_COMMAND_CACHE
+    """
+    channel = BLACK_COMMAND_CHANNEL
+
+    def load(self):
+        rules = default_redis.smembers(BLACK_COMMAND_CACHE) or set()
+        matcher = CommandMatcher(rules)
+        logger.info('black command rules loaded: {}'.format(len(matcher)))
+        return matcher
+
+    def match(self, command_line):
+        return self.get().match(command_line)
+
+
+def notify_black_command_change(*args, **kwargs):
+    """
+    BLACK_COMMAND_CACHE 更新后调用, 通知所有进程重新加载规则, 可直接作为 post_save/post_delete 信号处理函数
+    """
+    default_redis.publish(BLACK_COMMAND_CHANNEL, 1)
+
+
+black_command_matcher = BlackCommandMatcher()
@@ -0,0 +1,135 @@
+import math
+import time
+
+from apps.utils.cast_keyframe import pyte, render_dirty, render_screen
+from rzx_jms import settings
+
+# 输出速率(字节/秒)超过该值进入刷屏模式, 0 表示不启用
+FLOOD_THRESHOLD = getattr(settings, 'TERMINAL_FLOOD_THRESHOLD', 512 * 1024)
+# 速率低于 FLOOD_THRESHOLD * FLOOD_EXIT_RATIO 并持续 FLOOD_EXIT_HOLD 秒后恢复原样转发
+FLOOD_EXIT_RATIO = 0.25
+FLOOD_EXIT_HOLD = getattr(settings, 'TERMINAL_FLOOD_EXIT_HOLD', 2)
+# 刷屏模式下每秒最多发送的画面数
+FLOOD_FPS = getattr(settings, 'TERMINAL_FLOOD_FPS', 10)
+# 刷屏模式下每帧数据最多取末尾这么多字符喂给终端模拟器, 限制 cpu 占用
+FLOOD_FEED_LIMIT = getattr(settings, 'TERMINAL_FLOOD_FEED_LIMIT', 32 * 1024)
+# 没有安装 pyte 时, 每帧只发送最近输出的末尾这么多字符
+FLOOD_TAIL_BYTES = 8 * 1024
+
+
+class RateMeter(object):
+    """
+    指数衰减的速率估计(单位/秒)
+    """
+    def __init__(self, tau=0.5):
+        self.tau = tau
+        self._rate = 0.0
+        self._last = time.time()
+
+    def add(self, n, now=None):
+        now = now or time.time()
+        self._rate = self._rate * math.exp(-(now - self._last) / self.tau) + n / self.tau
+        self._last = now
+
+    def rate(self, now=None):
+        now = now or time.time()
+        return self._rate * math.exp(-(now - self._last) / self.tau)
+
+
+class FloodControl(object):
+    """
+    刷屏控制: 输出速率超过阈值时不再逐字节转发, 而是维护一个终端屏幕模型,
+    按 FLOOD_FPS 只发送变化的行(第一帧为整屏), 录像和回放缓冲区也只记录这些画面,
+    每个刷屏会话的带宽不超过 FLOOD_FPS 帧/秒 x 一屏的大小; 速率回落后恢复原样转发
+    """
+    def __init__(self, cols=80, rows=24, threshold=FLOOD_THRESHOLD, fps=FLOOD_FPS):
+        self.cols = cols
+        self.rows = rows
+        self.threshold = threshold
+        self.interval = 1.0 / fps
+        self.meter = RateMeter()
+        self.active = False
+        self.floods = 0
+        self.suppressed = 0  # 刷屏模式下没有原样发送的字节数
+        self.screen = None
+        self.stream = None
+        self._tail = ''
+        self._first = False
+        self._calm_since = None
+
+    def resize(self, cols, rows):
+        self.cols, self.rows = cols, rows
+        if self.screen is not None:
+            self.screen.resize(lines=rows, columns=cols)
+
+    def check(self, size):
+        """
+        每发送一帧前调用
+        :param size: 这一帧的字节数
+        :return: 是否需要进入刷屏模式
+        """
+        self.meter.add(size)
+        return not self.active and self.threshold and self.meter.rate() >= self.threshold
+
+    def start(self, recent=b''):
+        """
+        进入刷屏模式
+        :param recent: 最近的输出(回放缓冲区), 用来初始化屏幕
+        """
+        self.active = True
+        self.floods += 1
+        self._first = True
+        self._calm_since = None
+        if pyte is not None:
+            self.screen = pyte.Screen(self.cols, self.rows)
+            self.stream = pyte.Stream(self.screen)
+            self.stream.feed(recent[-FLOOD_FEED_LIMIT:].decode('utf-8', 'ignore'))
+
+    def feed(self, text):
+        self.suppressed += len(text)
+        if self.stream is None:
+            self._tail = (self._tail + text)[-FLOOD_TAIL_BYTES:]
+            return
+        # 滚动输出只有最后一屏可见, 只取最后 rows 行(且不超过 FLOOD_FEED_LIMIT), 从一行的开头开始, 避免半个控制序列
+        cut = len(text)
+        for _ in range(self.rows + 1):
+            cut = text.rfind('\n', 0, cut)
+            if cut < 0:
+                break
+        if cut >= 0:
+            text = text[cut + 1:]
+        if len(text) > FLOOD_FEED_LIMIT:
+            text = text[-FLOOD_FEED_LIMIT:]
+            cut = text.find('\n')
+            if cut >= 0:
+                text = text[cut + 1:]
+        self.stream.feed(text)
+
+    def render(self):
+        """
+        :return: 这一帧要发送的内容, 进入刷屏模式后的第一帧为整屏
+        """
+        full, self._first = self._first, False
+        if self.stream is None:
+            tail, self._tail = self._tail, ''
+            cut = tail.find('\n')
+            return tail[cut + 1:] if cut >= 0 and len(tail) >= FLOOD_TAIL_BYTES else tail
+        if full:
+            self.screen.dirty.clear()
+            return render_screen(self.screen)
+        return render_dirty(self.screen)
+
+    def should_exit(self):
+        now = time.time()
+        if self.meter.rate(now) >= self.threshold * FLOOD_EXIT_RATIO:
+            self._calm_since = None
+            return False
+        if self._calm_since is None:
+            self._calm_since = now
+        return now - self._calm_since >= FLOOD_EXIT_HOLD
+
+    def exit(self):
+        self.active = False
+        self.screen = None
+        self.stream = None
+        self._tail = ''
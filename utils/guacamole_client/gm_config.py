@@ -19,7 +19,7 @@ SCREEN_CONFIG = {
 
 
 GUACD = {
-    # TODO - need replace to _ !!
+    # 参数名中的 - 写作 _, 握手时按 guacd 返回的参数名(把 - 换成 _)取值
     # 如果设置为“true”，服务器返回的证书将被忽略，即使该证书无法验证。
     # 如果您普遍信任服务器以及与服务器的连接，并且您知道服务器的证书无法验证（例如，如果它是自签名的）
     'ignore_cert': 'true',
@@ -53,15 +53,15 @@ GUACD = {
     # 'disable_paste': 'true',
 
     # # 屏幕录像
-    # 'recording_name': '',
-    'recording-path': REPLAY_PATH,  # 录像保存位置, guacd 4822服务器路径
-    'create-recording-path': 'true',  # (只支持创建最后一级目录)
+    # 'recording_name': '',  # 录像文件名, 每个会话单独设置为会话 token
+    'recording_path': REPLAY_PATH,  # 录像保存位置, guacd 4822服务器路径
+    'create_recording_path': 'true',  # (只支持创建最后一级目录)
     # 'recording_exclude_output': 'true',  # 排除图像/数据流
     # 'recording_exclude_mouse': 'true',  # 排除鼠标
     # 'recording_include_keys': 'true',  # 包含按键事件
 
     # 性能
-    'enable-wallpaper': 'true',  # 墙纸
+    'enable_wallpaper': 'true',  # 墙纸
     # 'enable_theming': 'true',  # 主题
     # 'enable_font_smoothing': 'true',  # 字体平滑
     # 'enable_full_window_drag': 'true',  # 全窗口拖拽 (拖动窗口显示内容)
@@ -0,0 +1,240 @@
+import re
+import threading
+
+# 备用屏幕: vi/less/top 等全屏程序进入时输出 \x1b[?1049h, 退出时输出 \x1b[?1049l
+ALT_SCREEN_RE = re.compile(r'\x1b\[\?(?:1049|1047|47)([hl])')
+# 控制序列终止字节
+CSI_FINAL = re.compile(r'[@-~]')
+
+CTRL_A, CTRL_B, CTRL_C, CTRL_D, CTRL_E, CTRL_F = '\x01', '\x02', '\x03', '\x04', '\x05', '\x06'
+BELL, BACKSPACE, TAB, CTRL_K, CTRL_U, CTRL_W = '\x07', '\x08', '\t', '\x0b', '\x15', '\x17'
+ESC, DEL = '\x1b', '\x7f'
+
+
+class GapBuffer(object):
+    """
+    间隙缓冲区: 光标处插入/删除为 O(1) 均摊, 移动光标只搬动光标与间隙之间的字符
+    """
+    def __init__(self, capacity=64):
+        self._buf = [''] * capacity
+        self._gap_start = 0
+        self._gap_end = capacity
+
+    def __len__(self):
+        return len(self._buf) - (self._gap_end - self._gap_start)
+
+    def __str__(self):
+        return ''.join(self._buf[:self._gap_start]) + ''.join(self._buf[self._gap_end:])
+
+    @property
+    def cursor(self):
+        return self._gap_start
+
+    def _grow(self, need):
+        size = len(self._buf)
+        new_size = max(size * 2, size + need)
+        tail = self._buf[self._gap_end:]
+        self._buf = self._buf[:self._gap_start] + [''] * (new_size - size + self._gap_end - self._gap_start) + tail
+        self._gap_end = new_size - len(tail)
+
+    def insert(self, text):
+        if self._gap_end - self._gap_start < len(text):
+            self._grow(len(text))
+        for ch in text:
+            self._buf[self._gap_start] = ch
+            self._gap_start += 1
+
+    def overwrite(self, ch):
+        # 终端回显: 覆盖光标处的字符
+        if self._gap_end < len(self._buf):
+            self._gap_end += 1
+        self.insert(ch)
+
+    def delete_before(self, n=1):
+        n = min(n, self._gap_start)
+        self._gap_start -= n
+        return n
+
+    def delete_after(self, n=1):
+        n = min(n, len(self._buf) - self._gap_end)
+        self._gap_end += n
+        return n
+
+    def move_to(self, pos):
+        pos = max(0, min(pos, len(self)))
+        if pos < self._gap_start:
+            count = self._gap_start - pos
+            self._buf[self._gap_end - count:self._gap_end] = self._buf[pos:self._gap_start]
+            self._gap_start = pos
+            self._gap_end -= count
+        elif pos > self._gap_start:
+            count = pos - self._gap_start
+            self._buf[self._gap_start:self._gap_start + count] = self._buf[self._gap_end:self._gap_end + count]
+            self._gap_start += count
+            self._gap_end += count
+
+    def move_by(self, delta):
+        self.move_to(self._gap_start + delta)
+
+    def text_before(self):
+        return ''.join(self._buf[:self._gap_start])
+
+    def clear(self):
+        self._gap_start = 0
+        self._gap_end = len(self._buf)
+
+
+class LineEditor(object):
+    """
+    根据用户按键和服务器回显还原命令行, 每输入完一条命令(回车)回调 on_command(command)
+    tab 补全和上下键翻历史时, 命令内容由 shell 回显决定, 下一次输出按终端回显规则(退格/覆盖/清除到行尾)同步到当前行;
+    全屏程序(vi/less/top 等)运行期间的按键不算命令
+    """
+    def __init__(self, on_command=None):
+        self.line = GapBuffer()
+        self.on_command = on_command
+        self.alt_screen = False
+        self._esc = ''
+        self._sync_echo = False
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return str(self.line)
+
+    def feed_input(self, text):
+        """
+        :param text: 用户输入, 可以是单个按键, 也可以是整行(粘贴或逐行发送)
+        """
+        with self._lock:
+            for ch in text:
+                if self._esc:
+                    self._feed_escape(ch)
+                elif ch == ESC:
+                    self._esc = ch
+                else:
+                    self._feed_char(ch)
+
+    def _feed_char(self, ch):
+        line = self.line
+        if ch in '\r\n':
+            self._complete()
+        elif ch in (DEL, BACKSPACE):
+            line.delete_before()
+        elif ch == CTRL_A:
+            line.move_to(0)
+        elif ch == CTRL_E:
+            line.move_to(len(line))
+        elif ch == CTRL_B:
+            line.move_by(-1)
+        elif ch == CTRL_F:
+            line.move_by(1)
+        elif ch == CTRL_D:
+            line.delete_after()
+        elif ch == CTRL_U:
+            line.delete_before(line.cursor)
+        elif ch == CTRL_K:
+            line.delete_after(len(line) - line.cursor)
+        elif ch == CTRL_W:
+            before = line.text_before()
+            stripped = before.rstrip(' ')
+            line.delete_before(len(before) - len(stripped) + len(stripped.rsplit(' ', 1)[-1]))
+        elif ch == CTRL_C:
+            line.clear()
+        elif ch == TAB:
+            self._sync_echo = True
+        elif ch >= ' ':
+            line.insert(ch)
+        # 其它控制字符(响铃、ctrl+z、ctrl+l 等)不影响命令内容
+
+    def _feed_escape(self, ch):
+        self._esc += ch
+        seq = self._esc
+        if len(seq) == 2:
+            if ch in '[O':
+                return
+            # alt+键, 或连按两次 esc
+            self._esc = ''
+            if ch == ESC:
+                self._sync_echo = True
+            return
+        if not CSI_FINAL.match(ch):
+            if len(seq) > 16:
+                self._esc = ''
+            return
+        self._esc = ''
+        line = self.line
+        if ch in 'AB':      # ↑ ↓ 翻历史
+            self._sync_echo = True
+        elif ch == 'C':     # →
+            line.move_by(1)
+        elif ch == 'D':     # ←
+            line.move_by(-1)
+        elif ch == 'H' or seq in ('\x1b[1~', '\x1b[7~'):    # home
+            line.move_to(0)
+        elif ch == 'F' or seq in ('\x1b[4~', '\x1b[8~'):    # end
+            line.move_to(len(line))
+        elif seq == '\x1b[3~':  # delete
+            line.delete_after()
+
+    def _complete(self):
+        command = str(self.line).strip()
+        self.line.clear()
+        self._sync_echo = False
+        if self.alt_screen or not command:
+            return
+        if self.on_command:
+            self.on_command(command)
+
+    def feed_output(self, text):
+        """
+        :param text: 服务器输出(已解码)
+        """
+        if ESC in text and '[?' in text:
+            was_alt_screen = self.alt_screen
+            for match in ALT_SCREEN_RE.finditer(text):
+                self.alt_screen = match.group(1) == 'h'
+            if was_alt_screen and not self.alt_screen:
+                # 全屏程序退出, 其间的按键全部丢弃
+                with self._lock:
+                    self.line.clear()
+        if not self._sync_echo:
+            return
+        with self._lock:
+            self._sync_echo = False
+            self._apply_echo(text)
+
+    def _apply_echo(self, text):
+        line = self.line
+        i, size = 0, len(text)
+        while i < size:
+            ch = text[i]
+            if ch in '\r\n':
+                # 多行输出(如补全候选列表)无法对应到当前行
+                return
+            if ch == BACKSPACE:
+                line.move_by(-1)
+            elif ch == ESC and text[i + 1:i + 2] == '[':
+                j = i + 2
+                while j < size and not CSI_FINAL.match(text[j]):
+                    j += 1
+                if j >= size:
+                    return
+                param, final = text[i + 2:j], text[j]
+                count = int(param) if param.isdigit() else 1
+                if final == 'K':
+                    line.delete_after(len(line) - line.cursor)
+                elif final == 'C':
+                    line.move_by(count)
+                elif final == 'D':
+                    line.move_by(-count)
+                elif final == 'P':
+                    line.delete_after(count)
+                elif final == '@':
+                    cursor = line.cursor
+                    line.insert(' ' * count)
+                    line.move_to(cursor)
+                i = j
+            elif ch >= ' ':
+                line.overwrite(ch)
+            i += 1
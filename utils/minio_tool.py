@@ -1,31 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import urllib3
 from minio import Minio
+from minio.datatypes import Part
 
 from rzx_jms import settings
 
+# 存储桶存在的缓存时间(秒), 缓存期内上传下载不再先发一次 bucket_exists 请求
+BUCKET_CACHE_TTL = getattr(settings, 'MINIO_BUCKET_CACHE_TTL', 300)
+# 连接池大小, 需不小于同时向 minio 发起的请求数(上传线程数 x 并行分片数), 超出的连接用完即关闭
+POOL_SIZE = getattr(settings, 'MINIO_POOL_SIZE', 32)
+TIMEOUT = getattr(settings, 'MINIO_TIMEOUT', 300)
+# 大文件分片上传: 分片大小和同时上传的分片数
+PART_SIZE = max(getattr(settings, 'MINIO_PART_SIZE', 16 * 1024 * 1024), 5 * 1024 * 1024)
+PARALLEL_UPLOADS = getattr(settings, 'MINIO_PARALLEL_UPLOADS', 4)
+# 流式读取时每次读取的大小
+STREAM_CHUNK_SIZE = 64 * 1024
+# 预签名地址缓存的条数, 剩余有效期不足 PRESIGN_MARGIN 比例时重新生成
+PRESIGN_CACHE_SIZE = 1024
+PRESIGN_MARGIN = 0.2
+
+
+def make_http_client(pool_size=POOL_SIZE, timeout=TIMEOUT):
+    """
+    与 minio 默认的连接池相同的超时和重试, 只是连接数可调
+    """
+    return urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+        maxsize=pool_size,
+        retries=urllib3.Retry(
+            total=5,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504]
+        )
+    )
+
 
 class MinioManager(object):
-    def __init__(self):
+    def __init__(self, endpoint=None, access_key=None, secret_key=None, pool_size=POOL_SIZE,
+                 part_size=PART_SIZE, parallel_uploads=PARALLEL_UPLOADS, bucket_cache_ttl=BUCKET_CACHE_TTL):
         self.client = Minio(
-            endpoint=settings.MINIO_ENDPOINT,
-            access_key=settings.MINIO_ACCESS_KEY,
-            secret_key=settings.MINIO_SECRET_KEY,
-            secure=False
+            endpoint=endpoint or settings.MINIO_ENDPOINT,
+            access_key=access_key or settings.MINIO_ACCESS_KEY,
+            secret_key=secret_key or settings.MINIO_SECRET_KEY,
+            secure=False,
+            http_client=make_http_client(pool_size)
         )
+        self.part_size = part_size
+        self.parallel_uploads = parallel_uploads
+        self.bucket_cache_ttl = bucket_cache_ttl
+        # 存储桶 -> 缓存过期时间, 只缓存存在的桶, 新建的桶可以立即使用
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # (存储桶, 对象名, 有效期) -> (预签名地址, 过期时间)
+        self._presigned = OrderedDict()
+        self._presigned_lock = threading.Lock()
 
     def list_buckets(self):
         return self.client.list_buckets()
 
     def check_exists(self, bucket_name):
-        return self.client.bucket_exists(bucket_name)
+        if self._buckets.get(bucket_name, 0) > time.time():
+            return True
+        # 缓存过期时多个上传线程只发一次请求
+        with self._lock:
+            if self._buckets.get(bucket_name, 0) > time.time():
+                return True
+            exists = self.client.bucket_exists(bucket_name)
+            if exists:
+                self._buckets[bucket_name] = time.time() + self.bucket_cache_ttl
+            return exists
 
     def file_upload(
         self, bucket_name, object_name, file_path, content_type=None, metadata=None
     ):
+        """
+        超过 part_size 的文件分片上传, 同时上传 parallel_uploads 个分片
+        """
         if not self.check_exists(bucket_name):
             raise
         return self.client.fput_object(
             bucket_name, object_name, file_path,
-            content_type=content_type, metadata=metadata
+            content_type=content_type or 'application/octet-stream', metadata=metadata,
+            part_size=self.part_size, num_parallel_uploads=self.parallel_uploads
         )
 
     def object_upload(
@@ -33,7 +93,10 @@ class MinioManager(object):
     ):
         if not self.check_exists(bucket_name):
             raise
-        return self.client.put_object(bucket_name, object_name, data, file_size)
+        return self.client.put_object(
+            bucket_name, object_name, data, file_size,
+            part_size=self.part_size, num_parallel_uploads=self.parallel_uploads
+        )
 
     def file_download(self, object_name, bucket_name):
         if not self.check_exists(bucket_name):
@@ -45,9 +108,230 @@ class MinioManager(object):
             raise
         return self.client.stat_object(bucket_name, object_name)
 
+    def get_object_range(self, bucket_name, object_name, offset=0, length=0):
+        """
+        读取对象的一段, length 为 0 表示读到结尾
+        """
+        return self.client.get_object(bucket_name, object_name, offset=offset, length=length)
+
+    def presigned_url(self, bucket_name, object_name, expires=3600):
+        """
+        对象的预签名下载地址, 缓存到剩余有效期不足 PRESIGN_MARGIN 时再重新生成
+        签名在本地计算, 缓存的作用是同一录像多次打开时地址不变, 浏览器可以命中自己的缓存
+        :param expires: 有效期(秒)
+        """
+        key = (bucket_name, object_name, expires)
+        now = time.time()
+        with self._presigned_lock:
+            cached = self._presigned.get(key)
+            if cached and cached[1] - now > expires * PRESIGN_MARGIN:
+                self._presigned.move_to_end(key)
+                return cached[0]
+        url = self.client.presigned_get_object(bucket_name, object_name, expires=timedelta(seconds=expires))
+        with self._presigned_lock:
+            self._presigned[key] = (url, now + expires)
+            self._presigned.move_to_end(key)
+            while len(self._presigned) > PRESIGN_CACHE_SIZE:
+                self._presigned.popitem(last=False)
+        return url
+
+    def stream_object(self, bucket_name, object_name, offset=0, length=0, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        逐块读取对象, 不把整个对象读入内存, 读完或调用方中途停止时归还连接
+        """
+        response = self.get_object_range(bucket_name, object_name, offset, length)
+        try:
+            for chunk in response.stream(chunk_size):
+                yield chunk
+        finally:
+            response.close()
+            response.release_conn()
+
+    # 分片上传: minio 只在 put_object 内部使用分片上传, 这里直接调用它的分片接口,
+    # 以便边录像边上传, 由调用方保存 upload_id 和各分片的 etag
+    def create_multipart_upload(self, bucket_name, object_name, content_type='application/octet-stream'):
+        return self.client._create_multipart_upload(bucket_name, object_name, {'Content-Type': content_type})
+
+    def upload_part(self, bucket_name, object_name, upload_id, part_number, data):
+        """
+        :param data: 分片数据, 除最后一片外不小于 5MB
+        :return: etag
+        """
+        return self.client._upload_part(bucket_name, object_name, data, None, upload_id, part_number)
+
+    def complete_multipart_upload(self, bucket_name, object_name, upload_id, parts):
+        """
+        :param parts: [(分片号, etag), ...]
+        """
+        return self.client._complete_multipart_upload(
+            bucket_name, object_name, upload_id, [Part(number, etag) for number, etag in parts]
+        )
+
+    def abort_multipart_upload(self, bucket_name, object_name, upload_id):
+        return self.client._abort_multipart_upload(bucket_name, object_name, upload_id)
+
+
+class MinioObjectFile(object):
+    """
+    只读的类文件对象, 每次 read 按当前位置发起一次范围请求, 供需要 seek 的读取方使用(如压缩录像按帧读取)
+    """
+    def __init__(self, bucket_name, object_name, manager=None):
+        self.bucket_name = bucket_name
+        self.name = object_name
+        self.manager = manager or minio_manager
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.manager.get_object(self.name, self.bucket_name).size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        response = self.manager.get_object_range(
+            self.bucket_name, self.name, self.position, 0 if size is None or size < 0 else size
+        )
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
 
 minio_manager = MinioManager()
 
 
 if __name__ == "__main__":
-    print(minio_manager.list_buckets())
+    # 对照本地模拟的 s3 服务测试上传吞吐: 每个请求固定延迟 LATENCY 秒, 每个连接限速 BANDWIDTH 字节/秒
+    import re
+    import threading
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from tempfile import NamedTemporaryFile
+    from urllib.parse import urlparse, parse_qs
+
+    LATENCY = 0.005
+    BANDWIDTH = 50 * 1024 * 1024
+    counters = {'requests': 0, 'connections': 0, 'bucket_exists': 0}
+    objects = {}
+
+    class LocalS3Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            counters['connections'] += 1
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body=b'', status=200, headers=None):
+            time.sleep(LATENCY + len(body) / BANDWIDTH)
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def body(self):
+            data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            time.sleep(len(data) / BANDWIDTH)
+            return data
+
+        def handle_one_request(self):
+            counters['requests'] += 1
+            super().handle_one_request()
+
+        def do_HEAD(self):
+            counters['bucket_exists'] += 1
+            self.reply()
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if 'location' in parse_qs(url.query, keep_blank_values=True):
+                return self.reply(b'<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                                  b'</LocationConstraint>')
+            data = objects.get(url.path, b'')
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                data = data[int(match.group(1)):int(match.group(2)) + 1 if match.group(2) else None]
+            self.reply(data)
+
+        def do_PUT(self):
+            url = urlparse(self.path)
+            data = self.body()
+            query = parse_qs(url.query)
+            key = url.path + (':' + query['partNumber'][0] if 'partNumber' in query else '')
+            objects[key] = data
+            self.reply(headers={'ETag': '"{}"'.format(uuid.uuid4().hex)})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            self.body()
+            if 'uploads' in parse_qs(url.query, keep_blank_values=True):
+                return self.reply('<InitiateMultipartUploadResult><Bucket>b</Bucket><Key>k</Key><UploadId>{}'
+                                  '</UploadId></InitiateMultipartUploadResult>'.format(uuid.uuid4().hex).encode())
+            self.reply(b'<CompleteMultipartUploadResult><Location>l</Location><Bucket>b</Bucket><Key>k</Key>'
+                       b'<ETag>"e"</ETag></CompleteMultipartUploadResult>')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalS3Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = '127.0.0.1:{}'.format(server.server_port)
+
+    class UncachedMinioManager(MinioManager):
+        # 改动前的行为: 每次上传都先检查存储桶
+        def check_exists(self, bucket_name):
+            return self.client.bucket_exists(bucket_name)
+
+    def run(title, manager, paths, threads):
+        for key in counters:
+            counters[key] = 0
+        size = sum(os.path.getsize(path) for path in paths)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda path: manager.file_upload('bucket', os.path.basename(path), path), paths))
+        elapsed = time.perf_counter() - start
+        print('{:<40} {:6.2f}s {:7.1f} MB/s  requests {:4}  connections {:3}  bucket_exists {:3}'.format(
+            title, elapsed, size / elapsed / 1e6, counters['requests'], counters['connections'],
+            counters['bucket_exists']))
+
+    import os
+    small, large = [], []
+    for i in range(200):
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(256 * 1024))
+            small.append(f.name)
+    with NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(128 * 1024 * 1024))
+        large.append(f.name)
+    old = dict(endpoint=endpoint, access_key='a', secret_key='s', pool_size=10)
+    new = dict(endpoint=endpoint, access_key='a', secret_key='s')
+    run('200 x 256KB, 32 threads, before', UncachedMinioManager(**old), small, 32)
+    run('200 x 256KB, 32 threads, after', MinioManager(**new), small, 32)
+    run('128MB, 5MB parts x 1, before', UncachedMinioManager(part_size=5 * 1024 * 1024, parallel_uploads=1, **old),
+        large, 1)
+    run('128MB, {}MB parts x {}, after'.format(PART_SIZE // 1024 // 1024, PARALLEL_UPLOADS), MinioManager(**new),
+        large, 1)
+    # 流式读取
+    manager = MinioManager(**new)
+    start = time.perf_counter()
+    total = sum(len(chunk) for chunk in manager.stream_object('bucket', os.path.basename(small[0])))
+    print('stream_object {} bytes in {:.3f}s'.format(total, time.perf_counter() - start))
+    for path in small + large:
+        os.remove(path)
+    server.shutdown()
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from rzx_jms import settings
+
+# 合并窗口(秒): 第一块数据到达后最多等待这么久再发送
+OUTPUT_LATENCY = getattr(settings, 'TERMINAL_OUTPUT_LATENCY', 0.005)
+# 单帧最大字节数, 超过立即发送
+OUTPUT_MAX_BYTES = getattr(settings, 'TERMINAL_OUTPUT_MAX_BYTES', 64 * 1024)
+
+
+class CoalesceStats(object):
+    """
+    合并计数: chunks 为读到的数据块数, frames 为实际发送的帧数
+    """
+    def __init__(self):
+        self.chunks = 0
+        self.frames = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, chunks, frames, size):
+        with self._lock:
+            self.chunks += chunks
+            self.frames += frames
+            self.bytes += size
+
+    @property
+    def merge_ratio(self):
+        return round(self.chunks / self.frames, 2) if self.frames else 0
+
+    def as_dict(self):
+        return {
+            'chunks': self.chunks, 'frames': self.frames,
+            'bytes': self.bytes, 'merge_ratio': self.merge_ratio
+        }
+
+
+# 进程内所有会话的合并计数
+coalesce_stats = CoalesceStats()
+
+
+class OutputCoalescer(object):
+    """
+    终端输出合并: 在 latency 时间窗口内到达的数据合并成一帧, 或累计超过 max_bytes 立即成帧
+    """
+    def __init__(self, latency=OUTPUT_LATENCY, max_bytes=OUTPUT_MAX_BYTES):
+        self.latency = latency
+        self.max_bytes = max_bytes
+        self.first_time = None
+        self.chunks = 0
+        self.frames = 0
+        self.bytes = 0
+        self._buffer = []
+        self._size = 0
+        self._pending_chunks = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def full(self):
+        return self._size >= self.max_bytes
+
+    def append(self, data):
+        """
+        :param data: 一块输出数据
+        :return: 是否是当前帧的第一块数据(调用方据此启动 latency 定时器)
+        """
+        first = not self._buffer
+        if first:
+            self.first_time = time.time()
+        self._buffer.append(data)
+        self._size += len(data)
+        self._pending_chunks += 1
+        return first
+
+    def pop(self):
+        """
+        取出合并后的一帧数据, 没有数据时返回 None
+        """
+        if not self._buffer:
+            return None
+        data = self._buffer[0][:0].join(self._buffer)
+        self.chunks += self._pending_chunks
+        self.frames += 1
+        self.bytes += self._size
+        coalesce_stats.add(self._pending_chunks, 1, self._size)
+        self._buffer = []
+        self._size = 0
+        self._pending_chunks = 0
+        return data
+
+    @property
+    def merge_ratio(self):
+        return round(self.chunks / self.frames, 2) if self.frames else 0
+
+    def as_dict(self):
+        return {
+            'chunks': self.chunks, 'frames': self.frames,
+            'bytes': self.bytes, 'merge_ratio': self.merge_ratio
+        }
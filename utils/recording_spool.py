@@ -0,0 +1,179 @@
+"""
+录像上传队列(本地 spool): 录像目录中每个有 .upload 日志的录像就是一个待上传条目
+    录像打开时写入日志(含登记回放记录需要的会话信息), 上传成功并登记后删除录像和日志
+    上传失败时在日志中记录失败次数和下次重试时间, 按指数退避重试, 分片上传从中断处续传
+    进程崩溃遗留的没有日志的录像(孤儿录像)在 worker 启动和每次重试时收编为条目
+日志中的 next_retry 同时用作租约: 开始上传前设为 当前时间 + UPLOAD_LEASE, 其它重试不会同时处理,
+上传进程崩溃时租约到期后再重试
+"""
+import fcntl
+import glob
+import logging
+import os
+import random
+import shutil
+import time
+import traceback
+from contextlib import contextmanager
+
+from apps.utils.cast_format import CASTZ_SUFFIX
+from apps.utils.recording_upload import UploadJournal, journal_path, owner_alive, recover_uploads
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 重试间隔(秒): 第 n 次失败后等待 RETRY_BASE * 2^(n-1), 最长 RETRY_MAX
+RETRY_BASE = getattr(settings, 'TERMINAL_SPOOL_RETRY_BASE', 30)
+RETRY_MAX = getattr(settings, 'TERMINAL_SPOOL_RETRY_MAX', 3600)
+# 一次上传最长占用条目的时间(秒)
+UPLOAD_LEASE = getattr(settings, 'TERMINAL_SPOOL_UPLOAD_LEASE', 1800)
+# 没有日志的录像超过该时间(秒)没有写入视为孤儿录像
+ORPHAN_AGE = getattr(settings, 'TERMINAL_SPOOL_ORPHAN_AGE', 600)
+RECORD_SUFFIXES = ('.cast', CASTZ_SUFFIX)
+LOCK_NAME = '.spool.lock'
+
+
+class RecordingSpool(object):
+    def __init__(self, spool_dir=None):
+        self._spool_dir = spool_dir
+
+    @property
+    def spool_dir(self):
+        return self._spool_dir or settings.jms_video_record
+
+    @contextmanager
+    def lock(self):
+        """
+        同一时间只有一个进程扫描和重试, 进程退出时锁自动释放
+        :return: 是否拿到锁
+        """
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with open(os.path.join(self.spool_dir, LOCK_NAME), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def journals(self):
+        result = []
+        for path in recover_uploads(self.spool_dir):
+            try:
+                journal = UploadJournal.load(path)
+            except:
+                logger.error('broken upload journal {}: {}'.format(path, traceback.format_exc()))
+                continue
+            if journal is not None:
+                result.append(journal)
+        return result
+
+    def orphans(self, now=None):
+        """
+        录像打开时就写入日志, 孤儿录像只会来自旧版本或日志写入失败的录像
+        :return: 没有日志且超过 ORPHAN_AGE 秒没有写入的录像
+        """
+        now = now or time.time()
+        result = []
+        for suffix in RECORD_SUFFIXES:
+            for path in glob.glob(os.path.join(self.spool_dir, '**', '*' + suffix), recursive=True):
+                try:
+                    if os.path.exists(journal_path(path)) or now - os.path.getmtime(path) < ORPHAN_AGE:
+                        continue
+                except FileNotFoundError:
+                    continue
+                result.append(path)
+        return result
+
+    @staticmethod
+    def adopt(path, meta):
+        journal = UploadJournal(path, meta=meta, closed=True)
+        journal.save()
+        logger.info('adopt orphan recording {}'.format(path))
+        return journal
+
+    @staticmethod
+    def is_due(journal, now, max_age):
+        """
+        :param max_age: 会话进行中的日志超过该时间(秒)没有更新视为会话已中断
+        写入进程还在运行的录像不重试; 写入进程已退出的立即重试; 无法判断时按更新时间
+        """
+        if not journal.closed:
+            alive = owner_alive(journal.owner)
+            if alive is not None:
+                return not alive and journal.next_retry <= now
+            try:
+                if now - os.path.getmtime(journal_path(journal.path)) < max_age:
+                    return False
+                if os.path.exists(journal.path) and now - os.path.getmtime(journal.path) < max_age:
+                    return False
+            except FileNotFoundError:
+                return False
+        return journal.next_retry <= now
+
+    def due(self, max_age=3600):
+        now = time.time()
+        return sorted(
+            (journal for journal in self.journals() if self.is_due(journal, now, max_age)),
+            key=lambda journal: journal.created
+        )
+
+    @staticmethod
+    def lease(journal):
+        journal.closed = True
+        journal.next_retry = time.time() + UPLOAD_LEASE
+        journal.save()
+
+    @staticmethod
+    def failed(journal, error):
+        journal.attempts += 1
+        delay = min(RETRY_BASE * 2 ** (journal.attempts - 1), RETRY_MAX)
+        journal.next_retry = time.time() + delay * random.uniform(0.8, 1.2)
+        journal.last_error = str(error)[:500]
+        journal.save()
+        logger.warning('recording upload failed {} (attempt {}), retry in {:.0f}s: {}'.format(
+            journal.path, journal.attempts, delay, journal.last_error))
+
+    def metrics(self):
+        """
+        :return: {
+            'pending': 会话已结束待上传的录像数,
+            'streaming': 正在边录边传的录像数,
+            'failing': 上传失败过的录像数,
+            'failures': 累计失败次数,
+            'oldest_seconds': 最早的待上传录像已等待的时间(上传延迟),
+            'spool_bytes': 录像目录占用的字节数,
+            'free_bytes': 所在磁盘的剩余空间,
+            'errors': 最近失败的录像 [{'path', 'attempts', 'error', 'next_retry'}, ...],
+        }
+        """
+        now = time.time()
+        journals = self.journals()
+        pending = [journal for journal in journals if journal.closed]
+        failing = sorted((journal for journal in pending if journal.attempts), key=lambda j: -j.next_retry)
+        spool_bytes = 0
+        for root, _, files in os.walk(self.spool_dir):
+            for name in files:
+                try:
+                    spool_bytes += os.path.getsize(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass
+        return {
+            'pending': len(pending),
+            'streaming': len(journals) - len(pending),
+            'failing': len(failing),
+            'failures': sum(journal.attempts for journal in pending),
+            'oldest_seconds': round(now - min(journal.created for journal in pending), 1) if pending else 0,
+            'spool_bytes': spool_bytes,
+            'free_bytes': shutil.disk_usage(self.spool_dir).free if os.path.exists(self.spool_dir) else 0,
+            'errors': [{
+                'path': journal.path, 'attempts': journal.attempts,
+                'error': journal.last_error, 'next_retry': journal.next_retry
+            } for journal in failing[:10]],
+        }
+
+
+recording_spool = RecordingSpool()
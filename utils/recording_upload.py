@@ -0,0 +1,279 @@
+"""
+录像边录边传: 本地录像文件超过 PART_SIZE 后切出一个分片上传到 minio, 会话结束时上传剩余部分并合并
+本地只保留正在写的文件和最多一个待上传的分片, 上传跟得上录像时每个会话占用的磁盘不超过 2 * PART_SIZE
+每个已上传的分片记录在同名的 .upload 日志中, 进程崩溃后可以据此补传剩余部分并完成合并
+会话结束后每个待上传的录像都有一份日志(见 recording_spool), 上传失败时记录重试次数和下次重试时间
+"""
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.utils.minio_tool import minio_manager
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 是否边录边传
+RECORD_STREAM = getattr(settings, 'TERMINAL_RECORD_STREAM', True)
+# 分片大小, minio/s3 要求除最后一片外不小于 5MB
+PART_SIZE = max(getattr(settings, 'TERMINAL_RECORD_PART_SIZE', 5 * 1024 * 1024), 5 * 1024 * 1024)
+# 上传分片的线程数
+UPLOAD_WORKERS = getattr(settings, 'TERMINAL_RECORD_UPLOAD_WORKERS', 2)
+JOURNAL_SUFFIX = '.upload'
+PART_SUFFIX = '.part{}'
+
+
+def current_owner():
+    """
+    当前进程的标识(主机名:pid), 在调用时取 pid, fork 出的子进程不会沿用父进程的
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def owner_alive(owner):
+    """
+    :param owner: 日志中记录的写入进程
+    :return: 写入进程是否还在运行, 不是本机的进程或没有记录时返回 None(无法判断)
+    """
+    if not owner:
+        return None
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def part_path(path, number):
+    return path + PART_SUFFIX.format(number)
+
+
+def object_name(path):
+    return "{}-{}".format('video-playback', os.path.basename(path))
+
+
+class UploadJournal(object):
+    """
+    分片上传日志: upload_id, 已上传的分片 [(分片号, etag), ...], 以及完成后登记回放记录需要的会话信息
+    每次更新都先写临时文件再替换, 崩溃时不会留下写了一半的日志
+    录像打开时就写入日志并记下写入进程(owner), 进行中的录像不会被当作孤儿录像收编, 录像结束后清除 owner
+    """
+    FIELDS = (
+        'upload_id', 'parts', 'meta', 'next_part', 'offset', 'closed', 'uploaded',
+        'attempts', 'next_retry', 'last_error', 'created', 'owner'
+    )
+
+    def __init__(self, path, upload_id=None, parts=None, meta=None, next_part=1, offset=0, closed=False,
+                 uploaded=False, attempts=0, next_retry=0, last_error=None, created=None, owner=None):
+        """
+        :param offset: 会话结束后正在写的文件已上传到的位置
+        :param closed: 会话是否已结束
+        :param uploaded: 录像是否已上传完成(只差登记回放记录)
+        :param attempts: 失败次数
+        :param next_retry: 下次重试的时间
+        :param created: 进入待上传队列的时间
+        :param owner: 正在写录像的进程, 见 current_owner
+        """
+        self.path = path
+        self.upload_id = upload_id
+        self.parts = parts or []
+        self.meta = meta or {}
+        self.next_part = next_part
+        self.offset = offset
+        self.closed = closed
+        self.uploaded = uploaded
+        self.attempts = attempts
+        self.next_retry = next_retry
+        self.last_error = last_error
+        self.created = created or time.time()
+        self.owner = owner
+
+    @property
+    def bucket_name(self):
+        return settings.MINIO_BUCKET_NAME
+
+    @property
+    def object_name(self):
+        return object_name(self.path)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(journal_path(path)):
+            return None
+        with open(journal_path(path)) as f:
+            data = json.load(f)
+        data['parts'] = [tuple(part) for part in data.get('parts', [])]
+        return cls(path, **{field: data[field] for field in cls.FIELDS if field in data})
+
+    def save(self):
+        tmp = journal_path(self.path) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({field: getattr(self, field) for field in self.FIELDS}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, journal_path(self.path))
+
+    def remove(self):
+        if os.path.exists(journal_path(self.path)):
+            os.remove(journal_path(self.path))
+
+    def start(self):
+        self.upload_id = minio_manager.create_multipart_upload(self.bucket_name, self.object_name)
+        self.save()
+
+    def upload_part_file(self, number):
+        """
+        上传一个已切出的分片文件, 成功后记入日志并删除本地文件
+        """
+        filename = part_path(self.path, number)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        etag = minio_manager.upload_part(self.bucket_name, self.object_name, self.upload_id, number, data)
+        self.parts.append((number, etag))
+        self.save()
+        os.remove(filename)
+
+    def upload_tail(self):
+        """
+        会话结束后正在写的文件按 PART_SIZE 分片上传, 每片上传后记入日志, 中断后从 offset 继续
+        """
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            while self.offset < size:
+                f.seek(self.offset)
+                data = f.read(PART_SIZE)
+                etag = minio_manager.upload_part(
+                    self.bucket_name, self.object_name, self.upload_id, self.next_part, data
+                )
+                self.parts.append((self.next_part, etag))
+                self.next_part += 1
+                self.offset += len(data)
+                self.save()
+
+    def finish(self):
+        """
+        上传剩余的分片文件和正在写的文件, 合并所有分片
+        """
+        uploaded = {number for number, _ in self.parts}
+        for number in range(1, self.next_part):
+            if number not in uploaded and os.path.exists(part_path(self.path, number)):
+                self.upload_part_file(number)
+        self.upload_tail()
+        minio_manager.complete_multipart_upload(
+            self.bucket_name, self.object_name, self.upload_id, sorted(self.parts)
+        )
+
+    def upload(self):
+        """
+        上传录像, 可重复调用: 没有切出过分片的小文件直接上传, 否则从中断处续传并合并
+        """
+        if self.uploaded:
+            return
+        if self.upload_id is None and self.next_part == 1 and os.path.getsize(self.path) <= PART_SIZE:
+            minio_manager.file_upload(
+                bucket_name=self.bucket_name, object_name=self.object_name, file_path=self.path
+            )
+        else:
+            if self.upload_id is None:
+                self.start()
+            self.finish()
+        self.uploaded = True
+        self.save()
+
+
+class StreamingUpload(object):
+    """
+    录像写线程在每次组提交后调用 check: 本地文件超过 PART_SIZE 就切出分片交给上传线程池,
+    每个录像同时只有一个分片在上传, 上一个还没传完时跳过这次切分(本地文件继续增长, 下次切出的分片更大),
+    写线程不等待上传; 开始分片上传(create_multipart_upload)也在上传线程中进行,
+    失败后该录像不再边录边传, 已切出的分片和剩余部分在会话结束后由上传任务补传
+    """
+    executor = None
+    _lock = threading.Lock()
+
+    def __init__(self, journal):
+        """
+        :param journal: 录像打开时写入的上传日志
+        """
+        self.path = journal.path
+        self.journal = journal
+        self.future = None
+        self.failed = False
+
+    @classmethod
+    def get_executor(cls):
+        with cls._lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix='terminal-record-upload')
+        return cls.executor
+
+    def check(self, sink):
+        if self.failed or sink.local_size < PART_SIZE:
+            return
+        if self.future is not None:
+            if not self.future.done():
+                return
+            self.future = None
+        # 上传线程中没有该录像的任务, 这里更新日志不会和上传线程冲突; 先记下分片号再切分, 崩溃后能找到分片文件
+        number = self.journal.next_part
+        self.journal.next_part += 1
+        self.journal.save()
+        sink.rotate(part_path(self.path, number))
+        self.future = self.get_executor().submit(self._upload, number)
+
+    def _upload(self, number):
+        try:
+            if self.journal.upload_id is None:
+                self.journal.start()
+        except:
+            # 不再每次切分都重试, 分片文件保留在本地, 结束时由上传任务开始分片上传并补传
+            logger.error(traceback.format_exc())
+            self.failed = True
+            return
+        try:
+            self.journal.upload_part_file(number)
+        except:
+            # 分片文件保留在本地, 结束时或崩溃恢复时重传
+            logger.error(traceback.format_exc())
+
+    def then(self, callback):
+        """
+        正在上传的分片传完后在上传线程中调用 callback, 没有正在上传的分片时立即调用
+        """
+        def run(_=None):
+            try:
+                callback()
+            except:
+                logger.error(traceback.format_exc())
+
+        future = self.future
+        if future is None:
+            run()
+        else:
+            future.add_done_callback(run)
+
+
+def recover_uploads(record_dir):
+    """
+    查找崩溃遗留的上传日志
+    :return: 录像文件路径列表
+    """
+    pattern = os.path.join(record_dir, '**', '*' + JOURNAL_SUFFIX)
+    return [name[:-len(JOURNAL_SUFFIX)] for name in glob.glob(pattern, recursive=True)]
@@ -0,0 +1,322 @@
+import collections
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from apps.utils.cast_format import open_sink
+from apps.utils.recording_upload import StreamingUpload, UploadJournal, RECORD_STREAM, current_owner
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 待写入的批次上限(每个批次是一个会话的一组事件)
+RECORD_QUEUE_SIZE = getattr(settings, 'TERMINAL_RECORD_QUEUE_SIZE', 10000)
+# 组提交间隔(秒): 写线程最多攒这么久的数据再统一 flush
+RECORD_FLUSH_INTERVAL = getattr(settings, 'TERMINAL_RECORD_FLUSH_INTERVAL', 1)
+# fsync 策略: never 不主动 fsync, close 录像结束时 fsync, interval 每次组提交都 fsync
+RECORD_FSYNC = getattr(settings, 'TERMINAL_RECORD_FSYNC', 'close')
+# 队列满时的处理方式: drop 丢弃并在录像中留下标记,
+# block 暂存在录像的积压中, 下次写入或关闭时再交给写线程, 积压超过 RECORD_BACKLOG 个事件后再丢弃
+# 两种方式都不会阻塞调用方(轮询线程)
+RECORD_OVERFLOW = getattr(settings, 'TERMINAL_RECORD_OVERFLOW', 'drop')
+RECORD_BACKLOG = getattr(settings, 'TERMINAL_RECORD_BACKLOG', 10000)
+# 单次写入的最大批次数
+RECORD_BATCH_SIZE = 500
+# 录像格式: cast 普通 asciicast v2, castz 分帧压缩并带时间索引
+RECORD_FORMAT = getattr(settings, 'TERMINAL_RECORD_FORMAT', 'cast')
+# 打开、关闭录像的请求
+OPEN = 'open'
+CLOSE = 'close'
+# 唤醒写线程的空批次
+WAKEUP = (None, None)
+
+
+class RecordStats(object):
+    """
+    录像写入计数
+    """
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self.commits = 0
+        self.fsyncs = 0
+        self.dropped = 0
+        self.max_commit_time = 0
+
+    def as_dict(self):
+        return {
+            'events': self.events, 'batches': self.batches, 'commits': self.commits,
+            'fsyncs': self.fsyncs, 'dropped': self.dropped,
+            'max_commit_time': round(self.max_commit_time, 4),
+        }
+
+
+class Recording(object):
+    """
+    一个录像文件, 只在写线程中打开和写入; 会话线程调用 write/close 只是把数据或请求交给写线程, 不会阻塞
+    """
+    def __init__(self, writer, path, header, meta=None):
+        self.writer = writer
+        self.path = path
+        self.header = header
+        self.sink = None
+        # meta 为完成上传后登记回放记录需要的会话信息, 打开录像时写入上传日志
+        self.meta = meta
+        self.journal = None
+        self.upload = None  # 边录边传
+        self.dirty = False
+        self.closed = False
+        self.finished = False  # 写线程已关闭文件
+        self.pending = 0  # 队列中尚未写入的批次数
+        self.backlog = []  # block 方式下队列已满时暂存的事件
+        self.dropped = 0  # 尚未写入标记的丢弃事件数
+        self.last_time = 0  # 最近一个事件的时间, 用于丢弃标记
+        self._lock = threading.Lock()
+
+    def write(self, events):
+        """
+        :param events: asciicast 事件列表 [[时间, 类型, 数据], ...]
+        :return: 是否已放入队列
+        """
+        if not events or self.closed:
+            return False
+        events = list(events)
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                # 之前有丢弃的事件, 在这一批前面补一个标记
+                events.insert(0, [self.last_time, 'm', 'recording dropped {} events'.format(dropped)])
+            self.last_time = events[-1][0]
+            if self.backlog:
+                events = self.backlog + events
+                self.backlog = []
+            # 先计数再放入队列, 写线程处理关闭请求时据此判断队列中是否还有该录像的数据
+            self.pending += 1
+        if self.writer.put(self, events):
+            return True
+        with self._lock:
+            self.pending -= 1
+            if self.writer.overflow == 'block' and len(events) <= RECORD_BACKLOG:
+                self.backlog = events
+                return True
+            lost = len(events) - (1 if dropped else 0)
+            self.dropped += lost + dropped
+        self.writer.stats.dropped += lost
+        return False
+
+    def close(self, callback=None):
+        """
+        写完队列中该录像的剩余数据后关闭文件, 然后调用 callback(如上传录像), 有分片正在上传时等它传完再调用
+        关闭请求不经过有界队列, 队列已满时也不会阻塞或丢弃
+        """
+        if self.closed:
+            return
+        self.closed = True
+        with self._lock:
+            backlog, self.backlog = self.backlog, []
+        self.writer.request(CLOSE, self, backlog, callback)
+
+    def open(self):
+        # 先写日志再创建录像文件, 进行中的录像总有日志, 不会被 recording_spool 当作孤儿录像收编
+        self.journal = UploadJournal(self.path, meta=self.meta, owner=current_owner())
+        self.journal.save()
+        self.sink = open_sink(self.path, self.header, RECORD_FORMAT)
+        self.dirty = True
+        if RECORD_STREAM:
+            self.upload = StreamingUpload(self.journal)
+
+    def commit(self, fsync=False):
+        if self.sink is None or not self.dirty:
+            return False
+        self.sink.flush(fsync)
+        self.dirty = False
+        if self.upload:
+            self.upload.check(self.sink)
+        return True
+
+    def finish(self):
+        self.finished = True
+        if self.sink is None:
+            return
+        if self.dropped:
+            self.sink.write([[self.last_time, 'm', 'recording dropped {} events'.format(self.dropped)]])
+        self.sink.close(fsync=RECORD_FSYNC != 'never')
+        self.sink = None
+        self.dirty = False
+
+    def after_upload(self, callback=None):
+        """
+        正在上传的分片传完后清除日志的 owner, 再调用 callback(剩余部分由上传任务补传并合并), 写线程不等待上传
+        清除 owner 后上传任务没有处理的录像按日志的更新时间由 recording_spool 重试
+        """
+        def release():
+            if self.journal is not None:
+                self.journal.owner = None
+                self.journal.created = time.time()
+                self.journal.save()
+            if callback:
+                callback()
+
+        if self.upload:
+            self.upload.then(release)
+            return
+        try:
+            release()
+        except:
+            logger.error(traceback.format_exc())
+
+
+class RecordingWriter(object):
+    """
+    录像写线程: 会话只负责把事件放进有界队列, 编码和磁盘写入都在这个线程里完成
+    每次从队列取出一批数据, 按录像分组后一次编码、一次 write, 每 RECORD_FLUSH_INTERVAL 秒统一 flush(组提交),
+    磁盘变慢时队列会满, 按 RECORD_OVERFLOW 丢弃并在录像中留下标记, 终端输出不受影响
+    打开、关闭录像的请求放在单独的无界队列中, 会话线程(包括轮询线程)发出请求时不会阻塞;
+    关闭请求等有界队列中该录像的数据都写完后再处理
+    """
+    def __init__(self, maxsize=RECORD_QUEUE_SIZE, flush_interval=RECORD_FLUSH_INTERVAL, fsync=RECORD_FSYNC,
+                 overflow=RECORD_OVERFLOW):
+        self.queue = queue.Queue(maxsize)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.overflow = overflow
+        self.stats = RecordStats()
+        self.stop = True
+        self._dirty = set()
+        self._requests = collections.deque()  # (请求, 录像, 事件, 回调)
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        检查写线程是否启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        t = threading.Thread(target=self.run, name='terminal-record-writer', daemon=True)
+        t.start()
+
+    def open(self, path, header, meta=None):
+        """
+        :param path: 录像文件路径
+        :param header: asciicast 文件头
+        :param meta: 会话信息, 边录边传时记入上传日志
+        :return: Recording
+        """
+        self.check()
+        recording = Recording(self, path, header, meta)
+        self.request(OPEN, recording)
+        return recording
+
+    def put(self, recording, events):
+        try:
+            self.queue.put_nowait((recording, events))
+            return True
+        except queue.Full:
+            return False
+
+    def request(self, action, recording, events=None, callback=None):
+        self._requests.append((action, recording, events, callback))
+        if self.queue.empty():
+            # 队列中有数据时写线程很快就会醒来, 不占用队列的位置
+            try:
+                self.queue.put_nowait(WAKEUP)
+            except queue.Full:
+                pass
+
+    def run(self):
+        last_commit = time.time()
+        while True:
+            timeout = max(self.flush_interval - (time.time() - last_commit), 0.01)
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < RECORD_BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.handle(items)
+            except:
+                logger.error(traceback.format_exc())
+            self.handle_requests()
+            if time.time() - last_commit >= self.flush_interval:
+                self.commit()
+                last_commit = time.time()
+
+    def handle(self, items):
+        # 按录像分组, 每个录像一次编码、一次写入
+        batches = {}
+        for recording, events in items:
+            if recording is None:
+                continue
+            with recording._lock:
+                recording.pending -= 1
+            batches.setdefault(recording, []).append(events)
+        for recording, groups in batches.items():
+            self.write(recording, groups)
+
+    def write(self, recording, groups):
+        if recording.finished:
+            # 与关闭请求同时发出的数据, 文件已关闭, 不再重新打开
+            return
+        try:
+            if recording.sink is None:
+                recording.open()
+            events = [event for events in groups for event in events]
+            if events:
+                recording.sink.write(events)
+                recording.dirty = True
+                self._dirty.add(recording)
+                self.stats.events += len(events)
+            self.stats.batches += len(groups)
+        except:
+            logger.error(traceback.format_exc())
+
+    def handle_requests(self):
+        for _ in range(len(self._requests)):
+            action, recording, events, callback = self._requests.popleft()
+            if action == OPEN:
+                if recording.sink is None and not recording.finished:
+                    self.write(recording, [])
+                continue
+            if recording.pending > 0:
+                # 队列中还有该录像的数据, 下一轮再关闭
+                self._requests.append((action, recording, events, callback))
+                continue
+            if events:
+                self.write(recording, [events])
+            try:
+                recording.finish()
+            except:
+                logger.error(traceback.format_exc())
+            finally:
+                self._dirty.discard(recording)
+            recording.after_upload(callback)
+
+    def commit(self):
+        """
+        组提交: 把这段时间写过的录像统一 flush(按策略 fsync)
+        """
+        if not self._dirty:
+            return
+        start = time.time()
+        fsync = self.fsync == 'interval'
+        for recording in list(self._dirty):
+            try:
+                if recording.commit(fsync=fsync) and fsync:
+                    self.stats.fsyncs += 1
+            except:
+                logger.error(traceback.format_exc())
+        self._dirty.clear()
+        self.stats.commits += 1
+        self.stats.max_commit_time = max(self.stats.max_commit_time, time.time() - start)
+
+
+recording_writer = RecordingWriter()
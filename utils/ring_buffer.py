@@ -0,0 +1,39 @@
+import collections
+import threading
+
+
+class RingBuffer(object):
+    """
+    按字节数限制的环形缓冲区, 超过上限时丢弃最早的数据块
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if not data or self.max_bytes <= 0:
+            return
+        if len(data) > self.max_bytes:
+            data = data[-self.max_bytes:]
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                self._size -= len(self._chunks.popleft())
+
+    def snapshot(self):
+        """
+        :return: 缓冲区中的全部数据
+        """
+        with self._lock:
+            return b''.join(self._chunks)
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._size = 0
@@ -0,0 +1,268 @@
+"""
+会话全文索引: 录像上传完成后, 把终端输出和还原的命令分词写入 redis 倒排表, 供审计按关键词查找会话
+
+倒排表是 zset, 成员为会话文档 id, 分数为会话开始时间, 按时间过滤和排序不需要读取文档:
+    terminal:fts:o:{词}          输出中出现该词的会话
+    terminal:fts:c:{词}          命令中出现该词的会话
+    terminal:fts:o2:{词} {词}    输出中出现该相邻词对的会话(短语查询)
+    terminal:fts:c2:{词} {词}
+    terminal:fts:user:{id} / terminal:fts:asset:{id}  按用户/资产过滤
+查询时各条件的 zset 做一次 ZINTERSTORE, 再按时间范围分页, 耗时只与命中的倒排表大小有关, 与会话总数无关
+短语按相邻词对匹配: 短语中每一对相邻的词都在会话中相邻出现过即命中
+索引保留 RETENTION 秒(默认与录像的保留时间相同): 文档按会话开始时间过期, 倒排表每次写入后续期,
+长期没有新会话出现的词整个过期; purge 定时删除倒排表中超过保留时间的会话
+"""
+import re
+import time
+import uuid
+
+from apps.utils.redis_tool import default_redis
+from rzx_jms import settings
+
+FTS_PREFIX = 'terminal:fts:'
+TERM_KEY = FTS_PREFIX + '{}:{}'
+BIGRAM_KEY = FTS_PREFIX + '{}2:{} {}'
+DOC_KEY = FTS_PREFIX + 'doc:{}'
+DOC_SEQ_KEY = FTS_PREFIX + 'seq'
+USER_KEY = FTS_PREFIX + 'user:{}'
+ASSET_KEY = FTS_PREFIX + 'asset:{}'
+ALL_DOCS_KEY = FTS_PREFIX + 'docs'
+FIELD_OUTPUT = 'o'
+FIELD_COMMAND = 'c'
+
+# 每个会话最多索引的不同词/词对数量, 防止刷屏输出撑爆 redis
+MAX_TERMS = getattr(settings, 'TERMINAL_FTS_MAX_TERMS', 50000)
+MAX_BIGRAMS = getattr(settings, 'TERMINAL_FTS_MAX_BIGRAMS', 50000)
+# 索引的保留时间(秒), 默认跟随录像的保留时间, 录像删除后不再能检索到
+RETENTION = getattr(settings, 'TERMINAL_FTS_RETENTION',
+                    getattr(settings, 'TERMINAL_RECORDING_RETENTION', 180 * 24 * 3600))
+# 查询中间结果的过期时间(秒)
+QUERY_TTL = 60
+PIPELINE_SIZE = 1000
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-_]')
+TOKEN = re.compile(r'-{0,2}\w[\w\-.@:/+=]*')
+SUB_TOKEN = re.compile(r'\w+')
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """
+    分词: 小写, 保留 - . @ : / + = 连接的整体(如 api key、路径、ip、-F 这类命令参数), 同时拆出其中的字母数字片段
+    :return: 按出现顺序的词列表(拆出的片段紧跟在整体之后, 不参与词对)
+    """
+    tokens = []
+    for match in TOKEN.finditer(text.lower()):
+        token = match.group().rstrip('.:/-')[:64]
+        if len(token) < 2:
+            continue
+        tokens.append((token, True))
+        if not token.isalnum():
+            for sub in SUB_TOKEN.findall(token):
+                if len(sub) >= 2 and sub != token:
+                    tokens.append((sub, False))
+    return tokens
+
+
+class SessionIndexer(object):
+    """
+    一个会话的索引: 边读录像边 feed, 最后 commit 一次性用 pipeline 写入
+    """
+    def __init__(self, object_name, start_time, meta=None):
+        self.object_name = object_name
+        self.start_time = start_time
+        self.meta = meta or {}
+        self.terms = {FIELD_OUTPUT: set(), FIELD_COMMAND: set()}
+        self.bigrams = {FIELD_OUTPUT: set(), FIELD_COMMAND: set()}
+        self._pending = ''
+        self._last = {FIELD_OUTPUT: None, FIELD_COMMAND: None}
+
+    def _add(self, field, text, join_previous=True):
+        terms, bigrams = self.terms[field], self.bigrams[field]
+        last = self._last[field] if join_previous else None
+        for token, whole in tokenize(text):
+            if len(terms) < MAX_TERMS:
+                terms.add(token)
+            if not whole:
+                continue
+            if last is not None and len(bigrams) < MAX_BIGRAMS:
+                bigrams.add((last, token))
+            last = token
+        self._last[field] = last
+
+    def feed_output(self, text):
+        # 事件边界可能切断一个词, 只处理到最后一个空白, 剩余部分留到下一次
+        text = self._pending + text
+        cut = max(text.rfind(' '), text.rfind('\n'))
+        if cut < 0 and len(text) < 256:
+            self._pending = text
+            return
+        cut = cut if cut >= 0 else len(text)
+        self._pending = text[cut:]
+        self._add(FIELD_OUTPUT, ANSI_ESCAPE.sub(' ', text[:cut]))
+
+    def feed_command(self, command):
+        # 每条命令单独成句, 词对不跨命令
+        self._add(FIELD_COMMAND, command, join_previous=False)
+
+    def commit(self):
+        """
+        :return: 文档 id
+        """
+        if self._pending:
+            self._add(FIELD_OUTPUT, ANSI_ESCAPE.sub(' ', self._pending))
+            self._pending = ''
+        doc_id = default_redis.incr(DOC_SEQ_KEY)
+        score = self.start_time
+        doc = dict(self.meta, object_name=self.object_name, start_time=self.start_time)
+        doc_key = DOC_KEY.format(doc_id)
+        pipe = default_redis.pipeline(transaction=False)
+        pipe.hset(doc_key, mapping={k: v for k, v in doc.items() if v is not None})
+        pipe.expireat(doc_key, int((score or time.time()) + RETENTION))
+        pipe.zadd(ALL_DOCS_KEY, {doc_id: score})
+        if self.meta.get('user_id') is not None:
+            pipe.zadd(USER_KEY.format(self.meta['user_id']), {doc_id: score})
+        if self.meta.get('asset_id') is not None:
+            pipe.zadd(ASSET_KEY.format(self.meta['asset_id']), {doc_id: score})
+        count = 0
+        for field in (FIELD_OUTPUT, FIELD_COMMAND):
+            keys = [TERM_KEY.format(field, term) for term in self.terms[field]]
+            keys += [BIGRAM_KEY.format(field, a, b) for a, b in self.bigrams[field]]
+            for key in keys:
+                # 倒排表随写入续期, 只出现在已过期会话中的词不会一直留在 redis 里
+                pipe.zadd(key, {doc_id: score})
+                pipe.expire(key, RETENTION)
+                count += 1
+                if count % PIPELINE_SIZE == 0:
+                    pipe.execute()
+        pipe.execute()
+        return doc_id
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def purge(before=None):
+    """
+    删除倒排表和用户/资产/全部会话列表中开始时间早于 before 的会话, 由 celery beat 定时执行
+    文档本身按 expireat 过期, 这里只清理仍被其它会话续期的倒排表中的过期成员
+    :param before: 时间戳, 默认为当前时间减去 RETENTION
+    :return: 删除的成员数
+    """
+    before = before if before is not None else time.time() - RETENTION
+    skip = (DOC_KEY.format(''), FTS_PREFIX + 'tmp:', DOC_SEQ_KEY)
+    removed = 0
+    pipe = default_redis.pipeline(transaction=False)
+    pending = 0
+    for key in default_redis.scan_iter(match=FTS_PREFIX + '*', count=PIPELINE_SIZE):
+        if _decode(key).startswith(skip):
+            continue
+        pipe.zremrangebyscore(key, '-inf', '({}'.format(before))
+        pending += 1
+        if pending >= PIPELINE_SIZE:
+            removed += sum(pipe.execute())
+            pending = 0
+    if pending:
+        removed += sum(pipe.execute())
+    return removed
+
+
+def parse_query(query):
+    """
+    'iptables -F "api key"' -> [['iptables'], ['-f'], ['api', 'key']]
+    每一项是一个词或一个短语(多个词), 各项之间是 AND
+    """
+    parts = []
+    for phrase, word in QUERY_PART.findall(query):
+        text = phrase if phrase else word
+        tokens = [token for token, whole in tokenize(text) if whole]
+        if not tokens:
+            # 单个字母等分词后为空的, 按原样查询
+            token = text.lower().lstrip('-')
+            tokens = [token] if token else []
+        if tokens:
+            parts.append(tokens)
+    return parts
+
+
+class SessionSearch(object):
+    def _part_keys(self, tokens, field):
+        if len(tokens) == 1:
+            return [TERM_KEY.format(field, tokens[0])]
+        return [BIGRAM_KEY.format(field, a, b) for a, b in zip(tokens, tokens[1:])]
+
+    def search(self, query, field=None, user_id=None, asset_id=None, start=None, end=None, offset=0, limit=50):
+        """
+        :param query: 查询语句, 空格分隔的词之间为 AND, 双引号括起来的是短语
+        :param field: o 只查输出, c 只查命令, None 都查
+        :param start: 会话开始时间下限(时间戳)
+        :param end: 会话开始时间上限(时间戳)
+        :return: (命中总数, [文档, ...]) 按会话开始时间倒序
+        """
+        parts = parse_query(query)
+        if not parts:
+            return 0, []
+        fields = [field] if field else [FIELD_OUTPUT, FIELD_COMMAND]
+        tmp_prefix = FTS_PREFIX + 'tmp:' + uuid.uuid4().hex
+        tmp_keys = []
+        pipe = default_redis.pipeline(transaction=False)
+        keys = []
+        for i, tokens in enumerate(parts):
+            if len(fields) == 1:
+                part_keys = self._part_keys(tokens, fields[0])
+                keys.extend(part_keys)
+                continue
+            # 同一项在输出或命令中命中都算: 先在每个字段内求交集, 再求并集
+            union = []
+            for f in fields:
+                part_keys = self._part_keys(tokens, f)
+                if len(part_keys) == 1:
+                    union.append(part_keys[0])
+                    continue
+                key = '{}:{}:{}'.format(tmp_prefix, i, f)
+                pipe.zinterstore(key, part_keys, aggregate='MIN')
+                tmp_keys.append(key)
+                union.append(key)
+            key = '{}:{}'.format(tmp_prefix, i)
+            pipe.zunionstore(key, union, aggregate='MIN')
+            tmp_keys.append(key)
+            keys.append(key)
+        if user_id is not None:
+            keys.append(USER_KEY.format(user_id))
+        if asset_id is not None:
+            keys.append(ASSET_KEY.format(asset_id))
+        if len(keys) == 1:
+            result_key = keys[0]
+        else:
+            result_key = tmp_prefix
+            pipe.zinterstore(result_key, keys, aggregate='MIN')
+            tmp_keys.append(result_key)
+        low = start if start is not None else '-inf'
+        high = end if end is not None else '+inf'
+        pipe.zcount(result_key, low, high)
+        pipe.zrevrangebyscore(result_key, high, low, start=offset, num=limit)
+        for key in tmp_keys:
+            pipe.expire(key, QUERY_TTL)
+        results = pipe.execute()
+        base = len(results) - len(tmp_keys)
+        total, doc_ids = results[base - 2], results[base - 1]
+        if tmp_keys:
+            default_redis.delete(*tmp_keys)
+        if not doc_ids:
+            return total, []
+        pipe = default_redis.pipeline(transaction=False)
+        for doc_id in doc_ids:
+            pipe.hgetall(DOC_KEY.format(_decode(doc_id)))
+        docs = []
+        for doc_id, doc in zip(doc_ids, pipe.execute()):
+            if not doc:
+                # 文档已过期, 倒排表中的成员等待 purge 清理
+                continue
+            doc = {_decode(k): _decode(v) for k, v in doc.items()}
+            doc['id'] = int(_decode(doc_id))
+            docs.append(doc)
+        return total, docs
+
+
+session_search = SessionSearch()
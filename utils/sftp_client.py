@@ -10,6 +10,9 @@ import paramiko
 from paramiko import BadHostKeyException, AuthenticationException, SSHException
 
 from apps.common.consts import WsCode
+from apps.utils.sftp_download import SFTPDownload
+from apps.utils.sftp_upload import SFTPUpload
+from apps.utils.ssh_transport_pool import transport_pool
 from apps.utils.ws_data_format import WsDataFormat
 from rzx_jms import settings
 
@@ -37,8 +40,8 @@ class SFTPClient(object):
 
     def sftp_connect(self):
         try:
-            self.transport = paramiko.Transport(sock=(self.ip, self.port))
-            self.transport.connect(username=self.username, password=self.password)
+            # 与终端共用 transport_pool 中的同一个已认证连接, 只新开一个 sftp channel
+            self.transport = transport_pool.acquire(self.ip, self.port, self.username, self.password)
             self.sftp = paramiko.SFTPClient.from_transport(self.transport)
             # 切换到默认目录
             try:
@@ -68,7 +71,13 @@ class SFTPClient(object):
             )
 
     def close(self):
-        self.sftp.close()
+        try:
+            if self.sftp:
+                self.sftp.close()
+        finally:
+            if self.transport:
+                transport_pool.release(self.transport)
+                self.transport = None
 
     def create_file(self, name):
         """
@@ -131,53 +140,49 @@ class SFTPClient(object):
             res.append({'name': f.filename, 'is_dir': is_dir, 'id': index})
         return res
 
+    def upload_open(self, file_path, on_ack=None, on_error=None):
+        """
+        :param file_path: 上传的目标文件
+        :param on_ack: 数据帧写入完成的回调 on_ack(帧序号, 已写入的字节数)
+        :param on_error: 写入失败的回调 on_error(upload)
+        :return: SFTPUpload, 使用单独的 sftp channel, 上传期间可以继续浏览目录
+        """
+        return SFTPUpload.open(self, file_path, 'ab', on_ack=on_ack, on_error=on_error)
+
     def file_upload(
-            self, write_fd, bytes_data,
+            self, upload, bytes_data,
     ):
         """
-        :param write_fd:
+        放入写入线程的队列, 不等待写入
+        :param upload: SFTPUpload
         :param bytes_data:
-        :return:
+        :return: 帧序号
         """
-        write_fd.write(bytes_data)
+        return upload.feed(bytes_data)
 
     def file_download(
-            self, filename, prefetch=True
+            self, filename, window=0, on_done=None
     ):
         """
+        在后台线程中下载, 立即返回
         :param filename:
-        :param prefetch:
-        :return:
+        :param window: 浏览器的接收窗口(字节), 0 表示使用默认窗口
+        :param on_done: 下载结束的回调 on_done(download)
+        :return: SFTPDownload, 失败时返回 None
         """
         try:
             file_path = os.path.join(self.current_path, filename)
             file_stat = self.sftp.stat(file_path)
-            origin_file_size = file_stat.st_size
             if stat.S_ISDIR(file_stat.st_mode):
                 msg = {"code": WsCode.ERROR.value, "message": "仅支持文件下载！"}
                 self.ws.send(text_data=json.dumps(msg))
-                return False
-
-            with self.sftp.open(file_path, "rb") as fr:
-                if prefetch:
-                    fr.prefetch(origin_file_size)
-                while True:
-                    data = fr.read(32768)
-                    if len(data) == 0:
-                        # 数据传输结束后 发一个空包 带文件大小，通知客户端下载结束，并校验文件大小
-                        self.ws.send(
-                            bytes_data=b''
-                        )
-                        break
-                    else:
-                        self.ws.send(
-                            bytes_data=data
-                        )
-            return origin_file_size
+                return None
+            download = SFTPDownload(self, file_path, file_stat.st_size, window=window, on_done=on_done)
+            download.start()
+            return download
         except:
             logger.error(traceback.format_exc())
-            print(traceback.format_exc())
-            return 0
+            return None
 
     def change_name(self, old_filename, new_filename):
         old_path = os.path.join(self.current_path, old_filename)
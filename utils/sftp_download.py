@@ -0,0 +1,225 @@
+"""
+SFTP 后台下载: 下载在单独的线程中进行, 不再占用 websocket 的消息处理, 下载过程中可以继续浏览目录、取消下载
+    使用从连接池取得的 ssh 连接上新开的 sftp channel, 与浏览目录的 channel 互不阻塞
+    读取: 流水线发出 read 请求, 在途请求不超过 READ_WINDOW 个, 预读的数据有上限(不再 prefetch 整个文件)
+    发送: 每帧的大小按实际发送速度调整, 使每帧的发送时间约为 FRAME_SECONDS, 慢速连接上进度和取消依然及时
+    流控: 已发送未确认的数据不超过 window 字节, 浏览器按已接收的字节数回复 ack,
+        发送速度跟随浏览器实际接收的速度, 不会在 websocket 的发送缓冲中堆积数据
+        浏览器没有带 window 参数时使用 DOWNLOAD_WINDOW, 下载开始时的进度消息中告知浏览器
+    每 PROGRESS_INTERVAL 秒发送一次进度, 结束(完成、取消、失败)时再发送一次
+"""
+import collections
+import json
+import logging
+import threading
+import time
+import traceback
+
+import paramiko
+from paramiko import SFTPError
+from paramiko.sftp import CMD_DATA, CMD_READ, int64
+
+from apps.common.consts import WsCode
+from apps.utils.ssh_transport_pool import transport_pool
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 单个 read 请求的大小
+READ_SIZE = getattr(settings, 'TERMINAL_SFTP_READ_SIZE', 32 * 1024)
+# 在途的 read 请求数, 预读的数据不超过 READ_WINDOW * READ_SIZE
+READ_WINDOW = getattr(settings, 'TERMINAL_SFTP_READ_WINDOW', 64)
+# 帧大小的范围和每帧的目标发送时间(秒)
+MIN_FRAME = 32 * 1024
+MAX_FRAME = getattr(settings, 'TERMINAL_SFTP_MAX_FRAME', 1024 * 1024)
+FRAME_SECONDS = 0.05
+PROGRESS_INTERVAL = getattr(settings, 'TERMINAL_SFTP_PROGRESS_INTERVAL', 0.5)
+# 浏览器没有指定接收窗口时使用的窗口(字节)
+DOWNLOAD_WINDOW = getattr(settings, 'TERMINAL_SFTP_DOWNLOAD_WINDOW', 4 * 1024 * 1024)
+# 浏览器超过该时间(秒)没有回复 ack 视为已停止接收
+ACK_TIMEOUT = 60
+
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+
+class SFTPDownload(object):
+    """
+    一次后台下载, start 启动下载线程, cancel 取消, ack 更新浏览器已接收的字节数
+    """
+    def __init__(self, client, path, total, window=0, on_done=None):
+        """
+        :param client: SFTPClient, 使用其连接信息和 websocket
+        :param path: 远程文件
+        :param total: 文件大小
+        :param window: 浏览器的接收窗口(字节), 0 表示使用 DOWNLOAD_WINDOW
+        :param on_done: 下载结束(完成、取消、失败)的回调 on_done(download), 在下载线程中执行
+        """
+        self.client = client
+        self.ws = client.ws
+        self.path = path
+        self.total = total
+        self.window = window if window and window > 0 else DOWNLOAD_WINDOW
+        self.on_done = on_done
+        self.status = RUNNING
+        self.sent = 0
+        self.acked = 0
+        self.rate = 0  # 发送速度(字节/秒)
+        self.frame_size = MIN_FRAME
+        self.started = None
+        self._cancelled = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='sftp-download', daemon=True)
+        t.start()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def ack(self, size):
+        """
+        :param size: 浏览器已接收的字节数
+        """
+        with self._cond:
+            self.acked = max(self.acked, size)
+            self._cond.notify_all()
+
+    @property
+    def running(self):
+        return self.status == RUNNING
+
+    def run(self):
+        self.started = time.time()
+        transport = sftp = None
+        try:
+            transport = transport_pool.acquire(
+                self.client.ip, self.client.port, self.client.username, self.client.password
+            )
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            with sftp.open(self.path, 'rb') as fd:
+                # 先告知浏览器接收窗口, 再发送数据
+                self.progress()
+                self.transfer(sftp, fd)
+            if self._cancelled:
+                self.status = CANCELLED
+            else:
+                # 数据传输结束后 发一个空包，通知客户端下载结束
+                self.ws.send(bytes_data=b'')
+                self.status = FINISHED
+        except:
+            logger.error(traceback.format_exc())
+            self.status = CANCELLED if self._cancelled else FAILED
+        finally:
+            try:
+                if sftp:
+                    sftp.close()
+            finally:
+                if transport:
+                    transport_pool.release(transport)
+        try:
+            self.progress()
+        except:
+            logger.error(traceback.format_exc())
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def transfer(self, sftp, fd):
+        frame = bytearray()
+        last_progress = time.time()
+        for data in self.read(sftp, fd):
+            frame += data
+            if len(frame) < self.frame_size:
+                continue
+            if not self.send_frame(bytes(frame)):
+                return
+            frame = bytearray()
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                self.progress()
+                last_progress = time.time()
+        if frame and not self._cancelled:
+            self.send_frame(bytes(frame))
+
+    def read(self, sftp, fd):
+        """
+        流水线读取, 按文件顺序返回数据
+        服务端单次返回的数据可能少于请求的长度, 剩余部分重新请求, 先到的后续数据暂存到空缺补齐
+        按发送顺序读取响应: 服务端按顺序响应, paramiko 等待某个响应时会丢弃之前未等待的响应
+        """
+        inflight = collections.deque()  # (请求号, 位置, 长度)
+        ready = {}
+        offset = position = 0
+        while position < self.total and not self._cancelled:
+            while offset < self.total and len(inflight) < READ_WINDOW:
+                size = min(READ_SIZE, self.total - offset)
+                inflight.append((self._request(sftp, fd, offset, size), offset, size))
+                offset += size
+            if not inflight:
+                break
+            num, start, size = inflight.popleft()
+            try:
+                t, msg = sftp._read_response(num)
+            except EOFError:
+                # 文件在下载过程中变短, 只发送现有的部分
+                self.total = min(self.total, start)
+                continue
+            if t != CMD_DATA:
+                raise SFTPError('Expected data')
+            data = msg.get_binary()
+            if 0 < len(data) < size:
+                rest = start + len(data)
+                inflight.append((self._request(sftp, fd, rest, size - len(data)), rest, size - len(data)))
+            if data:
+                ready[start] = data
+            while position in ready:
+                data = ready.pop(position)
+                position += len(data)
+                yield data
+
+    @staticmethod
+    def _request(sftp, fd, offset, size):
+        return sftp._async_request(type(None), CMD_READ, fd.handle, int64(offset), int(size))
+
+    def send_frame(self, frame):
+        """
+        等待浏览器的接收窗口有空间后发送一帧, 并按发送耗时调整下一帧的大小
+        :return: 是否继续下载
+        """
+        start = time.time()
+        with self._cond:
+            last_ack = self.acked
+            deadline = start + ACK_TIMEOUT
+            while not self._cancelled and self.sent - self.acked + len(frame) > self.window \
+                    and self.sent > self.acked:
+                if self.acked != last_ack:
+                    last_ack = self.acked
+                    deadline = time.time() + ACK_TIMEOUT
+                if time.time() > deadline:
+                    raise IOError('download ack timeout')
+                self._cond.wait(1)
+        if self._cancelled:
+            return False
+        self.ws.send(bytes_data=frame)
+        self.sent += len(frame)
+        elapsed = max(time.time() - start, 1e-4)
+        rate = len(frame) / elapsed
+        self.rate = rate if not self.rate else self.rate * 0.7 + rate * 0.3
+        max_frame = min(MAX_FRAME, self.window // 4)
+        self.frame_size = int(min(max(self.rate * FRAME_SECONDS, MIN_FRAME), max(max_frame, MIN_FRAME)))
+        return True
+
+    def progress(self):
+        elapsed = time.time() - self.started if self.started else 0
+        self.ws.send(text_data=json.dumps({
+            "code": WsCode.SUCCESS.value,
+            "message": "progress",
+            "status": self.status,
+            "size": self.sent,
+            "total": self.total,
+            "rate": int(self.sent / elapsed) if elapsed else 0,
+            "window": self.window,
+        }))
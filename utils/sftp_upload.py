@@ -0,0 +1,381 @@
+"""
+SFTP 流水线上传: 浏览器的每个数据帧不再同步写入(每次写入都要等一个 SFTP 往返)
+    帧数据先合并到缓冲区, 每攒满 REQUEST_SIZE 发出一个 write 请求, 不等响应继续发送,
+    在途请求不超过 UPLOAD_WINDOW 个, 超过时才读取最早请求的响应
+    服务器确认写入后按帧回复 ack(累计确认, 带最后确认的帧序号和已写入的字节数),
+    浏览器已发送未确认的数据不超过 CLIENT_WINDOW 字节, 浏览器发送过快时不会占满服务端内存
+    窗口按字节计算而不是按帧数, 浏览器用小帧发送时吞吐不受影响
+写入在每个上传单独的线程中进行: feed 只把帧放入队列, websocket 的消息处理不会等待 SFTP 响应,
+    一个慢速的 SFTP 服务端不会占用 channels 共用的同步线程池; 窗口用完时浏览器等待 ack, 由写入线程回复
+上传使用单独的 sftp channel: 流水线写入期间 channel 上有未读取的响应, 这时同一 channel 上的其它请求(浏览目录等)
+会让 paramiko 丢弃这些响应, 上传再也等不到确认
+"""
+import collections
+import logging
+import threading
+import time
+import traceback
+
+import paramiko
+from paramiko import SFTPError
+from paramiko.sftp import CMD_STATUS, CMD_WRITE, int64
+
+from apps.utils.ssh_transport_pool import transport_pool
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 单个 write 请求的大小, 多数 SFTP 服务端支持到 32KB 以上, OpenSSH 最大 256KB
+UPLOAD_REQUEST_SIZE = getattr(settings, 'TERMINAL_SFTP_REQUEST_SIZE', 32 * 1024)
+# 在途(已发送未确认)的 write 请求数, 默认与 ssh channel 的 2MB 接收窗口相当
+UPLOAD_WINDOW = getattr(settings, 'TERMINAL_SFTP_UPLOAD_WINDOW', 64)
+# 浏览器已发送未收到 ack 的字节数上限, 上传开始时告知浏览器
+CLIENT_WINDOW = getattr(settings, 'TERMINAL_SFTP_CLIENT_WINDOW', 4 * 1024 * 1024)
+
+
+class SFTPUpload(object):
+    """
+    一次文件上传, feed 喂入浏览器的数据帧, finish 写完剩余数据并关闭文件
+    feed 在 websocket 的消息处理中调用, 不阻塞; 写入、读取响应、回复 ack 都在写入线程中进行
+    """
+    def __init__(self, sftp, path, mode='ab', window=UPLOAD_WINDOW, request_size=UPLOAD_REQUEST_SIZE,
+                 client_window=CLIENT_WINDOW, on_ack=None, on_error=None):
+        """
+        :param sftp: paramiko.SFTPClient
+        :param on_ack: 帧写入完成的回调 on_ack(帧序号, 已写入的字节数), 在写入线程中执行
+        :param on_error: 写入失败的回调 on_error(upload), 在写入线程中执行
+        """
+        self.sftp = sftp
+        self.path = path
+        self.fd = sftp.open(path, mode)
+        # 追加写入时从文件末尾开始, 部分服务端忽略 APPEND 标志, 按请求中的偏移写入
+        self.offset = self.fd.stat().st_size if 'a' in mode else 0
+        self.start = self.offset
+        self.written = self.offset  # 服务端已确认写入到的位置
+        self.window = window
+        self.request_size = request_size
+        self.client_window = client_window
+        self.on_ack = on_ack
+        self.on_error = on_error
+        self.error = None
+        self.buffer = bytearray()
+        self.inflight = collections.deque()  # (请求号, 写入后的位置)
+        self.frames = collections.deque()  # 未确认的帧 (帧序号, 帧数据的结束位置)
+        self.seq = 0
+        self.requests = 0
+        self.created = time.time()
+        self._transport = None  # open 从连接池取得的连接, 上传结束后归还
+        self._queue = collections.deque()  # 等待写入线程处理的帧 (帧序号, 数据)
+        self._queued = 0  # 队列中的字节数
+        self._finishing = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @classmethod
+    def open(cls, client, path, mode='ab', **kwargs):
+        """
+        在连接池的 ssh 连接上新开一个 sftp channel 上传
+        :param client: SFTPClient, 使用其连接信息
+        """
+        transport = transport_pool.acquire(client.ip, client.port, client.username, client.password)
+        sftp = None
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            upload = cls(sftp, path, mode, **kwargs)
+        except:
+            if sftp:
+                sftp.close()
+            transport_pool.release(transport)
+            raise
+        upload._transport = transport
+        return upload
+
+    @property
+    def size(self):
+        return self.written - self.start
+
+    def feed(self, data):
+        """
+        帧放入队列后立即返回
+        :param data: 浏览器的一个数据帧
+        :return: 帧序号
+        """
+        with self._cond:
+            if self.error is not None:
+                raise IOError('upload failed: {}'.format(self.error))
+            if self._queued + len(data) > 2 * self.client_window:
+                # 浏览器没有遵守发送窗口
+                raise IOError('upload client window exceeded')
+            self.seq += 1
+            self._queue.append((self.seq, data))
+            self._queued += len(data)
+            self._cond.notify()
+            seq = self.seq
+        self.check()
+        return seq
+
+    def finish(self, timeout=None):
+        """
+        写入剩余数据, 等待全部确认后关闭文件
+        剩余的数据不超过浏览器的发送窗口, 等待时间有限
+        :return: 本次上传的字节数
+        """
+        with self._cond:
+            self._finishing = True
+            self._cond.notify()
+        self.check()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise IOError('upload finish timeout')
+        if self.error is not None:
+            raise IOError('upload failed: {}'.format(self.error))
+        return self.size
+
+    def close(self):
+        """
+        中途放弃(连接断开或写入失败), 丢弃未发送的数据
+        """
+        with self._cond:
+            self._aborted = True
+            self._queue.clear()
+            self._cond.notify()
+        if self._thread is None:
+            self._close_file()
+            self._close_channel()
+        else:
+            # 关闭 channel, 等待响应的写入线程随之退出, 由写入线程关闭文件、归还连接
+            try:
+                self.sftp.close()
+            except:
+                pass
+
+    def check(self):
+        """
+        检查写入线程是否已启动
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, name='sftp-upload', daemon=True)
+        self._thread.start()
+
+    def run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self._finishing and not self._aborted and not self.inflight:
+                        self._cond.wait()
+                    if self._aborted:
+                        return
+                    frames = list(self._queue)
+                    self._queue.clear()
+                    self._queued = 0
+                    finishing = self._finishing
+                for seq, data in frames:
+                    self._write(seq, data)
+                if frames:
+                    self._reap_ready()
+                elif finishing:
+                    self._send(len(self.buffer))
+                    self._reap_until(self.offset)
+                    self._ack()
+                    self.fd.close()
+                    return
+                elif self.inflight:
+                    # 没有新的帧, 等待最早一个请求的响应
+                    self._reap_one()
+                self._ack()
+        except Exception as e:
+            if not self._aborted:
+                logger.error(traceback.format_exc())
+                self.error = e
+                if self.on_error is not None:
+                    self.on_error(self)
+        finally:
+            if self._aborted or self.error is not None:
+                self._close_file()
+            self._close_channel()
+
+    def _write(self, seq, data):
+        self.buffer += data
+        self.frames.append((seq, self.offset + len(self.buffer)))
+        self._send(len(self.buffer) - len(self.buffer) % self.request_size)
+        if self.offset + len(self.buffer) - self.written >= self.client_window:
+            # 浏览器的发送窗口已用完, 不再等待合并, 至少确认最早的一帧, 否则双方互相等待
+            self._send(len(self.buffer))
+            self._reap_until(self.frames[0][1])
+            self._ack()
+
+    def _close_file(self):
+        self.buffer = bytearray()
+        self.inflight.clear()
+        try:
+            self.fd.close()
+        except:
+            pass
+
+    def _close_channel(self):
+        if self._transport is None:
+            return
+        try:
+            self.sftp.close()
+        except:
+            pass
+        finally:
+            transport_pool.release(self._transport)
+            self._transport = None
+
+    def _send(self, size):
+        """
+        发送缓冲区开头 size 字节, 按 request_size 拆分为多个 write 请求
+        """
+        if size <= 0:
+            return
+        for start in range(0, size, self.request_size):
+            while len(self.inflight) >= self.window:
+                self._reap_one()
+            piece = bytes(self.buffer[start:min(start + self.request_size, size)])
+            num = self.sftp._async_request(type(None), CMD_WRITE, self.fd.handle, int64(self.offset), piece)
+            self.offset += len(piece)
+            self.inflight.append((num, self.offset))
+            self.requests += 1
+        del self.buffer[:size]
+
+    def _reap_one(self):
+        # 服务端按顺序处理请求, 按发送顺序读取响应; 写入失败时 _read_response 抛出 IOError
+        num, end = self.inflight.popleft()
+        t, msg = self.sftp._read_response(num)
+        if t != CMD_STATUS:
+            raise SFTPError('Expected status')
+        self.written = end
+
+    def _reap_ready(self):
+        """
+        读取已到达的响应, 不阻塞
+        """
+        while self.inflight and self.sftp.sock.recv_ready():
+            self._reap_one()
+
+    def _reap_until(self, position):
+        while self.inflight and self.written < position:
+            self._reap_one()
+
+    def _ack(self):
+        seq = None
+        while self.frames and self.frames[0][1] <= self.written:
+            seq = self.frames.popleft()[0]
+        if seq is not None and self.on_ack is not None:
+            self.on_ack(seq, self.size)
+
+
+if __name__ == "__main__":
+    # 吞吐: 本地 SFTP 服务端 + 注入往返延迟的代理, 64KB 帧逐帧同步写入 vs 流水线写入
+    import os
+    import queue
+    import socket
+    import tempfile
+    import threading
+
+    import paramiko
+
+    RTT = 0.04
+    FRAME = 64 * 1024
+    TOTAL = 16 * 1024 * 1024
+
+    class LocalHandle(paramiko.SFTPHandle):
+        def stat(self):
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.writefile.fileno()))
+
+    class LocalSFTP(paramiko.SFTPServerInterface):
+        def open(self, path, flags, attr):
+            handle = LocalHandle(flags)
+            handle.writefile = handle.readfile = os.fdopen(os.open(path, flags, 0o644), 'ab+')
+            return handle
+
+        def stat(self, path):
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    class LocalServer(paramiko.ServerInterface):
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+    def serve(listener, host_key):
+        while True:
+            conn, _ = listener.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTP)
+            transport.start_server(server=LocalServer())
+
+    def delay(src, dst):
+        # 每个方向各延迟半个往返
+        pending = queue.Queue()
+
+        def forward():
+            while True:
+                due, data = pending.get()
+                time.sleep(max(due - time.time(), 0))
+                if not data:
+                    dst.close()
+                    return
+                dst.sendall(data)
+        threading.Thread(target=forward, daemon=True).start()
+        while True:
+            data = src.recv(65536)
+            pending.put((time.time() + RTT / 2, data))
+            if not data:
+                return
+
+    def proxy(listener, target):
+        while True:
+            client, _ = listener.accept()
+            upstream = socket.create_connection(target)
+            for a, b in ((client, upstream), (upstream, client)):
+                threading.Thread(target=delay, args=(a, b), daemon=True).start()
+
+    def listen():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        return sock
+
+    server, front = listen(), listen()
+    threading.Thread(target=serve, args=(server, paramiko.RSAKey.generate(2048)), daemon=True).start()
+    threading.Thread(target=proxy, args=(front, server.getsockname()), daemon=True).start()
+    transport = paramiko.Transport(front.getsockname())
+    transport.connect(username='u', password='p')
+    sftp = paramiko.SFTPClient.from_transport(transport)
+    tmp = tempfile.mkdtemp()
+    data = os.urandom(TOTAL)
+
+    start = time.perf_counter()
+    with sftp.open(os.path.join(tmp, 'sync'), 'ab') as f:
+        for i in range(0, TOTAL, FRAME):
+            f.write(data[i:i + FRAME])
+    print('sync write:      {:.1f} MB/s'.format(TOTAL / (time.perf_counter() - start) / 1e6))
+
+    for frame in (FRAME, 4 * 1024):
+        # 浏览器: 已发送未确认的数据不超过 CLIENT_WINDOW
+        acks = []
+        acked = threading.Condition()
+
+        def on_ack(seq, size):
+            with acked:
+                acks.append(size)
+                acked.notify()
+        start = time.perf_counter()
+        upload = SFTPUpload(sftp, os.path.join(tmp, 'pipelined-{}'.format(frame)), on_ack=on_ack)
+        for i in range(0, TOTAL, frame):
+            with acked:
+                acked.wait_for(lambda: i + frame - (acks[-1] if acks else 0) <= CLIENT_WINDOW)
+            upload.feed(data[i:i + frame])
+        upload.finish()
+        elapsed = time.perf_counter() - start
+        with open(os.path.join(tmp, 'pipelined-{}'.format(frame)), 'rb') as f:
+            assert f.read() == data
+        print('pipelined {:>5}B frames: {:.1f} MB/s, {} requests, {} acks'.format(
+            frame, TOTAL / elapsed / 1e6, upload.requests, len(acks)))
@@ -3,13 +3,12 @@ import time
 import traceback
 import logging
 
-import paramiko
 import json
 
 from channels.generic.websocket import JsonWebsocketConsumer
 from paramiko import BadHostKeyException, AuthenticationException, SSHException
 
-from apps.common.consts import WsCode
+from apps.utils.ssh_transport_pool import transport_pool
 
 logger = logging.getLogger('service')
 
@@ -24,26 +23,23 @@ class SSHClient(object):
         self.port = port
         self.username = username
         self.password = password
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh_channel = None
         self.channel_name = None
         self.ws = kwargs.get('websocket')   # type: JsonWebsocketConsumer
-        self.transport = paramiko.Transport(sock=(self.ip, int(self.port)))
+        # 终端大小
+        self.cols = kwargs.get('cols') or 80
+        self.rows = kwargs.get('rows') or 24
+        # 与文件管理共用 transport_pool 中的同一个已认证连接
+        self.transport = None
 
     def ssh_connect(
         self, timeout=10, look_for_keys=False
     ):
         try:
-            self.client.connect(
-                hostname=self.ip,
-                port=self.port,
-                username=self.username,
-                password=self.password,
-                timeout=timeout,
-                look_for_keys=look_for_keys
+            self.transport = transport_pool.acquire(
+                self.ip, self.port, self.username, self.password, timeout=timeout
             )
-            self.transport.connect(username=self.username, password=self.password)
+            self.ssh_channel = self.transport.open_session()
         except (
             BadHostKeyException, AuthenticationException, SSHException,
             socket.error
@@ -55,32 +51,33 @@ class SSHClient(object):
                 )
                 self.ws.close()
             return
-        # transport = self.client.get_transport()
-        self.ssh_channel = self.transport.open_session()
         self.ssh_channel.set_name("{}_{}_{}".format(
             self.username, self.hostname, time.strftime("%Y%m%d%H%M%S")
         ))
-        print('------------------', self.ssh_channel.get_name())
-        # TODO 变更大小
-        self.ssh_channel.get_pty()
+        self.ssh_channel.get_pty(width=self.cols, height=self.rows)
         self.ssh_channel.invoke_shell()
         # 10分钟无输入就断开连接
         self.ssh_channel.settimeout(60*10)  # 10分钟
 
         for i in range(2):
-            hello_world = self.ssh_channel.recv(1024).decode('utf-8', 'ignore')
-            if self.ws:
-                self.ws.send(
-                    text_data=json.dumps({"code": WsCode.TEXT.value, 'message': hello_world.strip()})
-                )
-            self.ws.th.stdout.append([time.time() - self.ws.th.start_time, 'o', hello_world])
+            hello_world = self.ssh_channel.recv(1024)
+            if self.ws and hello_world:
+                # 与其它输出一样经会话发送: 按协商的格式(json/二进制)发给前端, 写入 scrollback 和录像
+                # 此时读取还没有注册到轮询线程, 不会与 on_read 同时修改读取状态
+                reader = self.ws.reader
+                reader.emit(reader.decoder.decode(hello_world), time.time(), data=hello_world)
 
     # 断开websocket和关闭ssh通道
     def close(self):
         try:
-            self.client.close()
+            if self.ssh_channel:
+                self.ssh_channel.close()
         except:
             logger.error(traceback.format_exc())
+        finally:
+            if self.transport:
+                transport_pool.release(self.transport)
+                self.transport = None
 
     def resize_pty(self, cols, rows):
         self.ssh_channel.resize_pty(width=cols, height=rows)
@@ -0,0 +1,193 @@
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+import paramiko
+
+from rzx_jms import settings
+
+logger = logging.getLogger('service')
+
+# 引用数为0的连接保留多久(秒)后关闭
+TRANSPORT_IDLE_TIMEOUT = getattr(settings, 'SSH_TRANSPORT_IDLE_TIMEOUT', 60)
+# 清理线程检查间隔(秒)
+TRANSPORT_SWEEP_INTERVAL = 10
+# 单个连接上最多同时打开的 channel 数, 与 sshd 的 MaxSessions(默认10) 保持一致
+TRANSPORT_MAX_SESSIONS = getattr(settings, 'SSH_TRANSPORT_MAX_SESSIONS', 10)
+# ssh keepalive 间隔(秒)
+TRANSPORT_KEEPALIVE = getattr(settings, 'SSH_TRANSPORT_KEEPALIVE', 30)
+# 连接池 key 中密码指纹的密钥, 每个进程随机生成, 内存中不保留可离线比对的密码摘要
+CREDENTIAL_SALT = os.urandom(16)
+
+
+class PooledTransport(object):
+    """
+    连接池中的一个连接, 一个条目只对应一个 transport: 连接断开后条目不再分配给新的使用者,
+    已持有的使用者照常 release, 引用数归零后由清理线程移除, 新的使用者建立新的条目
+    """
+    def __init__(self, key):
+        self.key = key
+        self.transport = None
+        self.refs = 0
+        self.last_used = time.time()
+        # 同一个 key 并发获取时只建立一次连接
+        self.lock = threading.Lock()
+
+    @property
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    @property
+    def is_dead(self):
+        # 建立过连接但已断开
+        return self.transport is not None and not self.transport.is_active()
+
+
+class TransportPool(object):
+    """
+    按 (ip, port, 账号, 密码指纹) 复用已认证的 paramiko.Transport, 密码不同的连接不会互相复用
+    终端的 shell 和文件管理的 sftp 都在同一个 transport 上开 channel, 只需要一次 TCP 连接和一次密钥交换;
+    一个 transport 上的 channel 数达到 max_sessions 时再新建连接, 引用计数归零后空闲超过 idle_timeout 才关闭
+    """
+    def __init__(self, idle_timeout=TRANSPORT_IDLE_TIMEOUT, max_sessions=TRANSPORT_MAX_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.stop = True
+        self._entries = {}  # key: [PooledTransport, ...]
+        self._owners = {}  # transport: PooledTransport
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    @staticmethod
+    def make_key(ip, port, username, password=None):
+        fingerprint = hmac.new(CREDENTIAL_SALT, (password or '').encode('utf-8'), hashlib.sha256).hexdigest()
+        return ip, int(port), username, fingerprint
+
+    def acquire(self, ip, port, username, password, timeout=10):
+        """
+        获取一个已认证的 transport, 用完后必须调用 release
+        :return: paramiko.Transport
+        """
+        key = self.make_key(ip, port, username, password)
+        try:
+            while True:
+                entry = self._reserve(key)
+                try:
+                    with entry.lock:
+                        if entry.transport is None:
+                            transport = self._connect(ip, port, username, password, timeout)
+                            with self._lock:
+                                entry.transport = transport
+                                self._owners[transport] = entry
+                        elif not entry.is_active:
+                            # 等锁期间连接已断开, 换一个条目
+                            self._release_entry(entry)
+                            continue
+                    return entry.transport
+                except:
+                    self._release_entry(entry)
+                    raise
+        finally:
+            self.check()
+
+    def _reserve(self, key):
+        """
+        选出一个没有断开且 channel 数未满的条目并增加引用数, 没有时新建条目(由调用方建立连接)
+        """
+        with self._lock:
+            entries = self._entries.setdefault(key, [])
+            entry = None
+            for item in entries:
+                if item.refs < self.max_sessions and not item.is_dead:
+                    entry = item
+                    break
+            if entry is None:
+                entry = PooledTransport(key)
+                entries.append(entry)
+            entry.refs += 1
+            entry.last_used = time.time()
+            return entry
+
+    def release(self, transport):
+        with self._lock:
+            entry = self._owners.get(transport)
+            if entry is not None:
+                entry.refs = max(entry.refs - 1, 0)
+                entry.last_used = time.time()
+
+    def _release_entry(self, entry):
+        with self._lock:
+            entry.refs = max(entry.refs - 1, 0)
+            entry.last_used = time.time()
+
+    @staticmethod
+    def _connect(ip, port, username, password, timeout):
+        sock = socket.create_connection((ip, int(port)), timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.connect(username=username, password=password)
+            transport.set_keepalive(TRANSPORT_KEEPALIVE)
+        except:
+            transport.close()
+            raise
+        return transport
+
+    @staticmethod
+    def _close_transport(entry):
+        if entry.transport is not None:
+            try:
+                entry.transport.close()
+            except:
+                logger.error(traceback.format_exc())
+            entry.transport = None
+
+    def evict_idle(self):
+        """
+        关闭空闲超时或已断开且无人使用的连接
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for key, entries in list(self._entries.items()):
+                for entry in list(entries):
+                    if entry.refs:
+                        continue
+                    if not entry.is_active or now - entry.last_used >= self.idle_timeout:
+                        entries.remove(entry)
+                        evicted.append(entry)
+                        self._owners.pop(entry.transport, None)
+                if not entries:
+                    self._entries.pop(key)
+        for entry in evicted:
+            self._close_transport(entry)
+        return len(evicted)
+
+    def check(self):
+        """
+        检查清理线程是否启动
+        :return:
+        """
+        with self._lock:
+            if not self.stop:
+                return
+            self.stop = False
+        t = threading.Thread(target=self.run, name='ssh-transport-pool', daemon=True)
+        t.start()
+
+    def run(self):
+        while True:
+            time.sleep(TRANSPORT_SWEEP_INTERVAL)
+            try:
+                self.evict_idle()
+            except:
+                logger.error(traceback.format_exc())
+
+
+transport_pool = TransportPool()